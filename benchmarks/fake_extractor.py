@@ -0,0 +1,65 @@
+# Canned stand-in for yt_dlp.YoutubeDL, so import paths can be benchmarked
+# without the network. install() swaps it into bot.yt_parse; every playlist
+# link resolves to `items` flat entries, every video link to one video, after
+# `latency` seconds of simulated extraction (spent on the extractor thread,
+# like the real thing).
+import time
+import hashlib
+
+import bot.yt_parse
+
+
+class FakeYoutubeDL:
+    items = 200
+    latency = 0.0
+
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @staticmethod
+    def _video(video_id, position=None):
+        #stable durations, so re-extracting a playlist gives the same fingerprint
+        seed = int(hashlib.md5(video_id.encode()).hexdigest()[:6], 16)
+        return {
+            "_type": "url",
+            "id": video_id,
+            "title": f"fake video {video_id}" + (f" #{position}" if position else ""),
+            "url": f"https://www.youtube.com/watch?v={video_id}",
+            "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+            "duration": 60 + seed % 3600,
+        }
+
+    def _entries(self, list_id):
+        for position in range(1, self.items + 1):
+            yield self._video(f"{list_id}-{position:05d}", position)
+
+    def extract_info(self, link, download=False, process=True, ie_key=None):
+        if self.latency:
+            time.sleep(self.latency)
+        kind, yt_id = bot.yt_parse.classify_link(link)
+        if kind == "playlist":
+            entries = self._entries(yt_id)
+            return {
+                "_type": "playlist",
+                "id": yt_id,
+                "title": f"fake playlist {yt_id}",
+                "playlist_count": self.items,
+                #process=False keeps entries lazy, as iter_playlist() expects
+                "entries": entries if not process else list(entries),
+            }
+        info = self._video(yt_id or hashlib.md5(link.encode()).hexdigest()[:11])
+        info["_type"] = "video"
+        return info
+
+
+def install(items=200, latency=0.0):
+    FakeYoutubeDL.items = items
+    FakeYoutubeDL.latency = latency
+    bot.yt_parse.yt_dlp.YoutubeDL = FakeYoutubeDL
+    return FakeYoutubeDL
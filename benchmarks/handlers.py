@@ -0,0 +1,305 @@
+# Drives the bot's real handler and service paths against a synthetic dataset at a fixed concurrency
+# and reports throughput and p50/p95/p99 per scenario, so runs can be compared across commits.
+#
+#   python -m benchmarks.synthetic --users 1000 --playlists 10 --items 200
+#   python -m benchmarks.handlers --users 1000 --playlists 10 --concurrency 32 --ops 2000
+#   python -m benchmarks.handlers --scenarios next,import --json after.json --compare before.json
+#   python -m benchmarks.synthetic --drop
+#
+# Scenarios (Telegram objects are in-process stand-ins, the database is real):
+#   show     /playlists  -> User.render_playlists_async
+#   stat     /stat       -> User.get_user_stat_async
+#   next     /next       -> Playlist.advance_for_user_async
+#   restart  /restart N  -> resolve_playlist_arg_async + Playlist.restart_async
+#   import   a link      -> ingest_link (enqueue) + IngestQueue.claim_async + process_job, with yt-dlp
+#                           replaced by benchmarks.fake_extractor (--extract-items, --extract-latency)
+#
+# Like the bot, one user's operations never overlap. --cold drops user_data before every operation,
+# so each one pays for the user lookup too. Uses the same DB_* environment variables as the bot, against
+# a UTF8 database with db/create_tables.sql applied (psycopg 3 hands back bytes for SQL_ASCII text).
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import logging
+import statistics
+import subprocess
+
+from dotenv import load_dotenv
+
+#before the bot modules read them: no token check, no metadata cache between runs, and extraction
+#on threads, where the patched YoutubeDL is visible
+os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+os.environ["YT_EXECUTOR"] = "thread"
+os.environ["YT_CACHE_MEMORY"] = "0"
+os.environ["YT_CACHE_PATH"] = ""
+
+import bot.main as handlers
+from bot.db_async import get_async_pool, close_async_pool
+from bot.extract_pool import shutdown_extraction_pool
+from bot.ingest_queue import IngestQueue
+from bot.ingest_worker import process_job
+from bot.metrics import get_metrics
+from bot.logs import setup_logging
+
+from benchmarks import synthetic, fake_extractor
+
+SCENARIOS = ("show", "stat", "next", "restart", "import")
+
+
+class FakeUser:
+    def __init__(self, tg_id):
+        self.id = tg_id
+        self.username = f"synth{synthetic.TG_BASE - tg_id}"
+        self.is_bot = False
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+        self.type = "private"
+
+
+class FakeMessage:
+    def __init__(self, user, chat, text):
+        self.from_user = user
+        self.chat = chat
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return FakeMessage(None, self.chat, text)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+
+class FakeUpdate:
+    def __init__(self, tg_id, text):
+        user = FakeUser(tg_id)
+        self.effective_user = user
+        self.effective_chat = FakeChat(tg_id)
+        self.message = self.effective_message = FakeMessage(user, self.effective_chat, text)
+
+
+class FakeContext:
+    def __init__(self, user_data, args=(), bot_data=None):
+        self.user_data = user_data
+        self.args = list(args)
+        self.bot_data = bot_data if bot_data is not None else {}
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return FakeMessage(None, FakeChat(chat_id), text)
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.bot = FakeBot()
+        self.user_data = {}
+        self.user_locks = {}
+        self.lists = itertools.count(1)
+        self.run_tag = f"{int(time.time()) % 100000:05d}"
+
+    def _context(self, tg_id, args=()):
+        if self.args.cold:
+            self.user_data.pop(tg_id, None)
+        return FakeContext(self.user_data.setdefault(tg_id, {}), args)
+
+    def _link(self):
+        #--shared-lists > 0 reuses sources, so most imports are copies out of the catalog
+        n = self.rng.randint(1, self.args.shared_lists) if self.args.shared_lists else next(self.lists)
+        return f"https://www.youtube.com/playlist?list=FAKE{self.run_tag}x{n}"
+
+    #each returns the replies, "🔴" in one of them counts the operation as failed
+    async def show(self, tg_id):
+        update = FakeUpdate(tg_id, "/playlists")
+        await handlers.show_playlists(update, self._context(tg_id))
+        return update.message.replies
+
+    async def stat(self, tg_id):
+        update = FakeUpdate(tg_id, "/stat")
+        await handlers.statistic(update, self._context(tg_id))
+        return update.message.replies
+
+    async def next(self, tg_id):
+        update = FakeUpdate(tg_id, "/next")
+        await handlers.send_videos(update, self._context(tg_id))
+        return update.message.replies
+
+    async def restart(self, tg_id):
+        position = self.rng.randint(1, self.args.playlists + 1)
+        update = FakeUpdate(tg_id, f"/restart {position}")
+        await handlers.restart_playlist(update, self._context(tg_id), playlist_position=position)
+        return update.message.replies
+
+    async def import_(self, tg_id):
+        update = FakeUpdate(tg_id, self._link())
+        await handlers.ingest_link(update, self._context(tg_id))
+        #the worker side of the same request; another user's job may come first, it is just as real
+        job = await IngestQueue.claim_async("bench")
+        if job:
+            await process_job(self.bot, job)
+        return update.message.replies
+
+    async def run(self, scenario, ops):
+        op = getattr(self, "import_" if scenario == "import" else scenario)
+        users = itertools.cycle(synthetic.tg_id(n) for n in range(1, self.args.users + 1))
+        remaining = itertools.count()
+        latencies = []
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            while next(remaining) < ops:
+                tg_id = next(users)
+                lock = self.user_locks.setdefault(tg_id, asyncio.Lock())
+                async with lock:
+                    started = time.perf_counter()
+                    try:
+                        replies = await op(tg_id)
+                        failed = any(r.startswith("🔴") for r in replies)
+                    except Exception:
+                        logging.getLogger(__name__).exception("%s failed", scenario)
+                        failed = True
+                    latencies.append(time.perf_counter() - started)
+                errors += failed
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def summarize(latencies, errors, wall):
+    latencies.sort()
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = latencies[0] if latencies else 0.0
+    return {
+        "ops": len(latencies),
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "ops_per_s": round(len(latencies) / wall, 1) if wall else 0.0,
+        "p50_ms": round(p50 * 1000, 2),
+        "p95_ms": round(p95 * 1000, 2),
+        "p99_ms": round(p99 * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def report(results, baseline=None):
+    print(f"{'scenario':<10} {'ops':>7} {'err':>5} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for scenario, r in results.items():
+        print(f"{scenario:<10} {r['ops']:>7} {r['errors']:>5} {r['ops_per_s']:>9.1f} "
+              f"{r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['max_ms']:>9.2f}")
+        old = (baseline or {}).get(scenario)
+        if old:
+            def delta(key):
+                return f"{(r[key] - old[key]) / old[key] * 100:+.0f}%" if old[key] else "n/a"
+            print(f"{'  vs base':<10} {'':>7} {'':>5} {delta('ops_per_s'):>9} "
+                  f"{delta('p50_ms'):>9} {delta('p95_ms'):>9} {delta('p99_ms'):>9} {delta('max_ms'):>9}")
+
+
+def print_queries(top=10):
+    rows = [r for r in get_metrics().summary(top=100) if r[0] == "query_seconds"][:top]
+    if not rows:
+        return
+    print(f"\n{'query':<36} {'count':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for _, name, count, p50, p95, p99, _ in rows:
+        print(f"{name[:36]:<36} {count:>8} {p50 * 1000:>9.2f} {p95 * 1000:>9.2f} {p99 * 1000:>9.2f}")
+
+
+async def run(args):
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    fake_extractor.install(items=args.extract_items, latency=args.extract_latency)
+    harness = Harness(args)
+    await get_async_pool()
+    results = {}
+    try:
+        for scenario in scenarios:
+            if args.warmup:
+                await harness.run(scenario, args.warmup)
+            get_metrics().reset()
+            results[scenario] = await harness.run(scenario, args.ops)
+            if args.queries:
+                print(f"\n-- {scenario}")
+                print_queries()
+    finally:
+        shutdown_extraction_pool()
+        await close_async_pool()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000, help="synthetic users to spread operations over")
+    parser.add_argument("--playlists", type=int, default=10, help="playlists per synthetic user")
+    parser.add_argument("--items", type=int, default=200, help="items per playlist (only used with --populate)")
+    parser.add_argument("--populate", action="store_true", help="load the synthetic dataset first")
+    parser.add_argument("--drop", action="store_true", help="remove the synthetic dataset afterwards")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=1000, help="timed operations per scenario")
+    parser.add_argument("--warmup", type=int, default=50, help="untimed operations per scenario")
+    parser.add_argument("--cold", action="store_true", help="no cached user_data between operations")
+    parser.add_argument("--extract-items", type=int, default=200)
+    parser.add_argument("--extract-latency", type=float, default=0.0, help="seconds per fake yt-dlp call")
+    parser.add_argument("--shared-lists", type=int, default=0, help="draw import links from this many sources")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--queries", action="store_true", help="print the slowest queries per scenario")
+    parser.add_argument("--json", help="write the results here")
+    parser.add_argument("--compare", help="results of an earlier --json run to diff against")
+    args = parser.parse_args()
+
+    load_dotenv()
+    #keep the log out of what is measured
+    setup_logging(level=logging.WARNING)
+
+    if args.populate:
+        synthetic.populate(args.users, args.playlists, args.items)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        if args.drop:
+            synthetic.drop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print()
+    report(results, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"commit": git_commit(), "args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# End-to-end load test of one bot process: thousands of simulated users send Telegram updates into the
+# Application from bot/main.py (per-user mailbox, session attach, handlers, ingest workers, the lot) and
+# every Bot API call is answered in memory. Prints updates/sec per process and update latency.
+#
+#   python -m benchmarks.synthetic --users 5000 --playlists 10 --items 200
+#   python -m benchmarks.load_driver --users 100,1000,5000 --mix next-heavy --duration 30
+#   python -m benchmarks.load_driver --users 2000 --mix next=50,stat=30,link=20 --think 1.0
+#
+# Each simulated user (one of the synthetic ones) sends an update, waits until the bot has handled it,
+# waits --think seconds and sends the next, the way people use a chat. With --think 0 the process runs
+# saturated and the throughput of the largest step is its capacity. Latency is from the update entering
+# the update queue to the end of its handling. The database is real, yt-dlp is benchmarks.fake_extractor.
+import os
+import time
+import random
+import asyncio
+import argparse
+import json
+import logging
+
+from dotenv import load_dotenv
+
+#only what answers updates: the background jobs would compete for the same loop and pool
+os.environ.setdefault("PLAYLIST_SYNC_WORKERS", "0")
+os.environ.setdefault("DELIVERY_SCHEDULER", "0")
+os.environ.setdefault("METRICS_DUMP_INTERVAL", "0")
+
+from benchmarks.handlers import summarize, git_commit
+from benchmarks import synthetic, fake_extractor
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+from bot.main import build_application, _post_init, _post_stop, _post_shutdown
+from bot.metrics import get_metrics
+from bot.logs import setup_logging
+from devtools.fake_telegram import FakeTelegram
+
+#action -> texts sent one after another (a /restart dialog is two updates)
+ACTIONS = {
+    "next": lambda rng, args: ["/next"],
+    "show": lambda rng, args: ["/show_playlists"],
+    "stat": lambda rng, args: ["/stat"],
+    "help": lambda rng, args: ["/help"],
+    "restart": lambda rng, args: ["/restart", str(rng.randint(1, args.playlists + 1))],
+    "link": lambda rng, args: [f"https://www.youtube.com/playlist?list=FAKEload{rng.randint(1, args.link_sources)}"],
+}
+
+MIXES = {
+    "default": {"next": 55, "show": 15, "stat": 10, "restart": 5, "link": 5, "help": 10},
+    "next-heavy": {"next": 90, "show": 5, "stat": 5},
+    "ingest-burst": {"link": 60, "next": 25, "show": 15},
+    "stat-storm": {"stat": 80, "next": 15, "show": 5},
+}
+
+
+def parse_mix(spec):
+    if spec in MIXES:
+        return MIXES[spec]
+    mix = {}
+    for part in spec.split(","):
+        action, _, weight = part.partition("=")
+        if action.strip() not in ACTIONS:
+            raise SystemExit(f"unknown action {action!r}, expected one of {', '.join(ACTIONS)}")
+        mix[action.strip()] = float(weight or 1)
+    return mix
+
+
+class StubRequest(BaseRequest):
+    #the Bot's HTTP layer: every call is answered by devtools.fake_telegram without leaving the process
+    def __init__(self):
+        self.telegram = FakeTelegram()
+        self.calls = {}
+        self.failures = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if str(params.get("text", "")).startswith("🔴"):
+            self.failures += 1
+        result = await self.telegram.call(api_method, params)
+        #nothing reads the transcript, keep memory flat over long runs
+        self.telegram.sent.clear()
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def reset(self):
+        self.calls.clear()
+        self.failures = 0
+
+
+class LoadTest:
+    def __init__(self, app, request, args):
+        self.app = app
+        self.request = request
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.pending = {}
+        processor = app.update_processor
+        after_update = processor.after_update
+
+        #completion comes from the mailbox, after the session is flushed like for a real update
+        async def done(update):
+            try:
+                if after_update:
+                    await after_update(update)
+            finally:
+                future = self.pending.pop(update.update_id, None)
+                if future and not future.done():
+                    future.set_result(time.perf_counter())
+
+        processor.after_update = done
+
+    async def send(self, tg_id, text):
+        update = Update.de_json(self.request.telegram.make_update(tg_id, text, f"synth{synthetic.TG_BASE - tg_id}"),
+                                self.app.bot)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[update.update_id] = future
+        queued_at = time.perf_counter()
+        await self.app.update_queue.put(update)
+        try:
+            finished_at = await asyncio.wait_for(future, timeout=self.args.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(update.update_id, None)
+            return None
+        return finished_at - queued_at
+
+    async def user(self, n, deadline, latencies, counters):
+        rng = random.Random(self.args.seed * 1_000_003 + n)
+        tg_id = synthetic.tg_id(n)
+        actions, weights = zip(*self.mix.items())
+        #spread the first sends over the ramp instead of a thundering herd at t=0
+        await asyncio.sleep(rng.random() * self.args.ramp)
+        while time.perf_counter() < deadline:
+            action = rng.choices(actions, weights)[0]
+            for text in ACTIONS[action](rng, self.args):
+                latency = await self.send(tg_id, text)
+                if latency is None:
+                    counters["timeouts"] += 1
+                else:
+                    latencies.append(latency)
+            if self.args.think:
+                await asyncio.sleep(rng.expovariate(1 / self.args.think))
+
+    async def step(self, users):
+        get_metrics().reset()
+        self.request.reset()
+        overflowed = self.app.update_processor.overflowed
+        latencies = []
+        counters = {"timeouts": 0}
+        started = time.perf_counter()
+        deadline = started + self.args.ramp + self.args.duration
+        await asyncio.gather(*(self.user(n, deadline, latencies, counters) for n in range(1, users + 1)))
+        result = summarize(latencies, self.request.failures, time.perf_counter() - started)
+        result.update({
+            "users": users,
+            "timeouts": counters["timeouts"],
+            "overflowed": self.app.update_processor.overflowed - overflowed,
+            "api_calls": dict(self.request.calls),
+        })
+        return result
+
+
+async def run(args):
+    fake_extractor.install(items=args.extract_items, latency=args.extract_latency)
+    request = StubRequest()
+    app = build_application(webhook=True, request=request)
+    #same lifecycle as bot/webhook.py
+    await app.initialize()
+    await _post_init(app)
+    await app.start()
+    results = []
+    try:
+        test = LoadTest(app, request, args)
+        for users in (int(u) for u in args.users.split(",")):
+            result = await test.step(users)
+            results.append(result)
+            print(f"{users:>7} users {result['ops_per_s']:>9.1f} updates/s   p50 {result['p50_ms']:.1f} ms"
+                  f"   p95 {result['p95_ms']:.1f} ms   p99 {result['p99_ms']:.1f} ms"
+                  f"   errors {result['errors']}   timeouts {result['timeouts']}   overflowed {result['overflowed']}")
+    finally:
+        await app.stop()
+        await _post_stop(app)
+        await app.shutdown()
+        await _post_shutdown(app)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", default="1000", help="simulated users, a comma list runs one step per value")
+    parser.add_argument("--playlists", type=int, default=10, help="playlists per synthetic user")
+    parser.add_argument("--mix", default="default", help=f"{', '.join(MIXES)} or e.g. next=60,stat=40")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per step, after the ramp")
+    parser.add_argument("--ramp", type=float, default=2, help="seconds over which users start")
+    parser.add_argument("--think", type=float, default=0, help="mean pause between a user's updates")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before an update counts as lost")
+    parser.add_argument("--link-sources", type=int, default=50, help="distinct playlists the link action sends")
+    parser.add_argument("--extract-items", type=int, default=200)
+    parser.add_argument("--extract-latency", type=float, default=0.5, help="seconds per fake yt-dlp call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the results here")
+    args = parser.parse_args()
+
+    load_dotenv()
+    setup_logging(level=logging.WARNING)
+
+    results = asyncio.run(run(args))
+    best = max(results, key=lambda r: r["ops_per_s"])
+    print(f"\ncapacity: {best['ops_per_s']:.1f} updates/s per process "
+          f"({args.mix} mix, {best['users']} users, p99 {best['p99_ms']:.0f} ms)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"commit": git_commit(), "args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
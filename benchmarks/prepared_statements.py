@@ -0,0 +1,111 @@
+# Planning time saved by preparing the hot registry queries (bot/queries.py) once per connection:
+# the /next statement (advance) and the /show_playlists one (render_playlists), plus the other lookups
+# every update makes. For each query prints the server's planning time, then the mean / p50 / p99 of
+# executing it unprepared (parsed and planned every time) vs prepared (psycopg prepare=True, as
+# run_query_async does).
+#
+#   python -m benchmarks.synthetic --users 100 --playlists 10 --items 200
+#   python -m benchmarks.prepared_statements --rounds 2000
+#
+# Runs as synthetic user 1 (--telegram-id for another user); every execution is rolled back, so /next
+# doesn't use up the playlist. advance_playlist() is plpgsql, which caches the plans of its own statements
+# per session either way: what preparing saves there is the outer SELECT. Uses the DB_* environment variables.
+#
+# Measured (PostgreSQL 16.2 over a unix socket, synthetic 100 x 10 x 200, --rounds 2000): planning takes
+# 0.03-0.15 ms per query and preparing saved 6% on advance, within +-2% (noise) on the others. The win
+# is the planning time per call, so it only shows where plans are costly or the server is busy planning.
+import argparse
+import json
+import os
+import statistics
+import time
+
+import psycopg
+from dotenv import load_dotenv
+
+from bot.playlist_class import ADVANCE_SQL, PICK_MODE
+from bot.user_class import RENDER_PLAYLISTS_SQL, USER_STAT_SQL, SELECT_USER_ID_SQL
+from bot.db_connection import RESOLVE_PLAYLIST_ARG_SQL
+
+from benchmarks import synthetic
+
+
+def connect():
+    return psycopg.connect(
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT", 5432),
+        prepare_threshold=None,
+    )
+
+
+def planning_ms(conn, query, params):
+    with conn.cursor() as cur:
+        cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + str(query), params)
+        plan = cur.fetchone()[0]
+    conn.rollback()
+    plan = plan if isinstance(plan, list) else json.loads(plan)
+    return plan[0]["Planning Time"]
+
+
+def timed(conn, query, params, rounds, prepare):
+    samples = []
+    with conn.cursor() as cur:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            cur.execute(query, params, prepare=prepare)
+            cur.fetchall()
+            samples.append(time.perf_counter() - start)
+            conn.rollback()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=1000)
+    parser.add_argument("--telegram-id", type=int, default=synthetic.tg_id(1))
+    args = parser.parse_args()
+
+    load_dotenv()
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SELECT_USER_ID_SQL, (args.telegram_id,))
+            row = cur.fetchone()
+        conn.rollback()
+        if not row:
+            raise SystemExit(f"no user with telegram_id {args.telegram_id}, run benchmarks.synthetic first")
+        user_id = row[0]
+
+        cases = [
+            (ADVANCE_SQL, (user_id, None, None, PICK_MODE)),
+            (RENDER_PLAYLISTS_SQL, (user_id,)),
+            (USER_STAT_SQL, (user_id,)),
+            (RESOLVE_PLAYLIST_ARG_SQL, (user_id, 2)),
+            (SELECT_USER_ID_SQL, (args.telegram_id,)),
+        ]
+        print(f"{'query':<22} {'plan ms':>8} | {'unprepared mean/p50/p99 ms':>28} | {'prepared mean/p50/p99 ms':>26} | {'saved':>6}")
+        for query, params in cases:
+            plan = planning_ms(conn, query, params)
+            #warm both paths (and the first, preparing, execution) out of the samples
+            timed(conn, query, params, 10, False)
+            timed(conn, query, params, 10, True)
+            unprepared = timed(conn, query, params, args.rounds, False)
+            prepared = timed(conn, query, params, args.rounds, True)
+
+            def stats(samples):
+                cuts = statistics.quantiles(samples, n=100)
+                return statistics.mean(samples) * 1000, cuts[49] * 1000, cuts[98] * 1000
+
+            u, p = stats(unprepared), stats(prepared)
+            saved = (u[0] - p[0]) / u[0] * 100 if u[0] else 0.0
+            print(f"{query.name:<22} {plan:>8.3f} | {u[0]:>9.3f} {u[1]:>8.3f} {u[2]:>9.3f} | "
+                  f"{p[0]:>8.3f} {p[1]:>8.3f} {p[2]:>8.3f} | {saved:>5.0f}%")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Loads the bot's own tables with a synthetic dataset: users x playlists x items,
+# the first --done-share of every playlist already watched. Playlist k of every
+# user points at the same videos, like a popular playlist in the shared catalog.
+#
+#   python -m benchmarks.synthetic --users 1000 --playlists 10 --items 200
+#   python -m benchmarks.synthetic --drop
+#
+# Synthetic users have telegram_id <= -1000000, videos a "synth_" youtube_id;
+# --drop removes exactly those. Uses the same DB_* environment variables as the bot.
+import argparse
+import os
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+TG_BASE = -1_000_000
+CHUNK_USERS = 500
+
+USERS_SQL = """
+    INSERT INTO users (telegram_id, username)
+    SELECT %(base)s - g, 'synth' || g
+        FROM generate_series(1, %(users)s) g
+    ON CONFLICT (telegram_id) DO NOTHING;
+    """
+
+VIDEOS_SQL = """
+    INSERT INTO videos (youtube_id, title, link, duration_sec)
+    SELECT 'synth_' || k || '_' || pos,
+           'synthetic video ' || k || '/' || pos,
+           'https://www.youtube.com/watch?v=synth_' || k || '_' || pos,
+           60 + (k * 7919 + pos * 104729) %% 3600
+        FROM generate_series(1, %(playlists)s) k
+        CROSS JOIN generate_series(1, %(items)s) pos
+    ON CONFLICT (youtube_id) DO NOTHING;
+    """
+
+#one chunk of users at a time keeps the counters triggers' transition tables small
+PLAYLISTS_SQL = """
+    WITH chunk AS (
+        SELECT u.id
+            FROM users u
+            WHERE u.telegram_id <= %(base)s - %(first)s
+            AND u.telegram_id > %(base)s - %(first)s - %(chunk)s
+            AND NOT EXISTS (SELECT 1 FROM playlists p WHERE p.user_id = u.id)
+    ), defaults AS (
+        INSERT INTO playlists (user_id, youtube_link, title)
+        SELECT c.id, 'default_playlist', 'playlist_for_single_videos'
+            FROM chunk c
+    )
+    INSERT INTO playlists (user_id, youtube_link, title)
+    SELECT c.id, 'https://www.youtube.com/playlist?list=SYNTH' || k, 'synthetic playlist ' || k
+        FROM chunk c
+        CROSS JOIN generate_series(1, %(playlists)s) k
+        ORDER BY c.id, k;
+    """
+
+ITEMS_SQL = """
+    INSERT INTO playlist_items (playlist_id, position_num, video_id, duration_sec, status, completed_at)
+    SELECT p.id, pos, v.id, v.duration_sec,
+           CASE WHEN pos <= %(items)s * %(done_share)s THEN 'done' ELSE 'await' END::watch_status,
+           CASE WHEN pos <= %(items)s * %(done_share)s THEN NOW() END
+        FROM users u
+        JOIN playlists p ON p.user_id = u.id AND p.youtube_link LIKE 'https://www.youtube.com/playlist?list=SYNTH%%'
+        CROSS JOIN generate_series(1, %(items)s) pos
+        JOIN videos v ON v.youtube_id = 'synth_' || split_part(p.youtube_link, 'SYNTH', 2) || '_' || pos
+        WHERE u.telegram_id <= %(base)s - %(first)s
+        AND u.telegram_id > %(base)s - %(first)s - %(chunk)s
+        AND NOT EXISTS (SELECT 1 FROM playlist_items pit WHERE pit.playlist_id = p.id);
+    """
+
+DROP_SQL = f"""
+    DELETE FROM users WHERE telegram_id <= {TG_BASE};
+    DELETE FROM playlists_catalog WHERE youtube_list_id LIKE 'SYNTH%' OR youtube_list_id LIKE 'FAKE%';
+    DELETE FROM videos v
+        WHERE (v.youtube_id LIKE 'synth\\_%' OR v.youtube_id LIKE 'FAKE%')
+        AND NOT EXISTS (SELECT 1 FROM playlist_items pit WHERE pit.video_id = v.id)
+        AND NOT EXISTS (SELECT 1 FROM playlists_catalog_items ci WHERE ci.video_id = v.id);
+    """
+
+
+def connect():
+    conn = psycopg2.connect(
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT", 5432)
+    )
+    conn.autocommit = True
+    return conn
+
+
+def tg_id(n):
+    #telegram id of synthetic user n, 1-based
+    return TG_BASE - n
+
+
+def populate(users, playlists, items, done_share=0.5, log=print):
+    params = {"base": TG_BASE, "users": users, "playlists": playlists, "items": items,
+              "done_share": done_share, "chunk": CHUNK_USERS}
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            start = time.perf_counter()
+            cur.execute(USERS_SQL, params)
+            cur.execute(VIDEOS_SQL, params)
+            for first in range(0, users, CHUNK_USERS):
+                chunk = {**params, "first": first}
+                cur.execute(PLAYLISTS_SQL, chunk)
+                cur.execute(ITEMS_SQL, chunk)
+                log(f"-- users {first + 1}..{min(first + CHUNK_USERS, users)}: {time.perf_counter() - start:.1f} s")
+            cur.execute("ANALYZE users, videos, playlists, playlist_items;")
+            log(f"-- {users} users x {playlists} playlists x {items} items loaded in {time.perf_counter() - start:.1f} s")
+    finally:
+        conn.close()
+
+
+def drop(log=print):
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            start = time.perf_counter()
+            cur.execute(DROP_SQL)
+            log(f"-- synthetic data dropped in {time.perf_counter() - start:.1f} s")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--playlists", type=int, default=10)
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--done-share", type=float, default=0.5)
+    parser.add_argument("--drop", action="store_true", help="remove the synthetic data and exit")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.drop:
+        drop()
+        return
+    populate(args.users, args.playlists, args.items, args.done_share)
+
+
+if __name__ == "__main__":
+    main()
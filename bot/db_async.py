@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import partial
+
+from psycopg_pool import AsyncConnectionPool
+
+from bot.db_connection import MARK_VIDEO_DONE_SQL, RESOLVE_PLAYLIST_ARG_SQL, playlist_number
+from bot.metrics import get_metrics, query_name
+from bot.queries import Query, PREPARE, PREPARED_MAX
+from bot.logs import log_params
+
+
+logger = logging.getLogger(__name__)
+
+_apool = None
+_apool_lock = None
+_current_aconn = ContextVar("current_aconn", default=None)
+
+
+async def get_async_pool():
+    global _apool, _apool_lock
+    if _apool is not None:
+        return _apool
+    if _apool_lock is None:
+        _apool_lock = asyncio.Lock()
+    async with _apool_lock:
+        if _apool is None:
+            pool = AsyncConnectionPool(
+                conninfo="",
+                min_size=int(os.getenv("DB_POOL_MIN", 1)),
+                max_size=int(os.getenv("DB_POOL_MAX", 10)),
+                timeout=float(os.getenv("DB_POOL_TIMEOUT", 10)),
+                max_idle=float(os.getenv("DB_POOL_MAX_IDLE", 600)),
+                check=AsyncConnectionPool.check_connection,
+                configure=_configure_connection,
+                open=False,
+                kwargs={
+                    "dbname": os.getenv("DB_NAME"),
+                    "user": os.getenv("DB_USER"),
+                    "password": os.getenv("DB_PASSWORD"),
+                    "host": os.getenv("DB_HOST"),
+                    "port": os.getenv("DB_PORT", 5432),
+                },
+            )
+            await pool.open()
+            _apool = pool
+            get_metrics().register_gauge("db_pool_async", partial(_pool_stats, pool))
+            logger.info("Async DB pool opened: min=%s max=%s", pool.min_size, pool.max_size)
+    return _apool
+
+
+#psycopg prepares a statement after prepare_threshold runs on one connection; registry queries are
+#prepared on their first (run_query_async passes prepare=True), the cache just has to hold them all
+async def _configure_connection(conn):
+    conn.prepared_max = PREPARED_MAX
+    if not PREPARE:
+        conn.prepare_threshold = None
+
+
+def _pool_stats(pool):
+    stats = pool.get_stats()
+    return {key: stats.get(key, 0) for key in ("pool_max", "pool_size", "pool_available", "requests_waiting")}
+
+
+async def close_async_pool():
+    global _apool
+    if _apool is not None:
+        await _apool.close()
+        _apool = None
+
+
+@asynccontextmanager
+async def async_transaction():
+    #same contract as db_connection.transaction(): nested calls join the outer one
+    conn = _current_aconn.get()
+    if conn is not None:
+        yield conn
+        return
+
+    pool = await get_async_pool()
+    #pool.connection() commits on success, rolls back on error and drops broken connections
+    started = time.perf_counter()
+    async with pool.connection() as conn:
+        get_metrics().observe("db_pool_wait_seconds", "async", time.perf_counter() - started)
+        token = _current_aconn.set(conn)
+        try:
+            yield conn
+        finally:
+            _current_aconn.reset(token)
+
+
+async def run_query_async(query, params=None, *, fetchone=False, fetchall=False, name=None):
+    async with async_transaction() as conn:
+        async with conn.cursor() as cur:
+            with get_metrics().timer("query_seconds", name or query_name(query)):
+                await cur.execute(query, params, prepare=True if PREPARE and isinstance(query, Query) else None)
+            if cur.description:
+                if fetchone:
+                    result = await cur.fetchone()       # tuple | None
+                elif fetchall:
+                    result = await cur.fetchall()      # list[tuple]
+                else:
+                    result = None
+            else:
+                result = None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Query executed: %s | params=%s", query_name(query), log_params(params))
+        return result
+
+
+async def mark_video_done_async(video_id, playlist_id, user_id):
+    res = await run_query_async(MARK_VIDEO_DONE_SQL, (video_id, playlist_id, user_id), fetchone=True)
+    return bool(res)
+
+
+async def resolve_playlist_arg_async(user_id, number):
+    num = playlist_number(number)
+    if num is None:
+        return None
+
+    row = await run_query_async(RESOLVE_PLAYLIST_ARG_SQL, (user_id, num), fetchone=True)
+    return row[0] if row else None
+
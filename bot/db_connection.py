@@ -1,24 +1,203 @@
 import psycopg2
+from psycopg2 import errors as pg_errors
+from psycopg2 import pool as pg_pool
+from psycopg2.extensions import connection as pg_connection
 import os
+import time
 import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from bot.metrics import get_metrics, query_name
+from bot.queries import Query, register, PREPARE
+from bot.logs import log_params
 
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
-def run_query(query, params=None, *, fetchone=False, fetchall=False):
-    with psycopg2.connect(
-        dbname=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT", 5432)
-    ) as conn:
-        with conn.cursor() as cur:
+
+class PreparingConnection(pg_connection):
+    #names of the registry queries PREPAREd in this server session; they live as long as the connection
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class ConnectionPool:
+    #psycopg2 pool raises PoolError when exhausted, so callers wait on a semaphore instead
+    def __init__(self, minconn, maxconn, timeout, check_after, **conn_kwargs):
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, **conn_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self.timeout = timeout
+        self.check_after = check_after
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.in_use = 0
+        self.waiting = 0
+        self._stats_lock = threading.Lock()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        #skip the round trip for connections that were used recently
+        idle = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        with self._stats_lock:
+            self.waiting += 1
+        try:
+            with get_metrics().timer("db_pool_wait_seconds", "sync"):
+                acquired = self._slots.acquire(timeout=self.timeout)
+        finally:
+            with self._stats_lock:
+                self.waiting -= 1
+        if not acquired:
+            raise pg_pool.PoolError(f"no free DB connection after {self.timeout}s")
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                logger.warning("Recycling broken DB connection")
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+                self._last_used[id(conn)] = time.monotonic()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._stats_lock:
+            self.in_use += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        self._last_used[id(conn)] = time.monotonic()
+        try:
+            if close or conn.closed:
+                self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            with self._stats_lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        return {"max": self.maxconn, "in_use": self.in_use, "waiting": self.waiting}
+
+    def closeall(self):
+        self._last_used.clear()
+        self._pool.closeall()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_current_conn = ContextVar("current_conn", default=None)
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    minconn=int(os.getenv("DB_POOL_MIN", 1)),
+                    maxconn=int(os.getenv("DB_POOL_MAX", 10)),
+                    timeout=float(os.getenv("DB_POOL_TIMEOUT", 10)),
+                    check_after=float(os.getenv("DB_POOL_CHECK_AFTER", 30)),
+                    dbname=os.getenv("DB_NAME"),
+                    user=os.getenv("DB_USER"),
+                    password=os.getenv("DB_PASSWORD"),
+                    host=os.getenv("DB_HOST"),
+                    port=os.getenv("DB_PORT", 5432),
+                    connection_factory=PreparingConnection
+                )
+                logger.info("DB pool created: min=%s max=%s", _pool.minconn, _pool.maxconn)
+                get_metrics().register_gauge("db_pool_sync", _pool.stats)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def transaction():
+    #nested calls join the outer transaction, so one request shares one connection
+    conn = _current_conn.get()
+    if conn is not None:
+        yield conn
+        return
+
+    pool = get_pool()
+    conn = pool.getconn()
+    token = _current_conn.set(conn)
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except BaseException as e:
+        broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        _current_conn.reset(token)
+        pool.putconn(conn, close=broken)
+
+
+#queries the server wouldn't PREPARE (a parameter whose type it can't infer): executed as plain text
+_unpreparable = set()
+#the statement itself can't be prepared; anything else (lock timeout, lost connection) may pass next time
+PERMANENT_PREPARE_ERRORS = (pg_errors.IndeterminateDatatype, pg_errors.UndefinedFunction)
+
+
+#psycopg2 only speaks the simple protocol, so registry queries go through an explicit PREPARE once per
+#connection and EXECUTE name(...) afterwards: parsed and analysed once, plans cached by the server
+def _execute_prepared(conn, cur, query, params):
+    if query.name not in conn.prepared:
+        statement, _, _ = query.positional
+        cur.execute("SAVEPOINT prepare_query")
+        try:
+            cur.execute(f"PREPARE {query.name} AS {statement}")
+        except PERMANENT_PREPARE_ERRORS as e:
+            cur.execute("ROLLBACK TO SAVEPOINT prepare_query")
+            _unpreparable.add(query.name)
+            logger.warning("Query %s can't be prepared, running it unprepared: %s", query.name, e)
             cur.execute(query, params)
+            return
+        cur.execute("RELEASE SAVEPOINT prepare_query")
+        conn.prepared.add(query.name)
+
+    values = query.values(params)
+    if values:
+        cur.execute(f"EXECUTE {query.name} ({', '.join(['%s'] * len(values))})", values)
+    else:
+        cur.execute(f"EXECUTE {query.name}")
+
+
+#name labels the query_seconds histogram, by default the registry name of the query
+def run_query(query, params=None, *, fetchone=False, fetchall=False, name=None):
+    with transaction() as conn:
+        with conn.cursor() as cur, get_metrics().timer("query_seconds", name or query_name(query)):
+            if PREPARE and isinstance(query, Query) and query.name not in _unpreparable:
+                _execute_prepared(conn, cur, query, params)
+            else:
+                cur.execute(query, params)
             if cur.description:
                 if fetchone:
                     result = cur.fetchone()       # tuple | None
@@ -28,25 +207,12 @@ def run_query(query, params=None, *, fetchone=False, fetchall=False):
                     result = None
             else:
                 result = None
-        logger.info("Query executed: %s | params=%s", query.strip().split("\n")[0], params)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Query executed: %s | params=%s", query_name(query), log_params(params))
         return result
-    
-def simple_insert(table_name, holders : int, column_name_list, conflict = 0, returning = 0, conflict_object = None , returning_object = None):
-    text =  f"""
-            INSERT INTO {table_name} ({", ".join(column_name_list)})
-            VALUES ({", ".join(["%s"] * holders)})
-"""
-    if conflict == 1:
-        text += f'\nON CONFLICT ({", ".join(conflict_object)}) DO NOTHING'
-    if returning == 1:
-        text += f'\nRETURNING {returning_object}'
-
-    text += ';'
-    return text
 
 
-def mark_video_done(video_id, playlist_id, user_id):
-    res = run_query("""
+MARK_VIDEO_DONE_SQL = register("mark_video_done", """
         UPDATE playlist_items AS pit
             SET status = 'done',
                 completed_at = NOW()
@@ -59,33 +225,36 @@ def mark_video_done(video_id, playlist_id, user_id):
                     AND p.user_id = %s
             )
             RETURNING pit.id;
-""", (video_id, playlist_id, user_id), fetchone=True)
+""")
+
+#ordinal is kept by the playlists_assign_ordinal trigger: a point lookup on UNIQUE (user_id, ordinal)
+RESOLVE_PLAYLIST_ARG_SQL = register("resolve_playlist_arg", """
+            SELECT p.id
+                FROM playlists p
+                WHERE p.user_id = %s
+                AND p.ordinal = %s;
+        """)
+
+
+def mark_video_done(video_id, playlist_id, user_id):
+    res = run_query(MARK_VIDEO_DONE_SQL, (video_id, playlist_id, user_id), fetchone=True)
     return bool(res)
 
 
-def resolve_playlist_arg(user_id, number):
+def playlist_number(number):
     if not number:
         return None
     
     try:
-        num = int(number)
+        return int(number)
     except ValueError:
         return None
-    
-    row = run_query("""
-            WITH ordered AS (
-                SELECT p.id, ROW_NUMBER() OVER (ORDER BY p.id) AS num
-                FROM playlists p
-                WHERE p.user_id = %s
-                    AND p.youtube_link <> 'default_playlist'
-            )
-            SELECT id FROM ordered WHERE num = %s;
-        """, (user_id, num), fetchone=True)
-    return row[0] if row else None
 
 
+def resolve_playlist_arg(user_id, number):
+    num = playlist_number(number)
+    if num is None:
+        return None
 
-
-        
-    
-
+    row = run_query(RESOLVE_PLAYLIST_ARG_SQL, (user_id, num), fetchone=True)
+    return row[0] if row else None
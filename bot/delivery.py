@@ -0,0 +1,176 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from psycopg import errors as pg_errors
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+from bot.db_async import run_query_async
+from bot.queries import register
+from bot.playlist_class import PICK_MODE
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_BATCH = int(os.getenv("DELIVERY_BATCH", 500))
+#Telegram allows about 30 messages per second per bot token, split it between replicas
+DELIVERY_RATE = float(os.getenv("DELIVERY_RATE", 25))
+DELIVERY_BURST = int(os.getenv("DELIVERY_BURST", 25))
+
+SCHEDULE_SQL = register("schedule", """
+            INSERT INTO delivery_schedules (user_id, chat_id, send_time, timezone, playlist_id, next_run_at)
+            VALUES (%(user_id)s, %(chat_id)s, %(send_time)s, %(timezone)s, %(playlist_id)s,
+                    next_delivery_at(%(send_time)s, %(timezone)s))
+            ON CONFLICT (user_id) DO UPDATE
+                SET chat_id = EXCLUDED.chat_id,
+                    send_time = EXCLUDED.send_time,
+                    timezone = EXCLUDED.timezone,
+                    playlist_id = EXCLUDED.playlist_id,
+                    next_run_at = EXCLUDED.next_run_at
+            RETURNING next_run_at;
+            """)
+
+UNSCHEDULE_SQL = register("unschedule", "DELETE FROM delivery_schedules WHERE user_id = %s RETURNING user_id;")
+
+#deliver_due() lives in db/create_tables.sql: claims a bucket of due schedules and advances all of them at once
+DELIVER_DUE_SQL = register("deliver_due", "SELECT user_id, chat_id, playlist_id, item_id, link, playlist_done FROM deliver_due(%s, %s);")
+
+
+class UnknownTimezone(ValueError):
+    pass
+
+
+class DeliverySchedule:
+    #send_time is a datetime.time, tz_name an IANA zone. Postgres computes the delivery times with its own
+    #zone database, which can differ from Python's: a zone it doesn't know fails the upsert, nothing is stored
+    @staticmethod
+    async def schedule_async(user_id, chat_id, send_time, tz_name, playlist_id=None):
+        try:
+            row = await run_query_async(SCHEDULE_SQL, {
+                "user_id": user_id,
+                "chat_id": chat_id,
+                "send_time": send_time,
+                "timezone": tz_name,
+                "playlist_id": playlist_id,
+            }, fetchone=True)
+        except pg_errors.InvalidParameterValue as e:
+            #time zone "..." not recognized, raised by next_delivery_at()
+            raise UnknownTimezone(tz_name) from e
+        return row[0] if row else None
+
+    @staticmethod
+    async def unschedule_async(user_id):
+        row = await run_query_async(UNSCHEDULE_SQL, (user_id,), fetchone=True)
+        return bool(row)
+
+    @staticmethod
+    async def deliver_due_async(limit=DELIVERY_BATCH, mode=PICK_MODE):
+        rows = await run_query_async(DELIVER_DUE_SQL, (limit, mode), fetchall=True)
+        return [
+            {"user_id": user_id, "chat_id": chat_id, "playlist_id": playlist_id,
+             "item_id": item_id, "link": link, "playlist_done": playlist_done}
+            for user_id, chat_id, playlist_id, item_id, link, playlist_done in rows or []
+        ]
+
+
+class TokenBucket:
+    #rate tokens per second, at most capacity saved up; acquire() waits for one
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    #Telegram asked us to back off: nothing goes out for that long
+    async def pause(self, seconds):
+        async with self._lock:
+            await asyncio.sleep(seconds)
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+
+async def _send(bot, bucket, delivery):
+    text = f"🎬 Your video for today:\n{delivery['link']}"
+    if delivery["playlist_done"]:
+        text += "\nPlaylist has been marked as done!"
+    for _ in range(3):
+        await bucket.acquire()
+        try:
+            await bot.send_message(delivery["chat_id"], text)
+            return
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            logger.warning("Flood control, pausing delivery for %ss", retry_after)
+            await bucket.pause(retry_after)
+        except Forbidden:
+            #blocked the bot: stop sending until they /schedule again
+            logger.info("User %s blocked the bot, dropping their schedule", delivery["user_id"])
+            await DeliverySchedule.unschedule_async(delivery["user_id"])
+            return
+        except TelegramError as e:
+            logger.warning("Failed to deliver to chat %s: %s", delivery["chat_id"], e)
+            return
+    logger.warning("Gave up delivering to chat %s", delivery["chat_id"])
+
+
+async def run_sender(bot, queue, bucket):
+    while True:
+        delivery = await queue.get()
+        try:
+            await _send(bot, bucket, delivery)
+        except Exception:
+            logger.exception("🔴 Delivery to chat %s crashed", delivery["chat_id"])
+        finally:
+            queue.task_done()
+
+
+#wakes at the top of every minute and drains that minute's bucket batch by batch. The next batch is only
+#claimed once the sender has sent the last one, so at most one batch is claimed (and marked done) but unsent
+async def run_scheduler(bot, stop, rate=DELIVERY_RATE, burst=DELIVERY_BURST):
+    queue = asyncio.Queue(maxsize=DELIVERY_BATCH)
+    bucket = TokenBucket(rate, burst)
+    sender = asyncio.create_task(run_sender(bot, queue, bucket))
+    logger.info("Delivery scheduler started: %s msg/s", rate)
+    try:
+        while not stop.is_set():
+            try:
+                while not stop.is_set():
+                    await queue.join()
+                    batch = await DeliverySchedule.deliver_due_async()
+                    for delivery in batch:
+                        await queue.put(delivery)
+                    if batch:
+                        logger.info("Queued %s scheduled deliveries", len(batch))
+                    if len(batch) < DELIVERY_BATCH:
+                        break
+            except Exception:
+                logger.exception("🔴 Failed to claim scheduled deliveries")
+
+            now = datetime.now(timezone.utc)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=60 - now.second - now.microsecond / 1e6)
+            except asyncio.TimeoutError:
+                pass
+        #what was claimed is already marked done, send it before leaving
+        await queue.join()
+    finally:
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+    logger.info("Delivery scheduler stopped")
+
+
+def start_scheduler(bot, stop):
+    return asyncio.create_task(run_scheduler(bot, stop))
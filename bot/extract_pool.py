@@ -0,0 +1,144 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
+from bot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractorBusy(RuntimeError):
+    pass
+
+
+class ExtractionPool:
+    #max_workers extractions run at once, up to max_queue more wait for a worker, the rest are rejected
+    def __init__(self, max_workers, max_queue, kind="thread"):
+        if kind == "process":
+            self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="yt-dlp")
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.kind = kind
+        self._pending = 0
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def queued(self):
+        return max(self._pending - self.max_workers, 0)
+
+    async def submit(self, func, *args, **kwargs):
+        if self._pending >= self.max_workers + self.max_queue:
+            raise ExtractorBusy(f"extraction queue is full ({self._pending} pending)")
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            #queue wait included: that's what the handler waiting on it sees
+            with get_metrics().timer("extraction_seconds", func.__name__):
+                return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    async def stream(self, gen_func, *args, chunk_size=200):
+        #runs a blocking generator on a worker thread and yields its items in lists of chunk_size.
+        #the first item comes alone so a header can be handled right away; at most two chunks are buffered
+        if self._pending >= self.max_workers + self.max_queue:
+            raise ExtractorBusy(f"extraction queue is full ({self._pending} pending)")
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=2)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def produce():
+            gen = gen_func(*args)
+            chunk = []
+            first = True
+            error = None
+            try:
+                for item in gen:
+                    if stop.is_set():
+                        return
+                    chunk.append(item)
+                    if first or len(chunk) >= chunk_size:
+                        put(chunk)
+                        chunk, first = [], False
+                if chunk:
+                    put(chunk)
+            except Exception as e:
+                error = e
+            finally:
+                gen.close()
+            put((done, error))
+
+        self._pending += 1
+        #generators can't cross process boundaries, streams always use a thread
+        producer = loop.run_in_executor(None if self.kind == "process" else self._executor, produce)
+        started = time.perf_counter()
+        try:
+            while True:
+                batch = await queue.get()
+                if isinstance(batch, tuple) and batch and batch[0] is done:
+                    if batch[1] is not None:
+                        raise batch[1]
+                    break
+                yield batch
+        finally:
+            get_metrics().observe("extraction_seconds", gen_func.__name__, time.perf_counter() - started)
+            self._pending -= 1
+            stop.set()
+            #unblock a producer waiting on a full queue
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+
+    def stats(self):
+        return {"workers": self.max_workers, "pending": self._pending, "queued": self.queued}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_extraction_pool = None
+
+
+def get_extraction_pool():
+    global _extraction_pool
+    if _extraction_pool is None:
+        _extraction_pool = ExtractionPool(
+            max_workers=int(os.getenv("YT_WORKERS", 4)),
+            max_queue=int(os.getenv("YT_QUEUE_MAX", 32)),
+            kind=os.getenv("YT_EXECUTOR", "thread"),
+        )
+        logger.info("Extraction pool started: %s workers=%s queue=%s",
+                    _extraction_pool.kind, _extraction_pool.max_workers, _extraction_pool.max_queue)
+        get_metrics().register_gauge("extractor", _extraction_pool.stats)
+    return _extraction_pool
+
+
+async def run_extraction(func, *args, **kwargs):
+    return await get_extraction_pool().submit(func, *args, **kwargs)
+
+
+def stream_extraction(gen_func, *args, chunk_size=200):
+    return get_extraction_pool().stream(gen_func, *args, chunk_size=chunk_size)
+
+
+def shutdown_extraction_pool():
+    global _extraction_pool
+    if _extraction_pool is not None:
+        _extraction_pool.shutdown()
+        _extraction_pool = None
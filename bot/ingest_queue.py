@@ -0,0 +1,123 @@
+import os
+import json
+
+from bot.db_async import run_query_async
+from bot.queries import register
+
+
+RETRY_BASE_SEC = float(os.getenv("INGEST_RETRY_BASE", 30))
+RETRY_MAX_SEC = float(os.getenv("INGEST_RETRY_MAX", 3600))
+LEASE_SEC = float(os.getenv("INGEST_LEASE", 900))
+
+ENQUEUE_JOB_SQL = register("enqueue_job", """
+            INSERT INTO ingest_jobs (user_id, chat_id, link, max_attempts)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id;
+            """)
+
+#SKIP LOCKED lets any number of workers claim jobs without blocking each other
+CLAIM_JOB_SQL = register("claim_job", """
+            UPDATE ingest_jobs j
+                SET status = 'running',
+                    attempts = j.attempts + 1,
+                    locked_by = %s,
+                    locked_at = NOW()
+                WHERE j.id = (
+                    SELECT id
+                        FROM ingest_jobs
+                        WHERE status = 'queued'
+                        AND run_after <= NOW()
+                        ORDER BY run_after, id
+                        FOR UPDATE SKIP LOCKED
+                        LIMIT 1
+                )
+                RETURNING j.id, j.user_id, j.chat_id, j.link, j.attempts, j.max_attempts;
+            """)
+
+COMPLETE_JOB_SQL = register("complete_job", """
+            UPDATE ingest_jobs
+                SET status = 'done',
+                    result = %s::jsonb,
+                    last_error = NULL,
+                    finished_at = NOW()
+                WHERE id = %s
+                AND locked_by = %s
+                AND status = 'running'
+                RETURNING id;
+            """)
+
+FAIL_JOB_SQL = register("fail_job", """
+            UPDATE ingest_jobs
+                SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                    run_after = NOW() + make_interval(secs => %s),
+                    last_error = %s,
+                    locked_by = NULL,
+                    locked_at = NULL,
+                    finished_at = CASE WHEN attempts >= max_attempts THEN NOW() END
+                WHERE id = %s
+                AND locked_by = %s
+                AND status = 'running'
+                RETURNING status;
+            """)
+
+#the running worker keeps its lease alive, so requeue_stale only picks up jobs whose worker is gone
+RENEW_LEASE_SQL = register("renew_lease", """
+            UPDATE ingest_jobs
+                SET locked_at = NOW()
+                WHERE id = %s
+                AND locked_by = %s
+                AND status = 'running'
+                RETURNING id;
+            """)
+
+#jobs whose worker died mid-import go back to the queue once their lease runs out
+REQUEUE_STALE_SQL = register("requeue_stale", """
+            UPDATE ingest_jobs
+                SET status = 'queued',
+                    locked_by = NULL,
+                    locked_at = NULL
+                WHERE status = 'running'
+                AND locked_at < NOW() - make_interval(secs => %s)
+                RETURNING id;
+            """)
+
+
+class IngestQueue:
+    @staticmethod
+    async def enqueue_async(user_id, chat_id, link, max_attempts=None):
+        max_attempts = max_attempts or int(os.getenv("INGEST_MAX_ATTEMPTS", 5))
+        row = await run_query_async(ENQUEUE_JOB_SQL, (user_id, chat_id, link, max_attempts), fetchone=True)
+        return row[0] if row else None
+
+    @staticmethod
+    async def claim_async(worker_id):
+        row = await run_query_async(CLAIM_JOB_SQL, (worker_id,), fetchone=True)
+        if not row:
+            return None
+        job_id, user_id, chat_id, link, attempts, max_attempts = row
+        return {"id": job_id, "user_id": user_id, "chat_id": chat_id, "link": link,
+                "attempts": attempts, "max_attempts": max_attempts, "worker_id": worker_id}
+
+    #False once the job is no longer this worker's (requeued as stale, claimed by another)
+    @staticmethod
+    async def renew_lease_async(job):
+        row = await run_query_async(RENEW_LEASE_SQL, (job["id"], job["worker_id"]), fetchone=True)
+        return bool(row)
+
+    #False when the lease was lost: the job's state belongs to whoever holds it now
+    @staticmethod
+    async def complete_async(job, result):
+        row = await run_query_async(COMPLETE_JOB_SQL, (json.dumps(result), job["id"], job["worker_id"]), fetchone=True)
+        return bool(row)
+
+    #"queued" (retried later) or "failed" (out of attempts), None when the lease was lost
+    @staticmethod
+    async def fail_async(job, error):
+        delay = min(RETRY_BASE_SEC * 2 ** (job["attempts"] - 1), RETRY_MAX_SEC)
+        row = await run_query_async(FAIL_JOB_SQL, (delay, str(error)[:1000], job["id"], job["worker_id"]), fetchone=True)
+        return row[0] if row else None
+
+    @staticmethod
+    async def requeue_stale_async():
+        rows = await run_query_async(REQUEUE_STALE_SQL, (LEASE_SEC,), fetchall=True)
+        return len(rows or [])
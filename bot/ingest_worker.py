@@ -0,0 +1,166 @@
+import os
+import time
+import socket
+import signal
+import asyncio
+import logging
+
+from bot.ingest_queue import IngestQueue, LEASE_SEC
+from bot.playlist_service import PlaylistService
+from bot.user_class import User
+from bot.extract_pool import shutdown_extraction_pool
+from bot.db_async import get_async_pool, close_async_pool
+from bot.logs import setup_logging, log_context
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", 1))
+STALE_CHECK_INTERVAL = float(os.getenv("INGEST_STALE_CHECK_INTERVAL", 60))
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", 3))
+
+
+#Sends one status message to the chat and keeps editing it while a playlist imports
+def import_progress(bot, chat_id):
+    state = {"msg": None, "last": 0.0}
+
+    async def report(imported, expected):
+        now = time.monotonic()
+        if state["msg"] and now - state["last"] < PROGRESS_EDIT_INTERVAL:
+            return
+        state["last"] = now
+        text = f"⏳ {imported}/{expected} imported" if expected else f"⏳ {imported} imported"
+        try:
+            if state["msg"] is None:
+                state["msg"] = await bot.send_message(chat_id, text)
+            else:
+                await state["msg"].edit_text(text)
+        except Exception:
+            logger.warning("Failed to update import progress", exc_info=True)
+
+    return report
+
+
+def outcome_text(result, playlist_id):
+    if result.kind == "playlist":
+        if not playlist_id:
+            return "Hi! This playlist already exists"
+        count = f" ({result.expected_count} videos)" if result.expected_count else ""
+        return f"Playlist saved{count}"
+    title = result.title or "video"
+    return f"Video: 🎥 {title}\nadded to your custom playlist"
+
+
+async def notify(bot, chat_id, text):
+    try:
+        await bot.send_message(chat_id, text)
+    except Exception:
+        logger.warning("Failed to notify chat %s", chat_id, exc_info=True)
+
+
+#renews the job's lease while a long import runs; stops on its own once the lease is lost
+async def heartbeat(job, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not await IngestQueue.renew_lease_async(job):
+                logger.warning("Ingest job %s lost its lease", job["id"])
+                return
+        except Exception:
+            logger.warning("Failed to renew lease of ingest job %s", job["id"], exc_info=True)
+
+
+async def process_job(bot, job):
+    user = User(None, None, user_id=job["user_id"])
+    lease = asyncio.create_task(heartbeat(job, LEASE_SEC / 3))
+    try:
+        result, playlist_id = await PlaylistService.ingest_async(
+            user, job["link"], progress=import_progress(bot, job["chat_id"]), import_job=job["id"])
+    except Exception as e:
+        status = await IngestQueue.fail_async(job, e)
+        if status is None:
+            logger.warning("Ingest job %s failed after losing its lease, left to its new owner: %s", job["id"], e)
+            return
+        logger.warning("Ingest job %s attempt %s/%s failed: %s",
+                       job["id"], job["attempts"], job["max_attempts"], e)
+        if status == "failed":
+            await notify(bot, job["chat_id"], "🔴 Couldn't import this link, please try again later:\n" + job["link"])
+        return
+    finally:
+        lease.cancel()
+
+    if result is None:
+        #not a video or playlist: retrying won't change that
+        if await IngestQueue.complete_async(job, {"kind": None}):
+            await notify(bot, job["chat_id"], "Type error: not a video / not a playlist")
+        return
+
+    if not await IngestQueue.complete_async(job, {"kind": result.kind, "playlist_id": playlist_id}):
+        #another worker holds the job now and reports the outcome itself
+        logger.warning("Ingest job %s finished after losing its lease", job["id"])
+        return
+    await notify(bot, job["chat_id"], outcome_text(result, playlist_id))
+
+
+async def run_worker(bot, worker_id, stop):
+    last_stale_check = 0.0
+    logger.info("Ingest worker %s started", worker_id)
+    while not stop.is_set():
+        job = None
+        try:
+            if time.monotonic() - last_stale_check > STALE_CHECK_INTERVAL:
+                last_stale_check = time.monotonic()
+                requeued = await IngestQueue.requeue_stale_async()
+                if requeued:
+                    logger.warning("Requeued %s stale ingest jobs", requeued)
+            job = await IngestQueue.claim_async(worker_id)
+        except Exception:
+            logger.exception("🔴 Failed to claim ingest job")
+
+        if job is None:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        try:
+            with log_context(request_id=f"ingest:{job['id']}", chat_id=job["chat_id"]):
+                await process_job(bot, job)
+        except Exception:
+            logger.exception("🔴 Ingest job %s crashed", job["id"])
+    logger.info("Ingest worker %s stopped", worker_id)
+
+
+def start_workers(bot, count, stop):
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    return [asyncio.create_task(run_worker(bot, f"{prefix}:{n}", stop)) for n in range(count)]
+
+
+#Standalone extraction workers: python -m bot.ingest_worker
+async def _main():
+    from telegram import Bot
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    setup_logging()
+    token = os.getenv("TELEGRAM_TOKEN")
+    if not token:
+        raise RuntimeError("TELEGRAM_TOKEN not found")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await get_async_pool()
+    try:
+        async with Bot(token) as bot:
+            tasks = start_workers(bot, int(os.getenv("INGEST_WORKERS", 4)), stop)
+            await asyncio.gather(*tasks)
+    finally:
+        shutdown_extraction_pool()
+        await close_async_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
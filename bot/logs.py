@@ -0,0 +1,192 @@
+import os
+import re
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from bot.metrics import get_metrics
+
+#Logging for every entry point (bot.main, bot.webhook, the standalone workers): setup_logging() once.
+#Records are queued by the caller and formatted / written by a listener thread, so the event loop
+#never waits on stderr; filters that need the caller's context (ids, sampling) run before the queue.
+#
+#LOG_LEVEL=INFO, LOG_FORMAT=text|json
+#LOG_SAMPLE="bot.playlist_class=0.01,bot.main=0.1": share of records below WARNING kept per logger
+#(and its children); warnings and errors are never sampled out
+#LOG_QUEUE_SIZE=10000: records beyond that are dropped (counted in log_records_dropped) instead of blocking
+#LOG_SQL_PARAMS=1 puts query parameters into the debug query log, otherwise only their shape
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+#bot tokens show up in Bot API URLs (httpx, telegram.ext), the rest in exception messages and DSNs
+_REDACT = (
+    (re.compile(r"bot\d+:[\w-]{20,}"), "bot<redacted>"),
+    (re.compile(r"(?i)\b(password|passwd|secret|secret_token|token|api_key)=[^\s&'\",]+"), r"\1=<redacted>"),
+    (re.compile(r"(?i)(['\"](?:password|secret|token)['\"]\s*:\s*)['\"][^'\"]*['\"]"), r"\1'<redacted>'"),
+)
+
+_context = ContextVar("log_context", default={})
+_listener = None
+_sql_params = False
+_setup_lock = threading.Lock()
+
+
+def redact(text):
+    for pattern, replacement in _REDACT:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+#what the debug query log shows instead of the values: they are user data
+def log_params(params):
+    if _sql_params or params is None:
+        return params
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: <{type(value).__name__}>" for key, value in params.items()) + "}"
+    return "(" + ", ".join(f"<{type(value).__name__}>" for value in params) + ")"
+
+
+#correlation ids (request_id, user_id, ...) carried by every record logged inside the block,
+#including from tasks started there
+@contextmanager
+def log_context(**ids):
+    token = _context.set({**_context.get(), **ids})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.context = _context.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._resolved = {}
+
+    @staticmethod
+    def parse(spec):
+        rates = {}
+        for part in spec.split(","):
+            name, _, rate = part.partition("=")
+            if name.strip() and rate.strip():
+                rates[name.strip()] = float(rate)
+        return rates
+
+    #the most specific configured logger wins, "bot" covers "bot.main"
+    def _rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate, probe = 1.0, name
+            while probe:
+                if probe in self.rates:
+                    rate = self.rates[probe]
+                    break
+                probe = probe.rpartition(".")[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        context = getattr(record, "context", None)
+        if context:
+            text += " [" + " ".join(f"{key}={value}" for key, value in context.items()) + "]"
+        return redact(text)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        entry.update(getattr(record, "context", None) or {})
+        if record.exc_info:
+            entry["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    #same process, nothing to pickle, but the args may be mutated by the caller before the listener thread
+    #gets to them: the message is rendered here, the rest of the formatting (and redaction) happens there
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            get_metrics().inc("log_records_dropped", record.name)
+
+
+#reads the LOG_* variables, so entry points call it after load_dotenv()
+def setup_logging(level=None, fmt=None, stream=None):
+    global _listener, _sql_params
+    with _setup_lock:
+        if _listener is not None:
+            return _listener
+
+        _sql_params = os.getenv("LOG_SQL_PARAMS", "0") == "1"
+        handler = logging.StreamHandler(stream)
+        fmt = fmt or os.getenv("LOG_FORMAT", "text")
+        handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(TEXT_FORMAT))
+
+        queue_handler = NonBlockingQueueHandler(queue.Queue(int(os.getenv("LOG_QUEUE_SIZE", 10000))))
+        rates = SamplingFilter.parse(os.getenv("LOG_SAMPLE", ""))
+        if rates:
+            queue_handler.addFilter(SamplingFilter(rates))
+        queue_handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        for old in list(root.handlers):
+            root.removeHandler(old)
+        root.addHandler(queue_handler)
+        root.setLevel(level or os.getenv("LOG_LEVEL", "INFO").upper())
+        #one INFO line per Bot API request otherwise
+        if root.getEffectiveLevel() > logging.DEBUG:
+            logging.getLogger("httpx").setLevel(logging.WARNING)
+
+        _listener = QueueListener(queue_handler.queue, handler)
+        _listener.start()
+        atexit.register(stop_logging)
+    return _listener
+
+
+#drains what is queued; called at exit, or earlier by whoever wants the log flushed
+def stop_logging():
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
@@ -1,36 +1,50 @@
-from telegram import BotCommand
+from telegram import BotCommand, Update
 from telegram.constants import ParseMode
-from telegram.ext import ApplicationBuilder,  ApplicationHandlerStop, CommandHandler, MessageHandler, filters
-from bot.db_connection import mark_video_done, resolve_playlist_arg
+from telegram.ext import ApplicationBuilder,  ApplicationHandlerStop, CommandHandler, MessageHandler, TypeHandler, filters
+from bot.db_async import resolve_playlist_arg_async, get_async_pool, close_async_pool
 from bot.utility import is_youtube_link, YOUTUBE_URL_RE
-from bot.playlist_service import PlaylistService
 from bot.user_class import User
 from bot.playlist_class import Playlist
-from bot.yt_parse import detect_youtube_type
+from bot.extract_pool import shutdown_extraction_pool
+from bot.ingest_queue import IngestQueue
+from bot.ingest_worker import start_workers
+from bot.playlist_sync import start_sync_workers
+from bot.delivery import DeliverySchedule, UnknownTimezone, start_scheduler
+from bot.session_cache import get_session_cache
+from bot.session_store import make_session_persistence
+from bot.update_processor import PerUserUpdateProcessor
+from bot.metrics import get_metrics, run_dump, log_summary
+from bot.logs import setup_logging
 import html
 import os
+import asyncio
 import logging
 from dotenv import load_dotenv
-from functools import wraps
+from functools import partial, wraps
+from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 if not TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN not found")
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 
+#Runs before every other handler group: pulls the user's saved user_data (User, open dialogs) in on first contact
+async def attach_session(update, context):
+    sessions = context.bot_data.get("sessions")
+    if sessions and update.effective_user:
+        await sessions.attach(update.effective_user.id, context.user_data)
+
+
 #Decorator to check User before running handler
 def require_user(func):
     @wraps(func)
     async def wrapper(update, context, *args, **kwargs):
         try:
-            Cur_user = User.validate_or_reload(context, update, ensure_default=False)
+            Cur_user = await User.validate_or_reload_async(context, update, ensure_default=False)
             context.user_data["user"] = Cur_user 
         except Exception:
             logger.exception("🔴 Failed to restore/init user")
@@ -39,6 +53,18 @@ def require_user(func):
         return await func(update, context, *args, **kwargs)
     return wrapper
 
+
+#Decorator for the answer of an open dialog: other text is ignored before the user is loaded
+def awaiting(key):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(update, context, *args, **kwargs):
+            if not context.user_data.get(key):
+                return
+            return await func(update, context, *args, **kwargs)
+        return wrapper
+    return decorator
+
 async def start(update, context):
     #get user info
     tg_id = update.message.from_user.id
@@ -47,8 +73,8 @@ async def start(update, context):
     Cur_user = User(tg_id, username)
 
     try:
-        Cur_user.save_to_db()
-        Cur_user.get_or_create_default_playlist()
+        await Cur_user.save_to_db_async()
+        await Cur_user.get_or_create_default_playlist_async()
     except Exception as e:
         logger.exception("🔴 Failed to init user")
         await update.message.reply_text("🔴 Internal error. Failed to init user")
@@ -73,36 +99,23 @@ async def ingest_link(update, context):
         await update.message.reply_text("Error: Not YouTube link")
         return
     
-    obj_type = detect_youtube_type(text)
+    #extraction runs in ingest workers; they report back to this chat when done
     try:
-        if obj_type == "playlist":
-            playlist_id = PlaylistService.add_playlist(Cur_user.user_id, text)
-            if playlist_id:
-                await update.message.reply_text("Playlist saved")
-            else:
-                await update.message.reply_text("Hi! This playlist already exists")
-
-        elif obj_type == "video":
-            if not Cur_user.default_playlist_id:
-                Cur_user.get_or_create_default_playlist()
-            title = PlaylistService.add_video(Cur_user.default_playlist_id, text)
-            PlaylistService.set_playlist_await(Cur_user.default_playlist_id, Cur_user.user_id)
-            if not title:
-                title = "video"
-            await update.message.reply_text(f"Video: 🎥 {title}\nadded to your custom playlist")
-        else:
-            logger.error("🔴 Type error: not a video / not a playlist")
-            await update.message.reply_text("Type error: not a video / not a playlist")
+        job_id = await IngestQueue.enqueue_async(Cur_user.user_id, update.effective_chat.id, text)
     except Exception:
-        logger.exception("🔴 Failed to ingest link")
+        logger.exception("🔴 Failed to enqueue link")
         await update.message.reply_text("Internal error while saving link.")
+        return
+
+    logger.debug("Ingest job %s queued", job_id)
+    await update.message.reply_text("⏳ Got it! Importing, I'll message you when it's ready.")
             
 
 @require_user
 async def send_videos(update, context):
     Cur_user = context.user_data["user"]
 
-    playlist_id = None
+    pos = None
 
     if context.args:
         try:
@@ -110,39 +123,32 @@ async def send_videos(update, context):
         except ValueError:
             await update.message.reply_text("Playlist number must be an integer")
             return
-        playlist_id = resolve_playlist_arg(Cur_user.user_id, pos)
 
-    if not playlist_id:
-        playlist_id = Cur_user.get_random_playlist()
+    #one statement resolves the playlist, takes the next video and closes the playlist if it was the last one
+    step = await Playlist.advance_for_user_async(Cur_user.user_id, pos)
 
-    if not playlist_id:
+    if not step:
         await update.message.reply_text("No playlists with -- await -- status")
         return
-    
-    Pl = Playlist(playlist_id, Cur_user.user_id)
 
-    video = Pl.find_next_video()    #{"id": vid_id, "link": link}
+    video = step["video"]
     if not video:
         await update.message.reply_text("Try again. No videos with -- await -- status in current playlist")
         return
-    
+
+    logger.debug("Video %s has been marked as done", video["link"])
     await update.message.reply_text(video["link"])
-    
-    if mark_video_done(video['id'], playlist_id, Cur_user.user_id):
-        logger.info(f"Video {video['link']} has been marked as done")
-    if Pl.set_last_sent():
-        logger.info('Playlist info -- last sent -- changed to NOW')
 
-    if Pl.set_playlist_done():
+    if step["playlist_done"]:
         await update.message.reply_text("Playlist has been marked as done!")
-        logger.info(f"Playlist has been marked as done")
+        logger.debug("Playlist %s has been marked as done", step["playlist_id"])
 
 
 @require_user
 async def show_playlists(update, context):
     Cur_user = context.user_data["user"]
     try:
-        text = Cur_user.render_playlists()
+        text = await Cur_user.render_playlists_async()
     except Exception:
         logger.exception("🔴 DB error in render_playlists")
         await update.message.reply_text("🔴 Failed to fetch playlists.")
@@ -168,7 +174,7 @@ async def starting_deletion(update, context):
     Cur_user = context.user_data["user"]
 
     try:
-        text = Cur_user.render_playlists()
+        text = await Cur_user.render_playlists_async()
     except Exception:
         logger.exception("🔴 DB error in render_playlists")
         await update.message.reply_text("🔴 Failed to fetch playlists.")
@@ -180,12 +186,9 @@ async def starting_deletion(update, context):
     await update.message.reply_text(intruction_msg + text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 
 
+@awaiting(AWAITING_DELETE_KEY)
 @require_user
 async def get_deletion_info(update, context):
-
-    if not context.user_data.get(AWAITING_DELETE_KEY):
-        return
-
     Cur_user = context.user_data["user"]
     user_answer = (update.message.text or "").strip()
 
@@ -210,7 +213,7 @@ async def delete_playlist_cmd(update, context, playlist_position = None):
     Cur_user = context.user_data["user"]
     
     try:
-        playlist_id = resolve_playlist_arg(Cur_user.user_id, playlist_position)
+        playlist_id = await resolve_playlist_arg_async(Cur_user.user_id, playlist_position)
     except Exception:
         logger.exception("🔴 resolve_playlist_arg failed")
         await update.message.reply_text("🔴 Internal error. Try again later.")
@@ -222,14 +225,14 @@ async def delete_playlist_cmd(update, context, playlist_position = None):
 
     try:
         Pl = Playlist(playlist_id, Cur_user.user_id)
-        deleted = Pl.delete_playlist()
+        deleted = await Pl.delete_playlist_async()
     except Exception:
         logger.exception("🔴 Failed to delete playlist")
         await update.message.reply_text("🔴 Failed to delete the playlist.")
         return
 
     if deleted:
-        logger.info(f"Playlist {deleted['id']} '{deleted['title']}' deleted")
+        logger.info("Playlist %s '%s' deleted", deleted["id"], deleted["title"])
         await update.message.reply_text(
             f'Deleted:\n{deleted["id"]} {html.escape(deleted["title"])}\n'
             f'🔗 <a href="{html.escape(deleted["youtube_link"], quote=True)}">link</a>',
@@ -250,7 +253,7 @@ async def starting_restart(update, context):
     context.user_data[AWAITING_RESTART_KEY] = True
 
     try:
-        text = Cur_user.render_playlists()
+        text = await Cur_user.render_playlists_async()
     except Exception:
         logger.exception("🔴 DB error in render_playlists")
         await update.message.reply_text("🔴 Failed to fetch playlists.")
@@ -260,15 +263,12 @@ async def starting_restart(update, context):
     await update.message.reply_text(intruction_msg + text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 
 
+@awaiting(AWAITING_RESTART_KEY)
 @require_user
 async def get_restarting_info(update, context):
-
-    if not context.user_data.get(AWAITING_RESTART_KEY):
-        return
-
     Cur_user = context.user_data["user"]
     user_answer = (update.message.text or "").strip()
-    logger.info("restart_flow answer: %r", user_answer)
+    logger.debug("restart_flow answer: %r", user_answer)
 
     if user_answer.lower() == "/cancel":
         context.user_data.pop(AWAITING_RESTART_KEY, None)
@@ -289,11 +289,11 @@ async def get_restarting_info(update, context):
 @require_user
 async def restart_playlist(update, context, playlist_position = None):
     Cur_user = context.user_data["user"]
-    logger.info("restart_playlist CALLED, pos=%r", playlist_position)
+    logger.debug("restart_playlist CALLED, pos=%r", playlist_position)
 
     try:
-        playlist_id = resolve_playlist_arg(Cur_user.user_id, playlist_position)
-        logger.info("resolved position %s -> playlist_id %r", playlist_position, playlist_id)
+        playlist_id = await resolve_playlist_arg_async(Cur_user.user_id, playlist_position)
+        logger.debug("resolved position %s -> playlist_id %r", playlist_position, playlist_id)
     except Exception:
         logger.exception("🔴 resolve_playlist_arg failed")
         await update.message.reply_text("🔴 Internal error. Try again later.")
@@ -305,7 +305,7 @@ async def restart_playlist(update, context, playlist_position = None):
     
     try:
         Pl = Playlist(playlist_id, Cur_user.user_id)
-        restarted = Pl.restart()
+        restarted = await Pl.restart_async()
     except Exception:
         logger.exception("🔴 DB error in restart_playlist")
         await update.message.reply_text("🔴 Internal error while restarting playlist.")
@@ -317,13 +317,77 @@ async def restart_playlist(update, context, playlist_position = None):
         await update.message.reply_text("🔴 Unexpected error. Please try again.")
 
 
+@require_user
+async def schedule_cmd(update, context):
+    Cur_user = context.user_data["user"]
+    usage = ("Usage: /schedule HH:MM [timezone] [playlist_number]\n"
+             "e.g. /schedule 08:30 Europe/Berlin 2 (UTC and a random playlist by default)")
+    if not context.args:
+        await update.message.reply_text(usage)
+        return
+
+    try:
+        send_time = datetime.strptime(context.args[0], "%H:%M").time()
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+
+    tz_name = "UTC"
+    playlist_position = None
+    for arg in context.args[1:3]:
+        if arg.isdigit():
+            playlist_position = arg
+        else:
+            tz_name = arg
+
+    unknown_tz = f"Unknown timezone: {tz_name}\nUse a name like Europe/Berlin or UTC"
+    try:
+        tz = ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        await update.message.reply_text(unknown_tz)
+        return
+
+    playlist_id = None
+    if playlist_position:
+        playlist_id = await resolve_playlist_arg_async(Cur_user.user_id, playlist_position)
+        if not playlist_id:
+            await update.message.reply_text("No playlist found by that number.")
+            return
+
+    try:
+        next_run_at = await DeliverySchedule.schedule_async(
+            Cur_user.user_id, update.effective_chat.id, send_time, tz_name, playlist_id)
+    except UnknownTimezone:
+        #known to Python, not to the database that computes the delivery times
+        await update.message.reply_text(unknown_tz)
+        return
+    except Exception:
+        logger.exception("🔴 Failed to save schedule")
+        await update.message.reply_text("🔴 Internal error. Try again later.")
+        return
+
+    source = f"playlist {playlist_position}" if playlist_id else "a random playlist"
+    await update.message.reply_text(
+        f"📅 Every day at {send_time:%H:%M} ({tz_name}) you'll get the next video from {source}.\n"
+        f"Next one: {next_run_at.astimezone(tz):%Y-%m-%d %H:%M}. /unschedule to stop.")
+
+
+@require_user
+async def unschedule_cmd(update, context):
+    Cur_user = context.user_data["user"]
+    if await DeliverySchedule.unschedule_async(Cur_user.user_id):
+        await update.message.reply_text("Daily videos stopped.")
+    else:
+        await update.message.reply_text("You have no daily videos scheduled.")
+
+
 @require_user
 async def statistic(update, context):
     Cur_user = context.user_data["user"]
     
-    user_stat = Cur_user.get_user_stat()
+    user_stat = await Cur_user.get_user_stat_async()
     await update.message.reply_text(user_stat)
-    logger.info("User stat delivered")
+    logger.debug("User stat delivered")
 
 
 async def help_cmd(update, context):
@@ -334,6 +398,8 @@ async def help_cmd(update, context):
         "/next [playlist position] - Get the next video (random if no number)\n"
         "/delete_playlist <playlist_number> - Delete a playlist by number\n"
         "/restart <playlist_number> - Restart a playlist by its position\n"
+        "/schedule HH:MM [timezone] [playlist_number] - Get the next video every day\n"
+        "/unschedule - Stop daily videos\n"
         "/stat - Show your statistics\n"
     )
     await update.message.reply_text(help_text)
@@ -345,41 +411,119 @@ COMMANDS = [
     BotCommand("next", "Get the next video (random or by position in /show_playlists)"),
     BotCommand("delete_playlist", "Delete a playlist by its position"),
     BotCommand("restart", "Restart a playlist by its position"),
+    BotCommand("schedule", "Get the next video every day at a set time"),
+    BotCommand("unschedule", "Stop daily videos"),
     BotCommand("stat", "Show your statistics"),
     BotCommand("help", "Show available commands"),
 ]
 
+#INGEST_WORKERS=0 leaves ingestion to separate `python -m bot.ingest_worker` processes,
+#PLAYLIST_SYNC_WORKERS=0 the catalog resync to `python -m bot.playlist_sync`.
+#DELIVERY_SCHEDULER=0 turns daily delivery off on this replica (schedules are claimed with SKIP LOCKED either way).
+#METRICS_DUMP_INTERVAL=0 stops the periodic metrics summary in the log (webhook replicas serve /metrics)
 async def _post_init(app):
+    await get_async_pool()
     await app.bot.set_my_commands(COMMANDS)
+    stop = asyncio.Event()
+    app.bot_data["ingest_stop"] = stop
+    app.bot_data["ingest_workers"] = start_workers(app.bot, int(os.getenv("INGEST_WORKERS", 2)), stop)
+    app.bot_data["sync_workers"] = start_sync_workers(int(os.getenv("PLAYLIST_SYNC_WORKERS", 1)), stop)
+    app.bot_data["delivery"] = [start_scheduler(app.bot, stop)] if os.getenv("DELIVERY_SCHEDULER", "1") == "1" else []
+    dump_interval = float(os.getenv("METRICS_DUMP_INTERVAL", 300))
+    app.bot_data["metrics_dump"] = [asyncio.create_task(run_dump(stop, dump_interval))] if dump_interval > 0 else []
+
+    sessions = make_session_persistence(shared=app.bot_data.get("shared_sessions", False))
+    app.bot_data["sessions"] = sessions
+    if sessions:
+        app.bot_data["sessions_flush"] = asyncio.create_task(sessions.run(stop))
+
+
+#after Application.stop(), while app.bot can still send: the scheduler delivers what it has already claimed
+#(and marked done) and in-flight ingest jobs report their outcome before they return.
+#post_shutdown runs only after the bot's HTTP client is closed
+async def _post_stop(app):
+    app.bot_data["ingest_stop"].set()
+    await asyncio.gather(*app.bot_data["ingest_workers"], *app.bot_data["sync_workers"],
+                         *app.bot_data["delivery"], *app.bot_data["metrics_dump"], return_exceptions=True)
+
+
+async def _post_shutdown(app):
+    sessions = app.bot_data.get("sessions")
+    if sessions:
+        await asyncio.gather(app.bot_data["sessions_flush"], return_exceptions=True)
+        await sessions.close()
+    shutdown_extraction_pool()
+    await close_async_pool()
+    logger.info("Session cache: %s", get_session_cache().stats())
+    logger.info("Updates turned away by the per-user mailbox: %s", app.update_processor.overflowed)
+    log_summary()
+
+
+#filters only see the update, not user_data: the dialog handlers check their key themselves (see awaiting)
+dialog_answer_filter = filters.TEXT & ~filters.COMMAND
+
+#with replicas a user's next update may land on another process: their session is written back right away
+async def _after_update(app, update):
+    sessions = app.bot_data.get("sessions")
+    user = getattr(update, "effective_user", None)
+    if sessions and sessions.shared and user:
+        await sessions.flush_user(user.id)
+
+
+#handler_seconds per callback; ApplicationHandlerStop ends a dialog, it isn't an error
+def timed(callback):
+    return get_metrics().wrap("handler_seconds", callback, expected=(ApplicationHandlerStop,))
+
+
+#webhook=True: no Updater, updates are pushed into app.update_queue by bot/webhook.py.
+#request: a telegram.request.BaseRequest for the Bot API calls, e.g. the in-memory one of benchmarks/load_driver.py
+def build_application(webhook=False, request=None):
+    processor = PerUserUpdateProcessor(
+        int(os.getenv("CONCURRENT_UPDATES", 64)),
+        max_pending_per_user=int(os.getenv("USER_MAILBOX_DEPTH", 5)),
+    )
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(processor)
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+        .post_shutdown(_post_shutdown)
+    )
+    #e.g. http://127.0.0.1:8081/bot for devtools/fake_telegram.py
+    if os.getenv("TELEGRAM_API_URL"):
+        builder = builder.base_url(os.getenv("TELEGRAM_API_URL"))
+    if request is not None:
+        builder = builder.request(request)
+    if webhook:
+        builder = builder.updater(None)
+    app = builder.build()
+    app.bot_data["shared_sessions"] = webhook
+    processor.after_update = partial(_after_update, app)
+    get_metrics().register_gauge("updates", processor.stats)
+    get_metrics().register_gauge("session_cache", lambda: {
+        f"{kind}_{key}": value for kind, stats in get_session_cache().stats().items() for key, value in stats.items()})
+
+    app.add_handler(TypeHandler(Update, timed(attach_session)), group=-1)
+    app.add_handler(MessageHandler(filters.Regex(YOUTUBE_URL_RE), timed(ingest_link)), group=0)
+
+    app.add_handler(CommandHandler("start", timed(start)))
+    app.add_handler(CommandHandler("next", timed(send_videos)))
+    app.add_handler(CommandHandler("show_playlists", timed(show_playlists)))
+    app.add_handler(CommandHandler("cancel", timed(cancel_any)))
+    app.add_handler(CommandHandler("delete_playlist", timed(starting_deletion)))
+    app.add_handler(CommandHandler("restart", timed(starting_restart)))
+    app.add_handler(CommandHandler("schedule", timed(schedule_cmd)))
+    app.add_handler(CommandHandler("unschedule", timed(unschedule_cmd)))
+    app.add_handler(CommandHandler("stat", timed(statistic)))
+    app.add_handler(CommandHandler("help", timed(help_cmd)))
+
+    #one handler per group: a group runs only its first matching handler, and both match any plain text
+    app.add_handler(MessageHandler(dialog_answer_filter, timed(get_restarting_info)), group=1)
+    app.add_handler(MessageHandler(dialog_answer_filter, timed(get_deletion_info)),   group=2)
+    return app
 
 
-awaiting_restart_filter = (
-    filters.TEXT
-    & ~filters.COMMAND
-    & filters.Create(lambda update, context: bool(context.user_data.get(AWAITING_RESTART_KEY)))
-)
-
-awaiting_delete_filter = (
-    filters.TEXT
-    & ~filters.COMMAND
-    & filters.Create(lambda update, context: bool(context.user_data.get(AWAITING_DELETE_KEY)))
-)
-
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(TOKEN).post_init(_post_init).build()
-
-    app.add_handler(MessageHandler(filters.Regex(YOUTUBE_URL_RE), ingest_link), group=0)
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("next", send_videos))
-    app.add_handler(CommandHandler("show_playlists", show_playlists))
-    app.add_handler(CommandHandler("cancel", cancel_any))
-    app.add_handler(CommandHandler("delete_playlist", starting_deletion))
-    app.add_handler(CommandHandler("restart", starting_restart))
-    app.add_handler(CommandHandler("stat", statistic))
-    app.add_handler(CommandHandler("help", help_cmd))
-
-    app.add_handler(MessageHandler(awaiting_restart_filter, get_restarting_info), group=1)
-    app.add_handler(MessageHandler(awaiting_delete_filter,  get_deletion_info),   group=1)
-    
-    app.run_polling()
\ No newline at end of file
+    setup_logging()
+    build_application().run_polling()
@@ -0,0 +1,204 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "playlist_bot_"
+#seconds; yt-dlp calls need the long tail
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", 300))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    #linear interpolation inside the bucket, the way Prometheus' histogram_quantile() does it
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.max
+
+
+#label values are quoted strings in the exposition format
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    #histograms and counters keyed by (metric, name), gauges read from callbacks when rendered.
+    #observe() takes one lock and touches two lists, cheap enough for every query
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, metric, name, seconds):
+        with self._lock:
+            hist = self._histograms.get((metric, name))
+            if hist is None:
+                hist = self._histograms[(metric, name)] = Histogram()
+            hist.observe(seconds)
+
+    def inc(self, metric, name, value=1):
+        with self._lock:
+            self._counters[(metric, name)] = self._counters.get((metric, name), 0) + value
+
+    #callback() returns {name: value}; registering the same metric again replaces it
+    def register_gauge(self, metric, callback):
+        with self._lock:
+            self._gauges[metric] = callback
+
+    @contextmanager
+    def timer(self, metric, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, name, time.perf_counter() - started)
+
+    #times a coroutine function, exceptions other than `expected` are counted under <metric>_errors
+    def wrap(self, metric, func, name=None, expected=()):
+        name = name or func.__name__
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if not isinstance(e, expected):
+                    self.inc(f"{metric}_errors", name)
+                raise
+            finally:
+                self.observe(metric, name, time.perf_counter() - started)
+        return wrapper
+
+    def _gauge_values(self):
+        with self._lock:
+            gauges = list(self._gauges.items())
+        values = {}
+        for metric, callback in gauges:
+            try:
+                values[metric] = callback() or {}
+            except Exception:
+                logger.warning("Gauge %s failed", metric, exc_info=True)
+        return values
+
+    #Prometheus text exposition format
+    def render(self):
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        typed = set()
+        for (metric, name), (counts, total, count) in sorted(histograms.items()):
+            full = PREFIX + metric
+            if full not in typed:
+                typed.add(full)
+                lines.append(f"# TYPE {full} histogram")
+            cumulative = 0
+            for le, n in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += n
+                lines.append(f'{full}_bucket{{name="{_label(name)}",le="{le}"}} {cumulative}')
+            lines.append(f'{full}_sum{{name="{_label(name)}"}} {total}')
+            lines.append(f'{full}_count{{name="{_label(name)}"}} {count}')
+
+        for (metric, name), value in sorted(counters.items()):
+            full = PREFIX + metric + "_total"
+            if full not in typed:
+                typed.add(full)
+                lines.append(f"# TYPE {full} counter")
+            lines.append(f'{full}{{name="{_label(name)}"}} {value}')
+
+        for metric, values in sorted(self._gauge_values().items()):
+            full = PREFIX + metric
+            lines.append(f"# TYPE {full} gauge")
+            for name, value in sorted(values.items()):
+                lines.append(f'{full}{{name="{_label(name)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    #the slowest series first: [(metric, name, count, p50, p95, p99, max)]
+    def summary(self, top=15):
+        with self._lock:
+            rows = [
+                (metric, name, h.count, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99), h.max)
+                for (metric, name), h in self._histograms.items()
+            ]
+        rows.sort(key=lambda r: r[5], reverse=True)
+        return rows[:top]
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+#every statement outside the registry shares one series: raw SQL as a label would grow without bound
+UNREGISTERED = "unregistered"
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = Metrics()
+    return _metrics
+
+
+#run_query() labels a statement with its registry name (bot/queries.py)
+def query_name(query):
+    return getattr(query, "name", None) or UNREGISTERED
+
+
+def log_summary(top=15):
+    metrics = get_metrics()
+    rows = metrics.summary(top)
+    if not rows:
+        return
+    lines = [f"{'metric':<22} {'name':<36} {'count':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+    for metric, name, count, p50, p95, p99, max_ in rows:
+        lines.append(f"{metric:<22} {name[:36]:<36} {count:>8} "
+                     f"{p50 * 1000:>9.1f} {p95 * 1000:>9.1f} {p99 * 1000:>9.1f} {max_ * 1000:>9.1f}")
+    lines.extend(f"{metric} {values}" for metric, values in sorted(metrics._gauge_values().items()))
+    logger.info("Metrics, slowest p99 first:\n%s", "\n".join(lines))
+
+
+#polling deployments have no /metrics endpoint: the summary goes to the log instead
+async def run_dump(stop, interval=DUMP_INTERVAL):
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        log_summary()
@@ -1,38 +1,25 @@
-from bot.db_connection import run_query
+from bot.db_connection import run_query, transaction
+from bot.db_async import run_query_async, async_transaction
+from bot.queries import register
+import os
 import logging
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
-class Playlist:
-    def __init__(self, playlist_id, user_id):
-        self.playlist_id = playlist_id
-        self.user_id = user_id
-        logger.info("Playlist.__init__: playlist_id=%s user_id=%s", self.playlist_id, self.user_id)
 
-    def find_next_video(self):
-        info = run_query("""
-            SELECT pit.id, pit.link
+FIND_NEXT_VIDEO_SQL = register("find_next_video", """
+            SELECT pit.id, v.link
                 FROM playlist_items pit
                 JOIN playlists p ON p.id = pit.playlist_id
+                JOIN videos v ON v.id = pit.video_id
                     WHERE pit.playlist_id = %s
                     AND p.user_id       = %s
-                    AND COALESCE(TRIM(LOWER(pit.status)), 'await') = 'await'
+                    AND pit.status = 'await'
                 ORDER BY pit.position_num NULLS FIRST, pit.id
                 LIMIT 1;
-        """, (self.playlist_id, self.user_id), fetchone = True)
-        if not info:
-            logger.info("No next video for playlist_id=%s (user_id=%s)", self.playlist_id, self.user_id)
-            return None
-        
-        vid_id, link = info[0], info[1]
-        return {"id": vid_id, "link": link}
+        """)
 
-    def set_playlist_done(self):
-        res = run_query("""
+SET_PLAYLIST_DONE_SQL = register("set_playlist_done", """
             UPDATE playlists p
             SET status = 'done',
                 completed_at = NOW()
@@ -45,45 +32,151 @@ class Playlist:
                     AND pit.status = 'await'
                     )
             RETURNING p.id;
-            """, (self.playlist_id, self.user_id), fetchone=True)
-        return 1 if res else 0
-    
-    
-    def set_last_sent(self):
-        res = run_query("""
+            """)
+
+SET_LAST_SENT_SQL = register("set_last_sent", """
             UPDATE playlists p
                     SET last_sent = NOW()
                     WHERE p.id = %s AND p.user_id = %s
                     RETURNING p.id;
-        """, (self.playlist_id, self.user_id), fetchone=True)
-        return bool(res)
+        """)
 
-    def delete_playlist(self):
-        row = run_query("""
+DELETE_PLAYLIST_SQL = register("delete_playlist", """
             DELETE FROM playlists p
             WHERE p.id = %s
                 AND p.user_id = %s
                 AND p.youtube_link <> 'default_playlist'
             RETURNING p.id, p.title, p.youtube_link;
-        """, (self.playlist_id, self.user_id), fetchone=True)
+        """)
+
+RESTART_ITEMS_SQL = register("restart_items", """
+            UPDATE playlist_items pit
+            SET status = 'await', completed_at = NULL
+            FROM playlists p
+            WHERE p.id = %s
+              AND p.user_id = %s
+              AND pit.playlist_id = p.id
+              AND pit.status = 'done'
+            RETURNING pit.id;
+        """)
+
+RESTART_PLAYLIST_SQL = register("restart_playlist", """
+            UPDATE playlists p
+            SET status = 'await', completed_at = NULL, last_sent = NULL
+            WHERE p.id = %s
+              AND p.user_id = %s
+              AND p.status <> 'await'
+            RETURNING p.id;
+        """)
+
+#advance_playlist() lives in db/create_tables.sql: it locks the playlist row, marks the next item done,
+#bumps last_sent and closes the playlist in one round trip, so two /next taps never get the same video
+ADVANCE_SQL = register("advance", "SELECT playlist_id, item_id, link, playlist_done FROM advance_playlist(%s, %s, %s, %s);")
+
+#how /next without a number chooses a playlist: random / stale (round robin by last_sent) / weighted
+PICK_MODE = os.getenv("NEXT_PICK_MODE", "random")
+
+
+class Playlist:
+    def __init__(self, playlist_id, user_id):
+        self.playlist_id = playlist_id
+        self.user_id = user_id
+        logger.debug("Playlist.__init__: playlist_id=%s user_id=%s", self.playlist_id, self.user_id)
+
+    @property
+    def _key(self):
+        return (self.playlist_id, self.user_id)
+
+    def find_next_video(self):
+        info = run_query(FIND_NEXT_VIDEO_SQL, self._key, fetchone = True)
+        return self._next_video(info)
+
+    async def find_next_video_async(self):
+        info = await run_query_async(FIND_NEXT_VIDEO_SQL, self._key, fetchone = True)
+        return self._next_video(info)
+
+    def _next_video(self, info):
+        if not info:
+            logger.debug("No next video for playlist_id=%s (user_id=%s)", self.playlist_id, self.user_id)
+            return None
+
+        vid_id, link = info[0], info[1]
+        return {"id": vid_id, "link": link}
+
+    def advance(self):
+        row = run_query(ADVANCE_SQL, (self.user_id, self.playlist_id, None, PICK_MODE), fetchone=True)
+        return self._advanced(row)
+
+    async def advance_async(self):
+        row = await run_query_async(ADVANCE_SQL, (self.user_id, self.playlist_id, None, PICK_MODE), fetchone=True)
+        return self._advanced(row)
+
+    #number is the one shown in /playlists; without it (or when it matches nothing) a random playlist is picked
+    @classmethod
+    def advance_for_user(cls, user_id, number=None):
+        row = run_query(ADVANCE_SQL, (user_id, None, number, PICK_MODE), fetchone=True)
+        return cls._advanced(row)
+
+    @classmethod
+    async def advance_for_user_async(cls, user_id, number=None):
+        row = await run_query_async(ADVANCE_SQL, (user_id, None, number, PICK_MODE), fetchone=True)
+        return cls._advanced(row)
+
+    @staticmethod
+    def _advanced(row):
+        if not row:
+            return None
+
+        playlist_id, item_id, link, playlist_done = row
+        video = {"id": item_id, "link": link} if item_id else None
+        return {"playlist_id": playlist_id, "video": video, "playlist_done": bool(playlist_done)}
+
+    def set_playlist_done(self):
+        res = run_query(SET_PLAYLIST_DONE_SQL, self._key, fetchone=True)
+        return 1 if res else 0
+
+    async def set_playlist_done_async(self):
+        res = await run_query_async(SET_PLAYLIST_DONE_SQL, self._key, fetchone=True)
+        return 1 if res else 0
+
+
+    def set_last_sent(self):
+        res = run_query(SET_LAST_SENT_SQL, self._key, fetchone=True)
+        return bool(res)
+
+    async def set_last_sent_async(self):
+        res = await run_query_async(SET_LAST_SENT_SQL, self._key, fetchone=True)
+        return bool(res)
+
+    def delete_playlist(self):
+        row = run_query(DELETE_PLAYLIST_SQL, self._key, fetchone=True)
+        return self._deleted(row)
+
+    async def delete_playlist_async(self):
+        row = await run_query_async(DELETE_PLAYLIST_SQL, self._key, fetchone=True)
+        return self._deleted(row)
+
+    def _deleted(self, row):
         if row:
             deleted = {"id": row[0], "title": row[1], "youtube_link": row[2]}
-        
+
             return deleted
         return None
 
 
     def restart(self):
-        rows = run_query("""
-        UPDATE playlist_items pit
-        SET status = 'await', completed_at = NULL
-        FROM playlists p
-        WHERE p.id = %s
-          AND p.user_id = %s
-          AND pit.playlist_id = p.id
-          AND pit.status <> 'await'
-        RETURNING pit.id;
-    """, (self.playlist_id, self.user_id), fetchall=True)
+        with transaction():
+            rows = run_query(RESTART_ITEMS_SQL, self._key, fetchall=True)
+            restarted = run_query(RESTART_PLAYLIST_SQL, self._key, fetchone = True)
+        return self._restarted(rows, restarted)
+
+    async def restart_async(self):
+        async with async_transaction():
+            rows = await run_query_async(RESTART_ITEMS_SQL, self._key, fetchall=True)
+            restarted = await run_query_async(RESTART_PLAYLIST_SQL, self._key, fetchone = True)
+        return self._restarted(rows, restarted)
+
+    def _restarted(self, rows, restarted):
         items_reset = len(rows or [])
 
         if items_reset:
@@ -91,15 +184,6 @@ class Playlist:
         else:
             logger.info("No items in playlist %s needed reset", self.playlist_id)
 
-        restarted = run_query("""
-        UPDATE playlists p
-        SET status = 'await', completed_at = NULL, last_sent = NULL
-        WHERE p.id = %s
-          AND p.user_id = %s
-          AND p.status <> 'await'
-        RETURNING p.id;
-    """, (self.playlist_id, self.user_id), fetchone = True)
-
         if restarted:
             restarted_id = restarted[0]
             logger.info("Playlist %s restarted", restarted_id)
@@ -111,4 +195,4 @@ class Playlist:
                 msg = f"Items reset: {items_reset}.\nPlaylist status was already 'await'."
             else:
                 msg = "Playlist not found or doesn't belong to you."
-            return {"playlist_id": None, "items_reset": items_reset, "msg": msg}
\ No newline at end of file
+            return {"playlist_id": None, "items_reset": items_reset, "msg": msg}
@@ -1,60 +1,225 @@
-from bot.yt_parse import detect_youtube_type, parse_playlist, parse_single_video
-from bot.db_connection import run_query,simple_insert
+import os
+import asyncio
+from contextlib import aclosing
 
+from bot.yt_parse import (
+    extract, extract_playlist, extract_video, iter_playlist, cached_playlist, classify_link,
+    PlaylistResult, VideoResult, ExtractionError
+)
+from bot.db_connection import run_query, transaction
+from bot.db_async import run_query_async, async_transaction
+from bot.queries import register
+from bot.extract_pool import run_extraction, stream_extraction
 
-class PlaylistService:
-    @staticmethod
-    def add_playlist(user_id, link):
-        playlist_info, items = parse_playlist(link)
+STREAM_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", 200))
 
-        columns = ['user_id', 'youtube_link', 'title', 'full_duration']
 
-        playlist_id = run_query(
-            simple_insert('playlists', 4, columns, 1, 1, ['user_id', 'youtube_link'], 'id'),
-            (user_id, playlist_info["playlist_link"], playlist_info["playlist_title"], playlist_info["full_duration"]),
-            fetchone=True)
+#catalog (videos, playlists_catalog) + the user's playlist and items in one statement: atomic, one round trip
+SAVE_PLAYLIST_SQL = register("save_playlist", """
+            WITH src AS (
+                SELECT *
+                    FROM unnest(%(positions)s::int[], %(youtube_ids)s::text[], %(titles)s::text[],
+                                %(links)s::text[], %(durations)s::int[])
+                        AS s(position_num, youtube_id, title, link, duration_sec)
+            ), upsert_videos AS (
+                INSERT INTO videos (youtube_id, title, link, duration_sec)
+                SELECT DISTINCT ON (youtube_id) youtube_id, title, link, duration_sec
+                    FROM src
+                    ORDER BY youtube_id
+                ON CONFLICT (youtube_id) DO UPDATE
+                    SET title = COALESCE(EXCLUDED.title, videos.title),
+                        duration_sec = COALESCE(EXCLUDED.duration_sec, videos.duration_sec),
+                        fetched_at = NOW()
+                RETURNING id, youtube_id, duration_sec
+            ), catalog AS (
+                INSERT INTO playlists_catalog (youtube_list_id, title, full_duration, item_count)
+                SELECT %(list_id)s::text, %(title)s::text, %(full_duration)s::int, cardinality(%(positions)s::int[])
+                    WHERE %(list_id)s::text IS NOT NULL AND cardinality(%(positions)s::int[]) > 0
+                ON CONFLICT (youtube_list_id) DO UPDATE
+                    SET title = EXCLUDED.title,
+                        full_duration = EXCLUDED.full_duration,
+                        item_count = EXCLUDED.item_count,
+                        fetched_at = NOW(),
+                        sync_fingerprint = NULL
+                RETURNING id
+            ), stale_catalog_items AS (
+                DELETE FROM playlists_catalog_items ci
+                    USING catalog c
+                    WHERE ci.catalog_id = c.id
+                    AND ci.position_num <> ALL(%(positions)s::int[])
+            ), catalog_items AS (
+                INSERT INTO playlists_catalog_items (catalog_id, position_num, video_id)
+                SELECT c.id, s.position_num, v.id
+                    FROM catalog c
+                    CROSS JOIN src s
+                    JOIN upsert_videos v ON v.youtube_id = s.youtube_id
+                ON CONFLICT (catalog_id, position_num) DO UPDATE SET video_id = EXCLUDED.video_id
+            ), new_playlist AS (
+                INSERT INTO playlists (user_id, youtube_link, title, catalog_id)
+                VALUES (%(user_id)s, %(link)s, %(title)s, (SELECT id FROM catalog))
+                ON CONFLICT (user_id, youtube_link) DO NOTHING
+                RETURNING id
+            ), new_items AS (
+                INSERT INTO playlist_items (playlist_id, position_num, video_id, duration_sec)
+                SELECT np.id, s.position_num, v.id, COALESCE(v.duration_sec, 0)
+                    FROM new_playlist np
+                    CROSS JOIN src s
+                    JOIN upsert_videos v ON v.youtube_id = s.youtube_id
+            )
+            SELECT id FROM new_playlist;
+            """)
 
-        if not playlist_id:
-            return None
+#copies a known playlist from the catalog without touching yt-dlp; no row means a catalog miss
+PLAYLIST_FROM_CATALOG_SQL = register("playlist_from_catalog", """
+            WITH cat AS (
+                SELECT id, title, full_duration
+                    FROM playlists_catalog
+                    WHERE youtube_list_id = %(list_id)s
+            ), new_playlist AS (
+                INSERT INTO playlists (user_id, youtube_link, title, catalog_id)
+                SELECT %(user_id)s, %(link)s, cat.title, cat.id
+                    FROM cat
+                ON CONFLICT (user_id, youtube_link) DO NOTHING
+                RETURNING id, catalog_id
+            ), new_items AS (
+                INSERT INTO playlist_items (playlist_id, position_num, video_id, duration_sec)
+                SELECT np.id, ci.position_num, ci.video_id, COALESCE(v.duration_sec, 0)
+                    FROM new_playlist np
+                    JOIN playlists_catalog_items ci ON ci.catalog_id = np.catalog_id
+                    JOIN videos v ON v.id = ci.video_id
+            )
+            SELECT cat.title, cat.full_duration, (SELECT id FROM new_playlist)
+                FROM cat;
+            """)
 
-        for i in items:
-            run_query(
-                simple_insert(
-                    'playlist_items', 5,
-                    ['playlist_id', 'position_num', 'title', 'link', 'duration_sec']),
-                    (playlist_id, i["position_num"], i["title"], i["link"], i["duration_sec"]))
-        return playlist_id
+KNOWN_VIDEO_SQL = register("known_video", """
+            SELECT youtube_id, title, link, duration_sec
+                FROM videos
+                WHERE youtube_id = %s
+                AND title IS NOT NULL;
+            """)
 
-    @staticmethod
-    def add_video(playlist_id, link):
-        db_data = parse_single_video(link)
-        dur = db_data.get("duration_sec") or 0
-
-        row = run_query("""
-            SELECT COALESCE(MAX(position_num), 0) + 1
-            FROM playlist_items
-            WHERE playlist_id = %s;
-            """,
-            (playlist_id,), fetchone=True)
-        next_pos = row[0] if row else 1
-
-        columns = ['playlist_id', 'position_num', 'title', 'link', 'duration_sec']
-
-        run_query(
-            simple_insert('playlist_items', 5, columns),
-            (playlist_id, next_pos, db_data["title"], db_data["link"], dur))
-        
-        run_query("""
+#taken before SAVE_VIDEO_SQL, in its own statement: one statement keeps the snapshot it started with, so its
+#MAX(position_num) would not see an item committed while it waited for the lock
+LOCK_PLAYLIST_SQL = register("lock_playlist", "SELECT id FROM playlists WHERE id = %s FOR UPDATE;")
+
+SAVE_VIDEO_SQL = register("save_video", """
+            WITH v AS (
+                INSERT INTO videos (youtube_id, title, link, duration_sec)
+                VALUES (%(youtube_id)s, %(title)s, %(link)s, %(duration_sec)s)
+                ON CONFLICT (youtube_id) DO UPDATE
+                    SET title = COALESCE(EXCLUDED.title, videos.title),
+                        duration_sec = COALESCE(EXCLUDED.duration_sec, videos.duration_sec)
+                RETURNING id, duration_sec
+            ), item AS (
+                INSERT INTO playlist_items (playlist_id, position_num, video_id, duration_sec)
+                SELECT %(playlist_id)s,
+                       COALESCE((SELECT MAX(position_num) FROM playlist_items WHERE playlist_id = %(playlist_id)s), 0) + 1,
+                       v.id,
+                       COALESCE(v.duration_sec, 0)
+                    FROM v
+                RETURNING id
+            )
+            SELECT id FROM item;
+            """)
+
+#streaming import: playlist row first, then items chunk by chunk, catalog entry at the end.
+#The row stays importing until FINISH_IMPORT_SQL, so a crash mid-import leaves it marked as partial
+CREATE_IMPORT_PLAYLIST_SQL = register("create_import_playlist", """
+            INSERT INTO playlists (user_id, youtube_link, title, importing, import_job)
+            VALUES (%s, %s, %s, true, %s)
+            ON CONFLICT (user_id, youtube_link) DO NOTHING
+            RETURNING id;
+            """)
+
+#a retried ingest job starts over: what its earlier attempt left half-imported goes first
+DROP_OWN_PARTIAL_IMPORT_SQL = register("drop_own_partial_import", """
+            DELETE FROM playlists
+                WHERE user_id = %s
+                AND youtube_link = %s
+                AND importing
+                AND import_job = %s;
+            """)
+
+#the row an insert ran into: still importing (another job) or a finished playlist
+EXISTING_PLAYLIST_SQL = register("existing_playlist", """
+            SELECT importing FROM playlists WHERE user_id = %s AND youtube_link = %s;
+            """)
+
+#every chunk commits on its own, so imported items are /next-able right away
+APPEND_ITEMS_SQL = register("append_items", """
+            WITH src AS (
+                SELECT *
+                    FROM unnest(%(positions)s::int[], %(youtube_ids)s::text[], %(titles)s::text[],
+                                %(links)s::text[], %(durations)s::int[])
+                        AS s(position_num, youtube_id, title, link, duration_sec)
+            ), upsert_videos AS (
+                INSERT INTO videos (youtube_id, title, link, duration_sec)
+                SELECT DISTINCT ON (youtube_id) youtube_id, title, link, duration_sec
+                    FROM src
+                    ORDER BY youtube_id
+                ON CONFLICT (youtube_id) DO UPDATE
+                    SET title = COALESCE(EXCLUDED.title, videos.title),
+                        duration_sec = COALESCE(EXCLUDED.duration_sec, videos.duration_sec),
+                        fetched_at = NOW()
+                RETURNING id, youtube_id, duration_sec
+            ), new_items AS (
+                INSERT INTO playlist_items (playlist_id, position_num, video_id, duration_sec)
+                SELECT %(playlist_id)s, s.position_num, v.id, COALESCE(v.duration_sec, 0)
+                    FROM src s
+                    JOIN upsert_videos v ON v.youtube_id = s.youtube_id
+            )
             UPDATE playlists p
-                                    SET full_duration = COALESCE(full_duration, 0) + %s
-                                    WHERE p.id = %s;
-            """, (dur, playlist_id))
-        
-        return db_data["title"]
-    
-    @staticmethod
-    def set_playlist_await(playlist_id, user_id):
-        res = run_query("""
+                SET status = 'await',
+                    completed_at = NULL
+                WHERE p.id = %(playlist_id)s;
+            """)
+
+FINISH_IMPORT_SQL = register("finish_import", """
+            WITH catalog AS (
+                INSERT INTO playlists_catalog (youtube_list_id, title, full_duration, item_count)
+                SELECT %(list_id)s::text, p.title, p.full_duration,
+                       (SELECT count(*) FROM playlist_items pit WHERE pit.playlist_id = p.id)
+                    FROM playlists p
+                    WHERE p.id = %(playlist_id)s
+                    AND %(list_id)s::text IS NOT NULL
+                    AND EXISTS (SELECT 1 FROM playlist_items pit WHERE pit.playlist_id = p.id)
+                ON CONFLICT (youtube_list_id) DO UPDATE
+                    SET title = EXCLUDED.title,
+                        full_duration = EXCLUDED.full_duration,
+                        item_count = EXCLUDED.item_count,
+                        fetched_at = NOW(),
+                        sync_fingerprint = NULL
+                RETURNING id
+            ), stale_catalog_items AS (
+                DELETE FROM playlists_catalog_items ci
+                    USING catalog c
+                    WHERE ci.catalog_id = c.id
+                    AND NOT EXISTS (
+                        SELECT 1 FROM playlist_items pit
+                        WHERE pit.playlist_id = %(playlist_id)s
+                        AND pit.position_num = ci.position_num
+                    )
+            ), catalog_items AS (
+                INSERT INTO playlists_catalog_items (catalog_id, position_num, video_id)
+                SELECT DISTINCT ON (pit.position_num) c.id, pit.position_num, pit.video_id
+                    FROM catalog c
+                    CROSS JOIN playlist_items pit
+                    WHERE pit.playlist_id = %(playlist_id)s
+                    AND pit.position_num IS NOT NULL
+                    ORDER BY pit.position_num, pit.id
+                ON CONFLICT (catalog_id, position_num) DO UPDATE SET video_id = EXCLUDED.video_id
+            )
+            UPDATE playlists p
+                SET catalog_id = (SELECT id FROM catalog),
+                    importing = false,
+                    import_job = NULL
+                WHERE p.id = %(playlist_id)s;
+            """)
+
+DROP_PARTIAL_PLAYLIST_SQL = register("drop_partial_playlist", "DELETE FROM playlists WHERE id = %s;")
+
+SET_PLAYLIST_AWAIT_SQL = register("set_playlist_await", """
             UPDATE playlists p
             SET status = 'await',
                 completed_at = NULL
@@ -67,5 +232,269 @@ class PlaylistService:
                     AND pit.status = 'await'
                     )
             RETURNING p.id;
-            """, (playlist_id, user_id), fetchone=True)
-        return 1 if res else 0
\ No newline at end of file
+            """)
+
+
+class ImportInProgress(Exception):
+    #the user's playlist for this link is still being imported by another ingest job; retried later
+    pass
+
+
+class PlaylistService:
+    @staticmethod
+    def add_playlist(user_id, link):
+        return PlaylistService._add_playlist(user_id, link)[1]
+
+    @staticmethod
+    async def add_playlist_async(user_id, link, progress=None):
+        return (await PlaylistService._add_playlist_async(user_id, link, progress))[1]
+
+    @staticmethod
+    def _add_playlist(user_id, link):
+        known, playlist_id = PlaylistService.playlist_from_catalog(user_id, link)
+        if not known:
+            known = extract_playlist(link)
+            playlist_id = PlaylistService.save_playlist(user_id, known)
+        if not playlist_id:
+            PlaylistService._check_existing(run_query(EXISTING_PLAYLIST_SQL, (user_id, link), fetchone=True))
+        return known, playlist_id
+
+    #import_job: the ingest job doing this import, its earlier partial attempt is dropped first
+    @staticmethod
+    async def _add_playlist_async(user_id, link, progress=None, import_job=None):
+        if import_job is not None:
+            await run_query_async(DROP_OWN_PARTIAL_IMPORT_SQL, (user_id, link, import_job))
+        known, playlist_id = await PlaylistService.playlist_from_catalog_async(user_id, link)
+        if not known:
+            #a miss in memory reads the sqlite tier of the metadata cache
+            cached = await asyncio.to_thread(cached_playlist, link)
+            if cached:
+                known, playlist_id = cached, await PlaylistService.save_playlist_async(user_id, cached)
+            else:
+                known, playlist_id = await PlaylistService.stream_playlist_async(
+                    user_id, link, progress, import_job=import_job)
+        if not playlist_id:
+            PlaylistService._check_existing(
+                await run_query_async(EXISTING_PLAYLIST_SQL, (user_id, link), fetchone=True))
+        return known, playlist_id
+
+    #(result, None) means "already exists", which must not be said of a playlist that is still importing
+    @staticmethod
+    def _check_existing(row):
+        if row and row[0]:
+            raise ImportInProgress("this playlist is still being imported")
+
+    #progress is an optional coroutine function called as progress(imported, expected_or_None) after every chunk
+    @staticmethod
+    async def stream_playlist_async(user_id, link, progress=None, chunk_size=None, import_job=None):
+        chunk_size = chunk_size or STREAM_CHUNK_SIZE
+        header = None
+        playlist_id = None
+        imported = 0
+        try:
+            async with aclosing(stream_extraction(iter_playlist, link, chunk_size=chunk_size)) as batches:
+                async for batch in batches:
+                    if header is None:
+                        header, batch = batch[0], batch[1:]
+                        row = await run_query_async(
+                            CREATE_IMPORT_PLAYLIST_SQL, (user_id, header.link, header.title, import_job), fetchone=True)
+                        if not row:
+                            return header, None
+                        playlist_id = row[0]
+
+                    if not batch:
+                        continue
+                    params = PlaylistService._items_params(batch)
+                    params["playlist_id"] = playlist_id
+                    await run_query_async(APPEND_ITEMS_SQL, params)
+
+                    imported += len(batch)
+                    header.full_duration += sum(i["duration_sec"] or 0 for i in batch)
+                    if progress:
+                        await progress(imported, header.expected_count)
+            #nothing playable (empty, private or all-unavailable list): not a playlist worth saving
+            if playlist_id and not imported:
+                raise ExtractionError(f"playlist {header.list_id} has no available items")
+        except BaseException:
+            #a failed import must not leave a half-filled playlist behind
+            if playlist_id:
+                await run_query_async(DROP_PARTIAL_PLAYLIST_SQL, (playlist_id,))
+            raise
+
+        if playlist_id:
+            await run_query_async(FINISH_IMPORT_SQL, {"playlist_id": playlist_id, "list_id": header.list_id})
+        header.expected_count = imported
+        return header, playlist_id
+
+    @staticmethod
+    def playlist_from_catalog(user_id, link):
+        _, list_id = classify_link(link)
+        if not list_id:
+            return None, None
+        row = run_query(PLAYLIST_FROM_CATALOG_SQL, {"list_id": list_id, "user_id": user_id, "link": link}, fetchone=True)
+        return PlaylistService._catalog_hit(link, list_id, row)
+
+    @staticmethod
+    async def playlist_from_catalog_async(user_id, link):
+        _, list_id = classify_link(link)
+        if not list_id:
+            return None, None
+        row = await run_query_async(
+            PLAYLIST_FROM_CATALOG_SQL, {"list_id": list_id, "user_id": user_id, "link": link}, fetchone=True)
+        return PlaylistService._catalog_hit(link, list_id, row)
+
+    @staticmethod
+    def _catalog_hit(link, list_id, row):
+        if not row:
+            return None, None
+        title, full_duration, playlist_id = row
+        return PlaylistResult(link=link, title=title, full_duration=full_duration or 0, list_id=list_id), playlist_id
+
+    @staticmethod
+    def _items_params(items):
+        return {
+            "positions": [i["position_num"] for i in items],
+            "youtube_ids": [i["video_id"] for i in items],
+            "titles": [i["title"] for i in items],
+            "links": [i["link"] for i in items],
+            "durations": [i["duration_sec"] for i in items],
+        }
+
+    @staticmethod
+    def _playlist_params(user_id, playlist):
+        #nothing playable (empty, private or all-unavailable list), same as the streamed import
+        if not playlist.items:
+            raise ExtractionError(f"playlist {playlist.list_id or playlist.link} has no available items")
+        return {
+            "user_id": user_id,
+            "link": playlist.link,
+            "title": playlist.title,
+            "full_duration": playlist.full_duration,
+            "list_id": playlist.list_id,
+            **PlaylistService._items_params(playlist.items),
+        }
+
+    @staticmethod
+    def save_playlist(user_id, playlist):
+        row = run_query(SAVE_PLAYLIST_SQL, PlaylistService._playlist_params(user_id, playlist), fetchone=True)
+        return row[0] if row else None
+
+    @staticmethod
+    async def save_playlist_async(user_id, playlist):
+        row = await run_query_async(SAVE_PLAYLIST_SQL, PlaylistService._playlist_params(user_id, playlist), fetchone=True)
+        return row[0] if row else None
+
+    @staticmethod
+    def add_video(playlist_id, link):
+        video = PlaylistService.known_video(link) or extract_video(link)
+        return PlaylistService.save_video(playlist_id, video)
+
+    @staticmethod
+    async def add_video_async(playlist_id, link):
+        video = await PlaylistService.known_video_async(link) or await run_extraction(extract_video, link)
+        return await PlaylistService.save_video_async(playlist_id, video)
+
+    @staticmethod
+    def known_video(link):
+        _, video_id = classify_link(link)
+        if not video_id:
+            return None
+        return PlaylistService._video_row(run_query(KNOWN_VIDEO_SQL, (video_id,), fetchone=True))
+
+    @staticmethod
+    async def known_video_async(link):
+        _, video_id = classify_link(link)
+        if not video_id:
+            return None
+        return PlaylistService._video_row(await run_query_async(KNOWN_VIDEO_SQL, (video_id,), fetchone=True))
+
+    @staticmethod
+    def _video_row(row):
+        if not row:
+            return None
+        youtube_id, title, link, duration_sec = row
+        return VideoResult(link=link, title=title, duration_sec=duration_sec, video_id=youtube_id)
+
+    @staticmethod
+    def _video_params(playlist_id, video):
+        #a link in youtube_id would never match the same video saved by id
+        if not video.video_id:
+            raise ExtractionError(f"no video id for {video.link}")
+        return {
+            "playlist_id": playlist_id,
+            "youtube_id": video.video_id,
+            "title": video.title,
+            "link": video.link,
+            "duration_sec": video.duration_sec,
+        }
+
+    @staticmethod
+    def save_video(playlist_id, video):
+        params = PlaylistService._video_params(playlist_id, video)
+        with transaction():
+            run_query(LOCK_PLAYLIST_SQL, (playlist_id,), fetchone=True)
+            run_query(SAVE_VIDEO_SQL, params)
+        return video.title
+
+    @staticmethod
+    async def save_video_async(playlist_id, video):
+        params = PlaylistService._video_params(playlist_id, video)
+        async with async_transaction():
+            await run_query_async(LOCK_PLAYLIST_SQL, (playlist_id,), fetchone=True)
+            await run_query_async(SAVE_VIDEO_SQL, params)
+        return video.title
+
+    #one extraction per link at most (none for catalog hits); returns (result, playlist_id), result is None for unrecognised links
+    @staticmethod
+    def ingest(user, link):
+        kind, _ = classify_link(link)
+        if kind == "playlist":
+            return PlaylistService._add_playlist(user.user_id, link)
+
+        result = PlaylistService.known_video(link) if kind == "video" else None
+        if result is None:
+            result = extract(link)
+        if result is None:
+            return None, None
+
+        if result.kind == "playlist":
+            return result, PlaylistService.save_playlist(user.user_id, result)
+
+        with transaction():
+            if not user.default_playlist_id:
+                user.get_or_create_default_playlist()
+            PlaylistService.save_video(user.default_playlist_id, result)
+            PlaylistService.set_playlist_await(user.default_playlist_id, user.user_id)
+        return result, user.default_playlist_id
+
+    @staticmethod
+    async def ingest_async(user, link, progress=None, import_job=None):
+        kind, _ = classify_link(link)
+        if kind == "playlist":
+            return await PlaylistService._add_playlist_async(user.user_id, link, progress, import_job)
+
+        result = await PlaylistService.known_video_async(link) if kind == "video" else None
+        if result is None:
+            result = await run_extraction(extract, link)
+        if result is None:
+            return None, None
+
+        if result.kind == "playlist":
+            return result, await PlaylistService.save_playlist_async(user.user_id, result)
+
+        async with async_transaction():
+            if not user.default_playlist_id:
+                await user.get_or_create_default_playlist_async()
+            await PlaylistService.save_video_async(user.default_playlist_id, result)
+            await PlaylistService.set_playlist_await_async(user.default_playlist_id, user.user_id)
+        return result, user.default_playlist_id
+
+    @staticmethod
+    def set_playlist_await(playlist_id, user_id):
+        res = run_query(SET_PLAYLIST_AWAIT_SQL, (playlist_id, user_id), fetchone=True)
+        return 1 if res else 0
+
+    @staticmethod
+    async def set_playlist_await_async(playlist_id, user_id):
+        res = await run_query_async(SET_PLAYLIST_AWAIT_SQL, (playlist_id, user_id), fetchone=True)
+        return 1 if res else 0
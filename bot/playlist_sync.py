@@ -0,0 +1,280 @@
+import os
+import signal
+import asyncio
+import hashlib
+import logging
+
+from bot.yt_parse import refresh_playlist
+from bot.db_async import run_query_async, async_transaction, get_async_pool, close_async_pool
+from bot.queries import register
+from bot.extract_pool import run_extraction, shutdown_extraction_pool, ExtractorBusy
+from bot.playlist_service import PlaylistService
+from bot.logs import setup_logging, log_context
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = float(os.getenv("PLAYLIST_SYNC_INTERVAL", 6 * 3600))
+SYNC_MAX_INTERVAL = float(os.getenv("PLAYLIST_SYNC_MAX_INTERVAL", 7 * 24 * 3600))
+SYNC_POLL_INTERVAL = float(os.getenv("PLAYLIST_SYNC_POLL_INTERVAL", 60))
+SYNC_BATCH = int(os.getenv("PLAYLIST_SYNC_BATCH", 20))
+SYNC_LEASE = float(os.getenv("PLAYLIST_SYNC_LEASE", 900))
+
+#one catalog row per source playlist, however many users have it; the lease keeps other workers off it
+CLAIM_SYNC_SQL = register("claim_sync", """
+            UPDATE playlists_catalog c
+                SET sync_after = NOW() + make_interval(secs => %s)
+                WHERE c.id IN (
+                    SELECT pc.id
+                        FROM playlists_catalog pc
+                        WHERE pc.sync_after <= NOW()
+                        ORDER BY pc.sync_after, pc.id
+                        FOR UPDATE SKIP LOCKED
+                        LIMIT %s
+                )
+                RETURNING c.id, c.youtube_list_id, c.sync_fingerprint, c.sync_idle,
+                          EXISTS (SELECT 1 FROM playlists p WHERE p.catalog_id = c.id);
+            """)
+
+RESCHEDULE_SYNC_SQL = register("reschedule_sync", """
+            UPDATE playlists_catalog
+                SET sync_after = NOW() + make_interval(secs => %(delay)s),
+                    sync_idle = %(idle)s,
+                    synced_at = CASE WHEN %(synced)s THEN NOW() ELSE synced_at END
+                WHERE id = %(catalog_id)s;
+            """)
+
+#same order advance_playlist() takes them in: the items below are only touched with their playlist locked
+LOCK_SUBSCRIBERS_SQL = register("lock_subscribers", "SELECT id FROM playlists WHERE catalog_id = %s ORDER BY id FOR UPDATE;")
+
+#the whole diff in one statement: catalog refreshed, then for every subscriber new videos appended,
+#await items gone from the source marked removed, the rest moved to their current position
+#(a removed video that comes back is await again). Durations follow through videos_duration_sync.
+#A video listed twice is saved twice, so items are matched on (video, nth time it appears), not video alone
+SYNC_CATALOG_SQL = register("sync_catalog", """
+            WITH src AS (
+                SELECT *
+                    FROM unnest(%(positions)s::int[], %(youtube_ids)s::text[], %(titles)s::text[],
+                                %(links)s::text[], %(durations)s::int[])
+                        AS s(position_num, youtube_id, title, link, duration_sec)
+            ), upsert_videos AS (
+                INSERT INTO videos (youtube_id, title, link, duration_sec)
+                SELECT DISTINCT ON (youtube_id) youtube_id, title, link, duration_sec
+                    FROM src
+                    ORDER BY youtube_id
+                ON CONFLICT (youtube_id) DO UPDATE
+                    SET title = COALESCE(EXCLUDED.title, videos.title),
+                        duration_sec = COALESCE(EXCLUDED.duration_sec, videos.duration_sec),
+                        fetched_at = NOW()
+                RETURNING id, youtube_id, duration_sec
+            ), listed AS (
+                SELECT v.id AS video_id, s.position_num, COALESCE(v.duration_sec, 0) AS duration_sec,
+                       row_number() OVER (PARTITION BY v.id ORDER BY s.position_num) AS occurrence
+                    FROM src s
+                    JOIN upsert_videos v ON v.youtube_id = s.youtube_id
+            ), catalog AS (
+                UPDATE playlists_catalog
+                    SET title = COALESCE(%(title)s, title),
+                        full_duration = %(full_duration)s,
+                        item_count = cardinality(%(positions)s::int[]),
+                        fetched_at = NOW(),
+                        synced_at = NOW(),
+                        sync_after = NOW() + make_interval(secs => %(delay)s),
+                        sync_fingerprint = %(fingerprint)s,
+                        sync_idle = 0
+                    WHERE id = %(catalog_id)s
+            ), stale_catalog_items AS (
+                DELETE FROM playlists_catalog_items ci
+                    WHERE ci.catalog_id = %(catalog_id)s
+                    AND ci.position_num <> ALL(%(positions)s::int[])
+            ), catalog_items AS (
+                INSERT INTO playlists_catalog_items (catalog_id, position_num, video_id)
+                SELECT %(catalog_id)s, s.position_num, v.id
+                    FROM src s
+                    JOIN upsert_videos v ON v.youtube_id = s.youtube_id
+                ON CONFLICT (catalog_id, position_num) DO UPDATE SET video_id = EXCLUDED.video_id
+                    WHERE playlists_catalog_items.video_id <> EXCLUDED.video_id
+            ), subscribers AS (
+                SELECT id
+                    FROM playlists
+                    WHERE catalog_id = %(catalog_id)s
+            ), current_items AS (
+                SELECT pit.id, pit.playlist_id, pit.video_id, pit.position_num, pit.status,
+                       row_number() OVER (PARTITION BY pit.playlist_id, pit.video_id
+                                          ORDER BY pit.position_num NULLS LAST, pit.id) AS occurrence
+                    FROM playlist_items pit
+                    JOIN subscribers sub ON sub.id = pit.playlist_id
+            ), added AS (
+                INSERT INTO playlist_items (playlist_id, position_num, video_id, duration_sec)
+                SELECT sub.id, l.position_num, l.video_id, l.duration_sec
+                    FROM subscribers sub
+                    CROSS JOIN listed l
+                    WHERE NOT EXISTS (
+                        SELECT 1
+                        FROM current_items ci
+                        WHERE ci.playlist_id = sub.id
+                        AND ci.video_id = l.video_id
+                        AND ci.occurrence = l.occurrence
+                    )
+                RETURNING id
+            ), removed AS (
+                UPDATE playlist_items pit
+                    SET status = 'removed'
+                    FROM current_items ci
+                    WHERE pit.id = ci.id
+                    AND ci.status = 'await'
+                    AND NOT EXISTS (
+                        SELECT 1
+                        FROM listed l
+                        WHERE l.video_id = ci.video_id
+                        AND l.occurrence = ci.occurrence
+                    )
+                RETURNING pit.id
+            ), moved AS (
+                UPDATE playlist_items pit
+                    SET position_num = l.position_num,
+                        status = CASE WHEN ci.status = 'removed' THEN 'await' ELSE ci.status END
+                    FROM current_items ci
+                    JOIN listed l ON l.video_id = ci.video_id AND l.occurrence = ci.occurrence
+                    WHERE pit.id = ci.id
+                    AND (ci.position_num IS DISTINCT FROM l.position_num OR ci.status = 'removed')
+                RETURNING pit.id
+            )
+            SELECT (SELECT count(*) FROM subscribers),
+                   (SELECT count(*) FROM added),
+                   (SELECT count(*) FROM removed),
+                   (SELECT count(*) FROM moved);
+            """)
+
+#runs after the counters triggers: new videos reopen a finished playlist, removals can finish one
+SYNC_PLAYLIST_STATUS_SQL = register("sync_playlist_status", """
+            UPDATE playlists p
+                SET status = CASE WHEN p.await_cnt > 0 THEN 'await' ELSE 'done' END::watch_status,
+                    completed_at = CASE WHEN p.await_cnt > 0 THEN NULL ELSE COALESCE(p.completed_at, NOW()) END
+                WHERE p.catalog_id = %s
+                AND p.status <> CASE WHEN p.await_cnt > 0 THEN 'await' ELSE 'done' END::watch_status;
+            """)
+
+
+class PlaylistSync:
+    #a source that keeps coming back unchanged (or failing) is checked half as often each time
+    @staticmethod
+    def _delay(idle):
+        return min(SYNC_INTERVAL * 2 ** min(idle, 16), SYNC_MAX_INTERVAL)
+
+    @staticmethod
+    def fingerprint(playlist):
+        digest = hashlib.sha1((playlist.title or "").encode())
+        for item in playlist.items:
+            digest.update(f"\n{item['position_num']}:{item['video_id']}:{item['duration_sec']}".encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    async def claim_async(limit=SYNC_BATCH):
+        rows = await run_query_async(CLAIM_SYNC_SQL, (SYNC_LEASE, limit), fetchall=True)
+        return [
+            {"catalog_id": catalog_id, "list_id": list_id, "fingerprint": fingerprint, "idle": idle, "subscribed": subscribed}
+            for catalog_id, list_id, fingerprint, idle, subscribed in rows or []
+        ]
+
+    @staticmethod
+    async def reschedule_async(job, synced):
+        idle = job["idle"] + 1
+        await run_query_async(RESCHEDULE_SYNC_SQL, {
+            "catalog_id": job["catalog_id"], "delay": PlaylistSync._delay(idle), "idle": idle, "synced": synced})
+
+    #returns the diff counts, None when nothing had to be written
+    @staticmethod
+    async def sync_async(job):
+        if not job["subscribed"]:
+            #nobody follows it any more: no extraction, looked at again less and less often
+            await PlaylistSync.reschedule_async(job, synced=False)
+            return None
+
+        try:
+            playlist = await run_extraction(refresh_playlist, job["list_id"])
+        except ExtractorBusy:
+            #leave it leased, it comes back when the lease runs out
+            raise
+        except Exception:
+            await PlaylistSync.reschedule_async(job, synced=False)
+            raise
+
+        fingerprint = PlaylistSync.fingerprint(playlist)
+        if fingerprint == job["fingerprint"]:
+            await PlaylistSync.reschedule_async(job, synced=True)
+            return None
+
+        params = PlaylistService._items_params(playlist.items)
+        params.update({
+            "catalog_id": job["catalog_id"],
+            "title": playlist.title,
+            "full_duration": playlist.full_duration,
+            "fingerprint": fingerprint,
+            "delay": PlaylistSync._delay(0),
+        })
+        async with async_transaction():
+            await run_query_async(LOCK_SUBSCRIBERS_SQL, (job["catalog_id"],), fetchall=True)
+            subscribers, added, removed, moved = await run_query_async(SYNC_CATALOG_SQL, params, fetchone=True)
+            await run_query_async(SYNC_PLAYLIST_STATUS_SQL, (job["catalog_id"],))
+        return {"subscribers": subscribers, "added": added, "removed": removed, "moved": moved}
+
+
+async def run_sync_worker(worker_id, stop):
+    logger.info("Playlist sync worker %s started", worker_id)
+    while not stop.is_set():
+        jobs = []
+        try:
+            jobs = await PlaylistSync.claim_async()
+        except Exception:
+            logger.exception("🔴 Failed to claim playlists to sync")
+
+        for job in jobs:
+            if stop.is_set():
+                break
+            try:
+                with log_context(request_id=f"sync:{job['list_id']}"):
+                    diff = await PlaylistSync.sync_async(job)
+            except ExtractorBusy:
+                logger.info("Extractor busy, playlist %s is retried later", job["list_id"])
+                continue
+            except Exception as e:
+                logger.warning("Sync of playlist %s failed: %s", job["list_id"], e)
+                continue
+            if diff:
+                logger.info("Synced playlist %s: %s", job["list_id"], diff)
+
+        #a full batch means more are due right away
+        if len(jobs) >= SYNC_BATCH:
+            continue
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=SYNC_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+    logger.info("Playlist sync worker %s stopped", worker_id)
+
+
+def start_sync_workers(count, stop):
+    return [asyncio.create_task(run_sync_worker(n, stop)) for n in range(count)]
+
+
+#Standalone sync workers: python -m bot.playlist_sync
+async def _main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    setup_logging()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await get_async_pool()
+    try:
+        await asyncio.gather(*start_sync_workers(int(os.getenv("PLAYLIST_SYNC_WORKERS", 1)), stop))
+    finally:
+        shutdown_extraction_pool()
+        await close_async_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
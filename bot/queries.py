@@ -0,0 +1,73 @@
+import os
+import re
+import threading
+from functools import cached_property
+
+#DB_PREPARE=0 for a transaction-pooling PgBouncer in front of Postgres: server-side
+#prepared statements don't follow the client from one server connection to the next
+PREPARE = os.getenv("DB_PREPARE", "1") == "1"
+#per connection; psycopg's own default of 100 is below what the bot registers plus ad-hoc statements
+PREPARED_MAX = int(os.getenv("DB_PREPARED_MAX", 256))
+
+_PLACEHOLDER_RE = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+class Query(str):
+    #SQL text that knows its registry name. Still a str, so it runs anywhere a query string does;
+    #run_query() / run_query_async() prepare it once per pooled connection and execute it by name
+    def __new__(cls, name, text):
+        query = super().__new__(cls, text)
+        query.name = name
+        return query
+
+    #($1, $2 ... statement, keys): keys are the dict keys in $n order, None for %s placeholders
+    @cached_property
+    def positional(self):
+        keys = []
+
+        def number(match):
+            if match.group(0) == "%%":
+                return "%"
+            if match.group(1) is None:
+                keys.append(None)
+                return f"${len(keys)}"
+            if match.group(1) not in keys:
+                keys.append(match.group(1))
+            return f"${keys.index(match.group(1)) + 1}"
+
+        statement = _PLACEHOLDER_RE.sub(number, str(self))
+        return statement.strip().rstrip(";"), (keys if any(keys) else None), len(keys)
+
+    def values(self, params):
+        _, keys, count = self.positional
+        if keys:
+            return [params[key] for key in keys]
+        values = list(params or ())
+        if len(values) != count:
+            raise ValueError(f"query {self.name} takes {count} parameters, got {len(values)}")
+        return values
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+#module level: ADVANCE_SQL = register("advance", "SELECT ...")
+def register(name, text):
+    with _registry_lock:
+        existing = _registry.get(name)
+        if existing is not None:
+            if existing != text:
+                raise ValueError(f"query {name!r} is already registered with different SQL")
+            return existing
+        query = _registry[name] = Query(name, text)
+    return query
+
+
+def get_query(name):
+    return _registry[name]
+
+
+def registered_queries():
+    with _registry_lock:
+        return dict(_registry)
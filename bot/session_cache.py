@@ -0,0 +1,90 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    #LRU of resolved users (telegram id -> user id + default playlist); entries expire after ttl seconds.
+    #Playlist numbers are not cached: another replica may delete or add a playlist and move them
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"users": [0, 0]}
+
+    def _get(self, table, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = table.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    table.move_to_end(key)
+                    return value
+                del table[key]
+            return None
+
+    def _put(self, table, key, value):
+        table[key] = (time.monotonic() + self.ttl, value)
+        table.move_to_end(key)
+        while len(table) > self.size:
+            table.popitem(last=False)
+
+    def _count(self, kind, hit):
+        with self._lock:
+            self._stats[kind][0 if hit else 1] += 1
+
+    def get_user(self, tg_id):
+        value = self._get(self._users, tg_id)
+        self._count("users", value is not None)
+        return dict(value) if value is not None else None
+
+    def set_user(self, tg_id, user_id, default_playlist_id=None):
+        if tg_id is None or user_id is None:
+            return
+        with self._lock:
+            self._put(self._users, tg_id, {"user_id": user_id, "default_playlist_id": default_playlist_id})
+
+    def set_default_playlist(self, tg_id, playlist_id):
+        with self._lock:
+            entry = self._users.get(tg_id)
+            if entry is not None:
+                entry[1]["default_playlist_id"] = playlist_id
+
+    def invalidate_user(self, tg_id):
+        with self._lock:
+            self._users.pop(tg_id, None)
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for kind, (hits, misses) in self._stats.items():
+                lookups = hits + misses
+                result[kind] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / lookups if lookups else 0.0,
+                }
+            result["users"]["entries"] = len(self._users)
+            return result
+
+
+_session_cache = None
+_session_cache_lock = threading.Lock()
+
+
+def get_session_cache():
+    global _session_cache
+    if _session_cache is None:
+        with _session_cache_lock:
+            if _session_cache is None:
+                _session_cache = SessionCache(
+                    ttl=float(os.getenv("SESSION_CACHE_TTL", 3600)),
+                    size=int(os.getenv("SESSION_CACHE_SIZE", 10000)),
+                )
+    return _session_cache
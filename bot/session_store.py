@@ -0,0 +1,257 @@
+import os
+import json
+import socket
+import asyncio
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+from bot.db_async import run_query_async
+from bot.queries import register
+from bot.user_class import User
+from bot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", 5))
+#users whose last saved state is remembered; an evicted one is reloaded (not overwritten) on its next update
+SAVED_SIZE = int(os.getenv("SESSION_SAVED_SIZE", 10000))
+#shared sessions: how long a replica may hold a user's session before another one takes it over
+SESSION_LEASE = float(os.getenv("SESSION_LEASE", 30))
+
+LOAD_SESSION_SQL = register("load_session", "SELECT data FROM user_sessions WHERE telegram_id = %s;")
+
+SAVE_SESSIONS_SQL = register("save_sessions", """
+            INSERT INTO user_sessions (telegram_id, data)
+            SELECT s.telegram_id, s.data::jsonb
+                FROM unnest(%s::bigint[], %s::text[]) AS s(telegram_id, data)
+            ON CONFLICT (telegram_id) DO UPDATE
+                SET data = EXCLUDED.data,
+                    updated_at = NOW();
+            """)
+
+
+#loads the session and leases it to this replica in one round trip; no row while another replica holds it.
+#The owner already holding it (same replica, next update of the user) just renews
+ACQUIRE_SESSION_SQL = register("acquire_session", """
+            INSERT INTO user_sessions (telegram_id, data, locked_by, locked_until)
+            VALUES (%(tg_id)s, '{}'::jsonb, %(owner)s, NOW() + make_interval(secs => %(lease)s))
+            ON CONFLICT (telegram_id) DO UPDATE
+                SET locked_by = EXCLUDED.locked_by,
+                    locked_until = EXCLUDED.locked_until
+                WHERE user_sessions.locked_until IS NULL
+                OR user_sessions.locked_until < NOW()
+                OR user_sessions.locked_by = EXCLUDED.locked_by
+            RETURNING data;
+            """)
+
+RELEASE_SESSION_SQL = register("release_session", """
+            UPDATE user_sessions
+                SET locked_by = NULL,
+                    locked_until = NULL
+                WHERE telegram_id = %s
+                AND locked_by = %s;
+            """)
+
+
+class PostgresSessionStore:
+    async def load(self, tg_id):
+        row = await run_query_async(LOAD_SESSION_SQL, (tg_id,), fetchone=True)
+        return row[0] if row else None
+
+    #waits (polling, backing off) while another replica handles one of the user's updates
+    async def acquire(self, tg_id, owner, lease):
+        params = {"tg_id": tg_id, "owner": owner, "lease": lease}
+        delay = 0.05
+        with get_metrics().timer("session_lease_wait_seconds", "postgres"):
+            while True:
+                row = await run_query_async(ACQUIRE_SESSION_SQL, params, fetchone=True)
+                if row:
+                    return row[0]
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+
+    async def release(self, tg_id, owner):
+        await run_query_async(RELEASE_SESSION_SQL, (tg_id, owner))
+
+    #one statement per flush, whatever the batch size
+    async def save_many(self, sessions):
+        ids = list(sessions)
+        await run_query_async(SAVE_SESSIONS_SQL, (ids, [json.dumps(sessions[i]) for i in ids]))
+
+    async def close(self):
+        pass
+
+
+class FileSessionStore:
+    #single-host deployments: one SQLite file next to the bot, calls run off the event loop
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS user_sessions (
+                telegram_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            )""")
+
+    def _load(self, tg_id):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM user_sessions WHERE telegram_id = ?", (tg_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save_many(self, sessions):
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO user_sessions (telegram_id, data) VALUES (?, ?)",
+                [(tg_id, json.dumps(data)) for tg_id, data in sessions.items()])
+            self._db.execute("COMMIT")
+
+    async def load(self, tg_id):
+        return await asyncio.to_thread(self._load, tg_id)
+
+    #one host, one process: the per-user mailbox already keeps a user's updates apart
+    async def acquire(self, tg_id, owner, lease):
+        return await self.load(tg_id)
+
+    async def release(self, tg_id, owner):
+        pass
+
+    async def save_many(self, sessions):
+        await asyncio.to_thread(self._save_many, sessions)
+
+    async def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def snapshot(user_data):
+    #the User object plus whatever plain values handlers keep (dialog flags); anything else isn't persisted
+    data = {}
+    for key, value in user_data.items():
+        if isinstance(value, User):
+            data[key] = {"__user__": value.to_session()}
+        elif isinstance(value, (bool, int, float, str)) or value is None:
+            data[key] = value
+    return data
+
+
+def restore(data):
+    return {
+        key: User.from_session(value["__user__"]) if isinstance(value, dict) and "__user__" in value else value
+        for key, value in data.items()
+    }
+
+
+class SessionPersistence:
+    #user_data is loaded the first time a user shows up in this process and written back in batches;
+    #only users seen since the last flush are compared against what was saved.
+    #shared=True is for replicas: every update leases and reloads the user's state, flush_user() writes it back
+    #and gives the lease up. The user's next update, on whichever replica, waits for that lease
+    def __init__(self, store, flush_interval=FLUSH_INTERVAL, shared=False, saved_size=SAVED_SIZE,
+                 lease=SESSION_LEASE, owner=None):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.saved_size = saved_size
+        self.lease = lease
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self._saved = OrderedDict()
+        self._touched = {}
+
+    async def attach(self, tg_id, user_data):
+        if self.shared or tg_id not in self._saved:
+            data = None
+            try:
+                if self.shared:
+                    data = await self.store.acquire(tg_id, self.owner, self.lease)
+                else:
+                    data = await self.store.load(tg_id)
+            except Exception:
+                logger.warning("Failed to load session of %s", tg_id, exc_info=True)
+            restored = restore(data or {})
+            if self.shared:
+                user_data.clear()
+                user_data.update(restored)
+            else:
+                for key, value in restored.items():
+                    user_data.setdefault(key, value)
+            self._remember(tg_id, data or {})
+        else:
+            self._saved.move_to_end(tg_id)
+        self._touched[tg_id] = user_data
+
+    #LRU: a user evicted here costs one more load and, at worst, one unchanged write
+    def _remember(self, tg_id, data):
+        self._saved[tg_id] = data
+        self._saved.move_to_end(tg_id)
+        while len(self._saved) > self.saved_size:
+            self._saved.popitem(last=False)
+
+    async def flush(self):
+        touched, self._touched = self._touched, {}
+        return await self._save(touched)
+
+    async def flush_user(self, tg_id):
+        user_data = self._touched.pop(tg_id, None)
+        try:
+            return await self._save({tg_id: user_data}) if user_data is not None else 0
+        finally:
+            if self.shared:
+                try:
+                    await self.store.release(tg_id, self.owner)
+                except Exception:
+                    #the lease runs out on its own
+                    logger.warning("Failed to release session of %s", tg_id, exc_info=True)
+
+    async def _save(self, touched):
+        changed = {}
+        for tg_id, user_data in touched.items():
+            data = snapshot(user_data)
+            if data != self._saved.get(tg_id):
+                changed[tg_id] = data
+        if not changed:
+            return 0
+
+        try:
+            await self.store.save_many(changed)
+        except Exception:
+            #keep them for the next round
+            logger.warning("Failed to flush %s sessions", len(changed), exc_info=True)
+            for tg_id in changed:
+                self._touched.setdefault(tg_id, touched[tg_id])
+            return 0
+        for tg_id, data in changed.items():
+            self._remember(tg_id, data)
+        return len(changed)
+
+    async def run(self, stop):
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def close(self):
+        await self.flush()
+        await self.store.close()
+
+
+#SESSION_STORE=postgres|file, anything else keeps user_data in memory only
+def make_session_persistence(shared=False):
+    kind = os.getenv("SESSION_STORE", "postgres")
+    if kind == "postgres":
+        store = PostgresSessionStore()
+    elif kind == "file":
+        if shared:
+            logger.warning("SESSION_STORE=file is local to this host, replicas won't see each other's sessions")
+        store = FileSessionStore(os.getenv("SESSION_STORE_PATH", "sessions.sqlite3"))
+    else:
+        if shared:
+            logger.warning("No SESSION_STORE: /delete and /restart dialogs won't survive a switch of replica")
+        return None
+    logger.info("Session persistence: %s%s", kind, " (shared)" if shared else "")
+    return SessionPersistence(store, shared=shared)
@@ -0,0 +1,104 @@
+import time
+import asyncio
+import logging
+
+from telegram.ext import BaseUpdateProcessor
+
+from bot.metrics import get_metrics
+from bot.logs import log_context
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_TEXT = "⏳ Still working on your previous messages, send this one again in a moment."
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    #up to max_concurrent_updates run at once, but updates of one user run one after another in arrival order
+    #(asyncio.Lock wakes waiters FIFO). A user gets at most max_pending_per_user updates admitted (running + waiting);
+    #the rest are answered with OVERFLOW_TEXT and dropped without running any handler.
+    #The user's turn is taken before a concurrency slot, so waiting updates of one chatty user hold no slots.
+    #after_update(update) runs inside the user's turn, e.g. to flush its session
+    #The slots are the base class's own semaphore, so current_concurrent_updates counts running handlers
+    def __init__(self, max_concurrent_updates, max_pending_per_user=0, after_update=None):
+        super().__init__(max_concurrent_updates)
+        self.max_pending_per_user = max_pending_per_user
+        self.after_update = after_update
+        self._mailboxes = {}
+        self.overflowed = 0
+
+    @staticmethod
+    def _key(update):
+        user = getattr(update, "effective_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, "effective_chat", None)
+        return chat.id if chat is not None else None
+
+    #Overrides a method PTB marks @final (a typing marker, Application just calls it). The base version holds a
+    #slot around do_process_update, so the turn could only be taken with a slot already held: 13 users with a full
+    #mailbox of 5 would hold all 64 slots while everyone else waits. Here the slot is taken once it's the user's turn
+    async def process_update(self, update, coroutine):
+        key = self._key(update)
+        #every record logged while handling it carries the update and user ids
+        with log_context(request_id=getattr(update, "update_id", None), user_id=key):
+            await self._process(update, key, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        async with self._semaphore:
+            await coroutine
+
+    async def _process(self, update, key, coroutine):
+        if key is None:
+            await self.do_process_update(update, coroutine)
+            return
+
+        entry = self._mailboxes.get(key)
+        if entry is not None and self.max_pending_per_user and entry[1] >= self.max_pending_per_user:
+            self.overflowed += 1
+            get_metrics().inc("updates_overflowed", "mailbox")
+            coroutine.close()
+            await self._reject(update)
+            return
+
+        if entry is None:
+            entry = self._mailboxes[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        queued_at = time.perf_counter()
+        try:
+            async with entry[0]:
+                get_metrics().observe("update_wait_seconds", "mailbox", time.perf_counter() - queued_at)
+                try:
+                    await self.do_process_update(update, coroutine)
+                finally:
+                    if self.after_update:
+                        try:
+                            await self.after_update(update)
+                        except Exception:
+                            logger.exception("🔴 after_update failed for user %s", key)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._mailboxes[key]
+
+    @staticmethod
+    async def _reject(update):
+        message = getattr(update, "effective_message", None)
+        if message is None:
+            return
+        try:
+            await message.reply_text(OVERFLOW_TEXT)
+        except Exception:
+            logger.warning("Failed to answer an overflowed update", exc_info=True)
+
+    @property
+    def active_users(self):
+        return len(self._mailboxes)
+
+    def stats(self):
+        return {"active_users": self.active_users, "overflowed": self.overflowed}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -1,7 +1,60 @@
-from bot.db_connection import run_query,simple_insert
-import random
+from bot.db_connection import run_query, transaction
+from bot.db_async import run_query_async, async_transaction
+from bot.queries import register
+from bot.playlist_class import PICK_MODE
+from bot.session_cache import get_session_cache
 from html import escape
 
+
+INSERT_USER_SQL = register("insert_user", """
+            INSERT INTO users (telegram_id, username)
+            VALUES (%s, %s)
+            ON CONFLICT (telegram_id) DO NOTHING
+            RETURNING id;
+            """)
+
+SELECT_USER_ID_SQL = register("select_user_id", "SELECT id FROM users WHERE telegram_id = %s")
+
+INSERT_DEFAULT_PLAYLIST_SQL = register("insert_default_playlist", """
+            INSERT INTO playlists (user_id, youtube_link, title, full_duration, status)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (user_id, youtube_link) DO NOTHING
+            RETURNING id;
+            """)
+
+SELECT_DEFAULT_PLAYLIST_SQL = register("select_default_playlist", """
+                SELECT id FROM playlists
+                WHERE user_id = %s AND youtube_link = %s
+                LIMIT 1;
+            """)
+
+#pick_playlist() lives in db/create_tables.sql; no sort over the user's playlists in the default mode
+RANDOM_PLAYLIST_SQL = register("random_playlist", "SELECT pick_playlist(%s, %s);")
+
+
+#counters are kept on playlists by triggers (db/create_tables.sql), no playlist_items scan here
+RENDER_PLAYLISTS_SQL = register("render_playlists", """
+                SELECT p.id, p.youtube_link, p.title, p.status, p.done_sec AS watched_sec, p.ordinal AS num
+                    FROM playlists p
+                    WHERE p.user_id = %s and p.youtube_link <> 'default_playlist'
+                    ORDER BY p.ordinal;""")
+
+USER_STAT_SQL = register("user_stat", """
+            SELECT
+                count(p.id) AS playlists_cnt,
+                COALESCE(SUM(p.done_cnt), 0) AS done_cnt,
+                COALESCE(SUM(p.done_sec), 0) AS done_sec,
+                COALESCE(SUM(p.await_cnt), 0) AS await_cnt,
+                COALESCE(SUM(p.await_sec), 0) AS await_sec
+            FROM playlists p
+            WHERE p.user_id = %s;
+        """)
+
+
+def _first(row):
+    return row[0] if isinstance(row, (tuple, list)) else row
+
+
 class User:
     def __init__(self, tg_id, username, user_id=None):
         self.tg_id = tg_id
@@ -9,99 +62,165 @@ class User:
         self.user_id = user_id
         self.default_playlist_id = None
 
+    #plain dict for the session store (bot/session_store.py)
+    def to_session(self):
+        return {
+            "tg_id": self.tg_id,
+            "username": self.username,
+            "user_id": self.user_id,
+            "default_playlist_id": self.default_playlist_id,
+        }
+
+    @classmethod
+    def from_session(cls, data):
+        user = cls(data["tg_id"], data.get("username"), user_id=data.get("user_id"))
+        user.default_playlist_id = data.get("default_playlist_id")
+        return user
+
     def save_to_db(self):
-        column_name_list = ['telegram_id', 'username']
-        row = run_query(
-            simple_insert('users', 2, column_name_list, 1, 1, ['telegram_id'], 'id'),
-            (self.tg_id, self.username), fetchone=True)
-        if row:
-            self.user_id = row[0] if isinstance(row, (tuple, list)) else row
-        else:
-            row = run_query("SELECT id FROM users WHERE telegram_id = %s", (self.tg_id,), fetchone=True)
+        with transaction():
+            row = run_query(INSERT_USER_SQL, (self.tg_id, self.username), fetchone=True)
+            if not row:
+                row = run_query(SELECT_USER_ID_SQL, (self.tg_id,), fetchone=True)
+        return self._set_user_id(row)
+
+    async def save_to_db_async(self):
+        async with async_transaction():
+            row = await run_query_async(INSERT_USER_SQL, (self.tg_id, self.username), fetchone=True)
             if not row:
-                raise RuntimeError("User upsert failed: no id returned and not found by telegram_id")
-            self.user_id = row[0] if isinstance(row, (tuple, list)) else row
+                row = await run_query_async(SELECT_USER_ID_SQL, (self.tg_id,), fetchone=True)
+        return self._set_user_id(row)
+
+    def _set_user_id(self, row):
+        if not row:
+            raise RuntimeError("User upsert failed: no id returned and not found by telegram_id")
+        self.user_id = _first(row)
+        get_session_cache().set_user(self.tg_id, self.user_id, self.default_playlist_id)
         return self.user_id
-    
+
     def get_or_create_default_playlist(self):
-        column_name_list = ['user_id', 'youtube_link', 'title', 'full_duration', 'status']
-        playlist_id = run_query(
-            simple_insert('playlists', 5, column_name_list, 1, 1, ['user_id', 'youtube_link'], 'id'),
-            (self.user_id, "default_playlist", "playlist_for_single_videos", 0, 'await'),
-            fetchone=True
-            )
-        if not playlist_id:
-            playlist_id = run_query("""
-                SELECT id FROM playlists
-                WHERE user_id = %s AND youtube_link = %s
-                LIMIT 1;
-            """, (self.user_id, "default_playlist"), fetchone=True)
+        with transaction():
+            playlist_id = run_query(
+                INSERT_DEFAULT_PLAYLIST_SQL,
+                (self.user_id, "default_playlist", "playlist_for_single_videos", 0, 'await'),
+                fetchone=True
+                )
+            if not playlist_id:
+                playlist_id = run_query(SELECT_DEFAULT_PLAYLIST_SQL, (self.user_id, "default_playlist"), fetchone=True)
+
+        return self._set_default_playlist(playlist_id)
+
+    async def get_or_create_default_playlist_async(self):
+        async with async_transaction():
+            playlist_id = await run_query_async(
+                INSERT_DEFAULT_PLAYLIST_SQL,
+                (self.user_id, "default_playlist", "playlist_for_single_videos", 0, 'await'),
+                fetchone=True
+                )
+            if not playlist_id:
+                playlist_id = await run_query_async(
+                    SELECT_DEFAULT_PLAYLIST_SQL, (self.user_id, "default_playlist"), fetchone=True)
+
+        return self._set_default_playlist(playlist_id)
 
-        self.default_playlist_id = playlist_id[0] if playlist_id else None
+
+    def _set_default_playlist(self, row):
+        self.default_playlist_id = row[0] if row else None
+        if self.default_playlist_id:
+            get_session_cache().set_default_playlist(self.tg_id, self.default_playlist_id)
         return self.default_playlist_id
-    
+
+    #a session cache hit skips the DB; with ensure_default the default playlist must be known too
+    @classmethod
+    def _from_session_cache(cls, u, ensure_default):
+        cached = get_session_cache().get_user(u.id)
+        if not cached or (ensure_default and not cached["default_playlist_id"]):
+            return None
+        Cur_user = cls(u.id, u.username, user_id=cached["user_id"])
+        Cur_user.default_playlist_id = cached["default_playlist_id"]
+        return Cur_user
 
     @classmethod
-    def validate_or_reload(cls, context, update):
+    def validate_or_reload(cls, context, update, ensure_default=True):
         Cur_user = context.user_data.get("user")
         if Cur_user:
             return Cur_user
 
         u = update.effective_user
+        Cur_user = cls._from_session_cache(u, ensure_default)
+        if Cur_user:
+            context.user_data["user"] = Cur_user
+            return Cur_user
+
         Cur_user = cls(u.id, u.username)
+        try:
+            with transaction():
+                res = run_query(SELECT_USER_ID_SQL, (u.id,), fetchone=True)
+                if res:
+                    Cur_user._set_user_id(res)
+                else:
+                    Cur_user.save_to_db()
 
-        res = run_query("SELECT id FROM users WHERE telegram_id = %s", (u.id,), fetchone=True)
-        if res:
-            Cur_user.user_id = res[0] if isinstance(res, (tuple, list)) else res
-        else:
-            Cur_user.save_to_db()
+                if ensure_default:
+                    Cur_user.get_or_create_default_playlist()
+        except Exception:
+            #ids written to the cache inside a rolled back transaction may not exist
+            get_session_cache().invalidate_user(u.id)
+            raise
+        context.user_data["user"] = Cur_user
+        return Cur_user
+
+    @classmethod
+    async def validate_or_reload_async(cls, context, update, ensure_default=True):
+        Cur_user = context.user_data.get("user")
+        if Cur_user:
+            return Cur_user
 
-        Cur_user.get_or_create_default_playlist()
+        u = update.effective_user
+        Cur_user = cls._from_session_cache(u, ensure_default)
+        if Cur_user:
+            context.user_data["user"] = Cur_user
+            return Cur_user
+
+        Cur_user = cls(u.id, u.username)
+        try:
+            async with async_transaction():
+                res = await run_query_async(SELECT_USER_ID_SQL, (u.id,), fetchone=True)
+                if res:
+                    Cur_user._set_user_id(res)
+                else:
+                    await Cur_user.save_to_db_async()
+
+                if ensure_default:
+                    await Cur_user.get_or_create_default_playlist_async()
+        except Exception:
+            get_session_cache().invalidate_user(u.id)
+            raise
         context.user_data["user"] = Cur_user
         return Cur_user
 
-    def get_random_playlist(self):
-        tuple_ids = run_query("""
-            SELECT p.id
-                FROM playlists p
-                WHERE p.user_id = %s
-          AND EXISTS (
-            SELECT 1
-            FROM playlist_items pit
-            WHERE pit.playlist_id = p.id
-            AND COALESCE(TRIM(LOWER(pit.status)), 'await') = 'await'
-          )
-        ORDER BY random()
-        LIMIT 1;
-        """, (self.user_id,), fetchall = True)
-
-        if not tuple_ids:
-            return None
-        playlist_ids = [id[0] for id in tuple_ids]
-        random_playlist = random.choice(playlist_ids)
-        return random_playlist
-    
+    def get_random_playlist(self, mode=PICK_MODE):
+        row = run_query(RANDOM_PLAYLIST_SQL, (self.user_id, mode), fetchone = True)
+        return _first(row) if row else None
+
+    async def get_random_playlist_async(self, mode=PICK_MODE):
+        row = await run_query_async(RANDOM_PLAYLIST_SQL, (self.user_id, mode), fetchone = True)
+        return _first(row) if row else None
+
 
     def render_playlists(self):
-        lists = run_query("""
-                WITH ordered AS (
-                    SELECT p.id, p.youtube_link, p.title, p.status,
-                    COALESCE(SUM(CASE WHEN pit.status = 'done' THEN pit.duration_sec END), 0) AS watched_sec,
-                    ROW_NUMBER() OVER (ORDER BY p.id) AS num
-                        FROM users u
-                        JOIN playlists p ON u.id = p.user_id
-                        LEFT JOIN playlist_items pit ON pit.playlist_id = p.id      
-                        WHERE u.id = %s and p.youtube_link <> 'default_playlist'
-                        GROUP BY p.id, p.youtube_link, p.title, p.status
-                    )
-                    SELECT id, youtube_link, title, status, watched_sec, num
-                          FROM ordered
-                          ORDER BY num;""", 
-                (self.user_id,), fetchall = True)
+        lists = run_query(RENDER_PLAYLISTS_SQL, (self.user_id,), fetchall = True)
+        return self._render(lists)
+
+    async def render_playlists_async(self):
+        lists = await run_query_async(RENDER_PLAYLISTS_SQL, (self.user_id,), fetchall = True)
+        return self._render(lists)
 
+    @staticmethod
+    def _render(lists):
         if not lists:
             return "No playlists saved"
-    
+
         lines = ["Your playlists:\n"]
         for pid, link, title, status, watched_sec, num in lists:
             safe_title = escape(title or "(noname)")
@@ -116,26 +235,19 @@ class User:
                 f"Watched: {minutes}min\n"
             )
         return "\n".join(lines)
-    
+
 
     def get_user_stat(self):
-        playlists_count = run_query("""
-            SELECT count(p.id)
-                         FROM playlists p
-                         WHERE p.user_id = %s;""", (self.user_id,), fetchone = True)
-        
-        row = run_query("""
-            SELECT
-                COALESCE(SUM(CASE WHEN pit.status = 'done'  THEN 1 END), 0) AS done_cnt,
-                COALESCE(SUM(CASE WHEN pit.status = 'done'  THEN pit.duration_sec END), 0) AS done_sec,
-                COALESCE(SUM(CASE WHEN pit.status = 'await' THEN 1 END), 0) AS await_cnt,
-                COALESCE(SUM(CASE WHEN pit.status = 'await' THEN pit.duration_sec END), 0) AS await_sec
-            FROM playlists p
-            JOIN playlist_items pit ON pit.playlist_id = p.id
-            WHERE p.user_id = %s;
-        """, (self.user_id,), fetchone=True)
+        row = run_query(USER_STAT_SQL, (self.user_id,), fetchone=True)
+        return self._format_stat(row)
+
+    async def get_user_stat_async(self):
+        row = await run_query_async(USER_STAT_SQL, (self.user_id,), fetchone=True)
+        return self._format_stat(row)
 
-        done_cnt, done_sec, await_cnt, await_sec = row if row else (0, 0, 0, 0)
+    @staticmethod
+    def _format_stat(row):
+        playlists_cnt, done_cnt, done_sec, await_cnt, await_sec = row if row else (0, 0, 0, 0, 0)
 
         def fmt_hm(total_sec: int) -> str:
             mins = total_sec // 60
@@ -161,11 +273,11 @@ class User:
         else:
             pic = '⬛⬜⬜⬜⬜⬜'
 
-        stat = ['User statistic:','\n', '\n',  
-                f"Playlist count: {playlists_count[0] - 1}", '\n', 
+        stat = ['User statistic:','\n', '\n',
+                f"Playlist count: {max(playlists_cnt - 1, 0)}", '\n',
                 f"Videos done: {done_cnt}", '\n',
-                f"Videos await: {await_cnt}",'\n', '\n', 
+                f"Videos await: {await_cnt}",'\n', '\n',
                 f"⏳ Time await {await_str}",'\n',
-                f"⌛ Time watched: {done_str}", '\n', '\n', 
+                f"⌛ Time watched: {done_str}", '\n', '\n',
                 f"Progress: {pic}({done_percentage}%)"]
-        return "".join(stat)
\ No newline at end of file
+        return "".join(stat)
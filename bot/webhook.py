@@ -0,0 +1,81 @@
+#Webhook entry point, one ASGI app per replica:
+#
+#   WEBHOOK_URL=https://bot.example.com/telegram WEBHOOK_SECRET=... uvicorn bot.webhook:app --port 8000
+#
+#Any number of replicas can sit behind a load balancer: ingestion is claimed from ingest_jobs with
+#SKIP LOCKED, /next locks the playlist row, and every update leases the user's row in user_sessions
+#until its user_data is written back. A user's next update, whichever replica it lands on, waits for
+#that lease, or for it to run out after SESSION_LEASE seconds if the replica holding it died.
+import os
+import logging
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+
+from bot.main import build_application, _post_init, _post_stop, _post_shutdown
+from bot.metrics import get_metrics
+from bot.logs import setup_logging
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+application = build_application(webhook=True)
+
+
+#answers as soon as the update is queued; handlers run in the background, ordered per user
+async def telegram_update(request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception:
+        logger.warning("Malformed update", exc_info=True)
+        return Response(status_code=400)
+    await application.update_queue.put(update)
+    return Response()
+
+
+#Prometheus scrape target, one per replica
+async def metrics(request):
+    return PlainTextResponse(get_metrics().render(), media_type="text/plain; version=0.0.4")
+
+
+async def health(request):
+    return PlainTextResponse("ok" if application.running else "starting",
+                             status_code=200 if application.running else 503)
+
+
+#run_webhook() would bring its own server, so the lifecycle (and the post_* hooks, in run_polling's order) is driven here
+@asynccontextmanager
+async def lifespan(_):
+    await application.initialize()
+    await _post_init(application)
+    if WEBHOOK_URL:
+        #every replica registers the same URL, setWebhook is idempotent
+        await application.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+    await application.start()
+    try:
+        yield
+    finally:
+        #no deleteWebhook here: the other replicas keep serving it
+        await application.stop()
+        await _post_stop(application)
+        await application.shutdown()
+        await _post_shutdown(application)
+
+
+app = Starlette(
+    routes=[
+        Route(WEBHOOK_PATH, telegram_update, methods=["POST"]),
+        Route("/healthz", health),
+        Route("/metrics", metrics),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+from bot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    #LRU in memory over an LRU SQLite file; both tiers expire entries after ttl seconds
+    def __init__(self, ttl, memory_size, disk_path=None, disk_size=0):
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_rows = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS metadata (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_metadata_last_access ON metadata(last_access)")
+            self._disk_rows = self._db.execute("SELECT count(*) FROM metadata").fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.hits_memory += 1
+                    return value
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM metadata WHERE key = ?", (key,)).fetchone()
+                if row and row[1] > now:
+                    self._db.execute("UPDATE metadata SET last_access = ? WHERE key = ?", (now, key))
+                    value = json.loads(row[0])
+                    self._remember(key, row[1], value)
+                    self.hits_disk += 1
+                    return value
+                if row:
+                    self._db.execute("DELETE FROM metadata WHERE key = ?", (key,))
+                    self._disk_rows -= 1
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO metadata (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), expires_at, now))
+                self._disk_rows += 1
+                if self._disk_rows > self.disk_size:
+                    self._evict_disk()
+
+    def _remember(self, key, expires_at, value):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    #_disk_rows is an upper bound (a replaced key counts as a new row), so the table is only counted once it
+    #says the limit is passed; eviction goes down to 90% so the next writes don't come back here one by one
+    def _evict_disk(self):
+        rows = self._db.execute("SELECT count(*) FROM metadata").fetchone()[0]
+        if rows > self.disk_size:
+            rows -= self._db.execute("DELETE FROM metadata WHERE expires_at <= ?", (time.time(),)).rowcount
+            excess = rows - (self.disk_size - self.disk_size // 10)
+            if excess > 0:
+                rows -= self._db.execute("""
+                    DELETE FROM metadata WHERE key IN (
+                        SELECT key FROM metadata ORDER BY last_access LIMIT ?
+                    )""", (excess,)).rowcount
+        self._disk_rows = rows
+
+    def stats(self):
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+
+
+def get_metadata_cache():
+    global _metadata_cache
+    if _metadata_cache is None:
+        with _metadata_cache_lock:
+            if _metadata_cache is None:
+                _metadata_cache = MetadataCache(
+                    ttl=float(os.getenv("YT_CACHE_TTL", 6 * 3600)),
+                    memory_size=int(os.getenv("YT_CACHE_MEMORY", 512)),
+                    disk_path=os.getenv("YT_CACHE_PATH", "yt_cache.sqlite3") or None,
+                    disk_size=int(os.getenv("YT_CACHE_DISK_MAX", 20000)),
+                )
+                get_metrics().register_gauge("yt_cache", _metadata_cache.stats)
+    return _metadata_cache
@@ -1,5 +1,10 @@
 import yt_dlp
 import logging
+from dataclasses import dataclass, field, asdict, replace
+from typing import ClassVar
+from urllib.parse import urlparse, parse_qs
+
+from bot.yt_cache import get_metadata_cache
 
 #playlists table
 # -- id
@@ -7,7 +12,8 @@ import logging
 # -- youtube_link
 # -- title
 # -- full_duration
-# -- status // await -- in_progress -- done
+# -- status // watch_status: await -- done
+# -- done_cnt, done_sec, await_cnt, await_sec // kept by triggers
 # -- created_at
 # -- last_sent
 # -- completed_at
@@ -16,18 +22,17 @@ import logging
 # -- id
 # -- playlist_id
 # -- position_num
-# -- title
-# -- link 
-# -- duration_sec
-# -- status // await -- skipped -- done
+# -- video_id // -> videos: youtube_id, title, link, duration_sec
+# -- duration_sec // copy of videos.duration_sec
+# -- status // watch_status: await -- done -- removed (gone from the source playlist)
 # -- completed_at
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
+class ExtractionError(RuntimeError):
+    pass
+
+
 class _QuietLogger:
     def debug(self, msg): 
         pass
@@ -53,108 +58,293 @@ BASE_YDL_OPTS = {
     "no_warnings": True,
     "skip_download": True,
     "simulate": True,
-    "ignoreerrors": True, 
+    #errors surface as DownloadError: a failed extraction is retried by the ingest queue, not taken for "nothing there"
+    "ignoreerrors": False,
     "extractor_retries": 2,  
     "logger": _QuietLogger(),  
     "match_filter": _skip_unavailable,
 }
 
-def detect_youtube_type(link):
-    opts = {**BASE_YDL_OPTS, "extract_flat": True}
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(link, download=False)
-    except Exception as e:
-        logger.warning(f"detect error {link}: {e}")
-        return "parse_error"
-    
-    if not info:
-        return "parse_error"
-    
-    t = info.get("_type")
-    if t in ("playlist", "multi_video", "compat_list") or ("entries" in info):
-        return "playlist"
-    if t in (None, "video", "url"): 
-        return "video"
-    return "unknown"
-    
+PLAYLIST_OPTS = {**BASE_YDL_OPTS, "extract_flat": "in_playlist", "lazy_playlist": True}
+VIDEO_OPTS = {**BASE_YDL_OPTS, "noplaylist": True, "extract_flat": False}
+
+_VIDEO_PATH_PREFIXES = ("/shorts/", "/live/", "/embed/", "/v/")
 
-def parse_single_video(link):
-    opts = {**BASE_YDL_OPTS, "noplaylist": True, "extract_flat": False}
 
+@dataclass
+class VideoResult:
+    link: str
+    title: str | None = None
+    duration_sec: int | None = None
+    video_id: str | None = None
+    kind: ClassVar[str] = "video"
+
+
+@dataclass
+class PlaylistResult:
+    link: str
+    title: str | None = None
+    full_duration: int = 0
+    items: list = field(default_factory=list)
+    list_id: str | None = None
+    expected_count: int | None = None
+    kind: ClassVar[str] = "playlist"
+
+
+def classify_link(link):
+    #("playlist", list_id) / ("video", video_id) from the URL shape alone, (None, None) if it needs yt-dlp
     try:
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(link, download=False)
-    except Exception as e:
-        logger.warning(f"video parse error {link}: {e}")
-        return {"title": None, "link": link, "duration_sec": None}
-    
-    if not info or info.get("_type") == "playlist":
-        return {"title": None, "link": link, "duration_sec": None}
-    
-    return {
-        "title": info.get("title"),
-        "link": info.get("webpage_url") or link,
-        "duration_sec": info.get("duration"),
-    }
+        url = urlparse(link.strip())
+    except ValueError:
+        return None, None
 
+    host = (url.hostname or "").lower()
+    query = parse_qs(url.query)
 
-def parse_playlist(link):
-    opts = {**BASE_YDL_OPTS, "extract_flat": "in_playlist", "lazy_playlist": True}
+    list_id = (query.get("list") or [None])[0]
+    if list_id:
+        return "playlist", list_id
+
+    if host.endswith("youtu.be"):
+        video_id = url.path.strip("/").split("/")[0]
+        return ("video", video_id) if video_id else (None, None)
 
+    if url.path == "/watch" and query.get("v"):
+        return "video", query["v"][0]
+
+    for prefix in _VIDEO_PATH_PREFIXES:
+        if url.path.startswith(prefix):
+            video_id = url.path[len(prefix):].split("/")[0]
+            if video_id:
+                return "video", video_id
+
+    return None, None
+
+
+#None only when yt-dlp has no extractor for the link (not a video or playlist); every other failure,
+#network errors included, raises ExtractionError
+def _extract_info(link, opts):
     try:
         with yt_dlp.YoutubeDL(opts) as ydl:
             info = ydl.extract_info(link, download=False)
+    except yt_dlp.utils.DownloadError as e:
+        if isinstance((e.exc_info or (None, None))[1], yt_dlp.utils.UnsupportedError):
+            return None
+        raise ExtractionError(f"extraction failed for {link}: {e}") from e
     except Exception as e:
-        logger.warning(f"playlist parse error {link}: {e}")
-        return {"playlist_link": link, "playlist_title": None, "full_duration": 0}, []
+        raise ExtractionError(f"extraction failed for {link}: {e}") from e
+    if not info:
+        #match_filter turned it down: private, deleted or members-only
+        raise ExtractionError(f"{link} is unavailable")
+    return info
+
+
+def _is_playlist_info(info):
+    t = info.get("_type")
+    return t in ("playlist", "multi_video", "compat_list") or ("entries" in info)
+
+
+def _video_result(link, info, video_id=None):
+    if not info or _is_playlist_info(info):
+        return VideoResult(link=link, video_id=video_id)
+
+    return VideoResult(
+        link=info.get("webpage_url") or link,
+        title=info.get("title"),
+        duration_sec=info.get("duration"),
+        video_id=info.get("id") or video_id,
+    )
+
+
+def _playlist_item(position, video):
+    if not video:
+        return None
+
+    avail = (video.get("availability") or "").lower()
+    title_l = (video.get("title") or "").lower()
+    if avail in {"private", "needs_auth", "subscriber_only", "premium_only"}:
+        return None
+    if title_l.startswith("[private") or title_l.startswith("[deleted]"):
+        return None
 
+    video_link = (
+        video.get("webpage_url") or
+        (f"https://www.youtube.com/watch?v={video.get('id')}" if video.get("id") else None)
+    )
+    if not video_link:
+        return None
+    #the id is what videos are shared by across playlists; an entry without one can't be stored
+    video_id = video.get("id") or classify_link(video_link)[1]
+    if not video_id:
+        return None
+
+    dur = video.get("duration")
+    return {
+        "position_num": position,
+        "video_id": video_id,
+        "title": video.get("title"),
+        "link": video_link,
+        "duration_sec": int(dur) if isinstance(dur, (int, float)) else None,
+    }
+
+
+def _playlist_result(link, info, list_id=None):
     if not info:
-        return {"playlist_link": link, "playlist_title": None, "full_duration": 0}, []
+        return PlaylistResult(link=link, list_id=list_id)
 
-    playlist_title = info.get("title")
     entries = info.get("entries") or []
 
     items = []
-    total_sec = 0
-
     for position, video in enumerate(entries, start=1):
-        if not video:
-            continue
-
-        avail = (video.get("availability") or "").lower()
-        title_l = (video.get("title") or "").lower()
-        if avail in {"private", "needs_auth", "subscriber_only", "premium_only"}:
-            continue
-        if title_l.startswith("[private") or title_l.startswith("[deleted]"):
-            continue
-
-        dur = video.get("duration")
-        if isinstance(dur, (int, float)):
-            total_sec += int(dur)
-
-        video_link = (
-            video.get("webpage_url") or
-            (f"https://www.youtube.com/watch?v={video.get('id')}" if video.get("id") else None)
+        item = _playlist_item(position, video)
+        if item:
+            items.append(item)
+
+    return PlaylistResult(
+        link=link,
+        title=info.get("title"),
+        full_duration=sum(i["duration_sec"] or 0 for i in items),
+        items=items,
+        list_id=info.get("id") or list_id,
+        expected_count=len(items),
+    )
+
+
+def iter_playlist(link):
+    #yields a PlaylistResult header (no items), then item dicts while yt-dlp pages through the list.
+    #process=False keeps "entries" a generator, so nothing is materialised up front
+    _, list_id = classify_link(link)
+    with yt_dlp.YoutubeDL(PLAYLIST_OPTS) as ydl:
+        try:
+            info = ydl.extract_info(link, download=False, process=False)
+            for _ in range(3):
+                if not info or info.get("_type") not in ("url", "url_transparent"):
+                    break
+                info = ydl.extract_info(info["url"], download=False, process=False, ie_key=info.get("ie_key"))
+        except Exception as e:
+            raise ExtractionError(f"playlist extraction failed for {link}: {e}") from e
+
+        if not info:
+            raise ExtractionError(f"playlist extraction returned nothing for {link}")
+
+        yield PlaylistResult(
+            link=link,
+            title=info.get("title"),
+            list_id=info.get("id") or list_id,
+            expected_count=info.get("playlist_count"),
         )
+        for position, video in enumerate(info.get("entries") or [], start=1):
+            item = _playlist_item(position, video)
+            if item:
+                yield item
 
-        items.append({
-            "position_num": position,
-            "title": video.get("title"),
-            "link": video_link,
-            "duration_sec": int(dur) if isinstance(dur, (int, float)) else None,
-        })
 
-    playlist_info = {
-        "playlist_link": link,
-        "playlist_title": playlist_title,
-        "full_duration": total_sec,
-    }
-    return playlist_info, items
+def _cached(kind, yt_id):
+    if not yt_id:
+        return None
+    data = get_metadata_cache().get(f"{kind}:{yt_id}")
+    if data is None:
+        return None
+    return VideoResult(**data) if kind == "video" else PlaylistResult(**data)
+
+
+def _store(result):
+    #failed extractions are not cached, the next request retries them
+    if result.kind == "video":
+        yt_id, ok = result.video_id, bool(result.title)
+    else:
+        yt_id, ok = result.list_id, bool(result.items)
+    if yt_id and ok:
+        get_metadata_cache().set(f"{result.kind}:{yt_id}", asdict(result))
+    return result
+
+
+def extract_video(link):
+    _, video_id = classify_link(link)
+    cached = _cached("video", video_id)
+    if cached:
+        return cached
+    info = _extract_info(link, VIDEO_OPTS)
+    if info is None:
+        raise ExtractionError(f"{link} is not a supported video")
+    return _store(_video_result(link, info, video_id))
+
+
+def cached_playlist(link):
+    _, list_id = classify_link(link)
+    cached = _cached("playlist", list_id)
+    #the playlist row stores the link this user sent
+    return replace(cached, link=link) if cached else None
+
+
+def extract_playlist(link):
+    cached = cached_playlist(link)
+    if cached:
+        return cached
+    _, list_id = classify_link(link)
+    return _store(_playlist_result(link, _extract_info(link, PLAYLIST_OPTS), list_id))
 
 
-    
+def refresh_playlist(list_id):
+    #flat listing straight from YouTube for the resync, never from the cache (but refreshes it).
+    #an empty result is an error: taking it at face value would mark every item removed
+    link = f"https://www.youtube.com/playlist?list={list_id}"
+    playlist = _playlist_result(link, _extract_info(link, PLAYLIST_OPTS), list_id)
+    if not playlist.items:
+        raise ExtractionError(f"playlist refresh returned no items for {list_id}")
+    return _store(playlist)
 
 
+def extract(link):
+    #one yt-dlp call per link: the URL shape picks the options, otherwise the result decides
+    kind, _ = classify_link(link)
+    if kind == "video":
+        return extract_video(link)
+    if kind == "playlist":
+        return extract_playlist(link)
 
+    #"in_playlist" only flattens playlist entries, a plain video is still fully resolved
+    info = _extract_info(link, PLAYLIST_OPTS)
+    if not info:
+        return None
+    if _is_playlist_info(info):
+        return _store(_playlist_result(link, info))
+    return _store(_video_result(link, info))
+
+
+def detect_youtube_type(link):
+    kind, _ = classify_link(link)
+    if kind:
+        return kind
 
+    try:
+        info = _extract_info(link, {**BASE_YDL_OPTS, "extract_flat": True})
+    except ExtractionError:
+        info = None
+    if not info:
+        return "parse_error"
+
+    if _is_playlist_info(info):
+        return "playlist"
+    if info.get("_type") in (None, "video", "url"):
+        return "video"
+    return "unknown"
+
+
+def parse_single_video(link):
+    video = extract_video(link)
+    return {
+        "title": video.title,
+        "link": video.link,
+        "duration_sec": video.duration_sec,
+    }
+
+
+def parse_playlist(link):
+    playlist = extract_playlist(link)
+    playlist_info = {
+        "playlist_link": playlist.link,
+        "playlist_title": playlist.title,
+        "full_duration": playlist.full_duration,
+    }
+    return playlist_info, playlist.items
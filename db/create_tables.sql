@@ -1,32 +1,442 @@
+-- 'removed': the video left the source playlist (see bot/playlist_sync.py), items only
+CREATE TYPE watch_status AS ENUM ('await', 'done', 'removed');
+
 CREATE TABLE users (
     id SERIAL PRIMARY KEY,
     telegram_id BIGINT NOT NULL UNIQUE,
+    username TEXT,
     created_at timestamptz NOT NULL DEFAULT now()
 );
 
+-- shared catalog: one row per YouTube video / playlist, whoever added it
+CREATE TABLE videos (
+    id SERIAL PRIMARY KEY,
+    youtube_id TEXT NOT NULL UNIQUE,
+    title TEXT,
+    link TEXT NOT NULL,
+    duration_sec INT,
+    fetched_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE playlists_catalog (
+    id SERIAL PRIMARY KEY,
+    youtube_list_id TEXT NOT NULL UNIQUE,
+    title TEXT,
+    full_duration INT,
+    item_count INT,
+    fetched_at timestamptz NOT NULL DEFAULT now(),
+    synced_at timestamptz,
+    sync_after timestamptz NOT NULL DEFAULT now(),
+    -- hash of the last extracted item list; an unchanged source costs one UPDATE
+    sync_fingerprint TEXT,
+    -- syncs in a row that found nothing to do, stretches the interval
+    sync_idle INT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE playlists_catalog_items (
+    catalog_id INT NOT NULL REFERENCES playlists_catalog(id) ON DELETE CASCADE,
+    position_num INT NOT NULL,
+    video_id INT NOT NULL REFERENCES videos(id),
+    PRIMARY KEY (catalog_id, position_num)
+);
+
 CREATE TABLE playlists (
     id SERIAL PRIMARY KEY,
     user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
     youtube_link TEXT NOT NULL,
     title TEXT,
-    full_duration INT,
-    status TEXT DEFAULT 'await',
+    full_duration INT NOT NULL DEFAULT 0,
+    status watch_status NOT NULL DEFAULT 'await',
+    -- maintained by the playlist_items_counters triggers below
+    done_cnt INT NOT NULL DEFAULT 0,
+    done_sec INT NOT NULL DEFAULT 0,
+    await_cnt INT NOT NULL DEFAULT 0,
+    await_sec INT NOT NULL DEFAULT 0,
+    catalog_id INT REFERENCES playlists_catalog(id) ON DELETE SET NULL,
+    -- per-user number shown in /playlists, set by playlists_assign_ordinal; NULL for the default playlist
+    ordinal INT,
+    -- set while a streamed import is still appending items (bot/playlist_service.py), with the ingest job doing it
+    importing BOOLEAN NOT NULL DEFAULT false,
+    import_job BIGINT,
     created_at timestamptz NOT NULL DEFAULT now(),
     last_sent timestamptz,
-    completed_at timestamptz
+    completed_at timestamptz,
+    UNIQUE (user_id, youtube_link),
+    UNIQUE (user_id, ordinal)
 );
 
 CREATE TABLE playlist_items (
     id SERIAL PRIMARY KEY,
     playlist_id BIGINT NOT NULL REFERENCES playlists(id) ON DELETE CASCADE,
     position_num INT,
-    title TEXT,
-    link TEXT NOT NULL,
-    duration_sec INT,
-    status TEXT DEFAULT 'await',
+    video_id INT NOT NULL REFERENCES videos(id),
+    -- copy of videos.duration_sec, kept in sync by videos_duration_sync
+    duration_sec INT NOT NULL DEFAULT 0,
+    status watch_status NOT NULL DEFAULT 'await',
     completed_at timestamptz
 );
 
 CREATE INDEX idx_playlists_user_id ON playlists(user_id);
+CREATE INDEX idx_playlists_user_await ON playlists(user_id, id) WHERE await_cnt > 0;
+CREATE INDEX idx_playlists_user_stale ON playlists(user_id, last_sent NULLS FIRST, id) WHERE await_cnt > 0;
 CREATE INDEX idx_items_playlist_id_pos ON playlist_items(playlist_id, position_num);
-CREATE INDEX idx_items_link ON playlist_items(link);
\ No newline at end of file
+CREATE INDEX idx_items_await_next ON playlist_items(playlist_id, position_num NULLS FIRST, id)
+    INCLUDE (video_id)
+    WHERE status = 'await';
+CREATE INDEX idx_items_video_id ON playlist_items(video_id);
+CREATE INDEX idx_catalog_items_video_id ON playlists_catalog_items(video_id);
+CREATE INDEX idx_playlists_catalog_sync ON playlists_catalog(sync_after, id);
+CREATE INDEX idx_playlists_catalog_id ON playlists(catalog_id) WHERE catalog_id IS NOT NULL;
+
+-- durable queue for link ingestion (queued -> running -> done / failed)
+CREATE TABLE ingest_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    chat_id BIGINT NOT NULL,
+    link TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 5,
+    run_after timestamptz NOT NULL DEFAULT now(),
+    locked_by TEXT,
+    locked_at timestamptz,
+    last_error TEXT,
+    result JSONB,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    finished_at timestamptz
+);
+
+CREATE INDEX idx_ingest_jobs_ready ON ingest_jobs(run_after, id) WHERE status = 'queued';
+CREATE INDEX idx_ingest_jobs_running ON ingest_jobs(locked_at) WHERE status = 'running';
+
+-- user_data (User, open /delete and /restart dialogs) kept across restarts, see bot/session_store.py
+CREATE TABLE user_sessions (
+    telegram_id BIGINT PRIMARY KEY,
+    data JSONB NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    -- lease of the replica handling one of the user's updates (shared sessions, bot/session_store.py)
+    locked_by TEXT,
+    locked_until timestamptz
+);
+
+-- opt-in daily delivery (/schedule), see bot/delivery.py
+CREATE TABLE delivery_schedules (
+    user_id BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    chat_id BIGINT NOT NULL,
+    -- local time of day, whole minutes
+    send_time TIME NOT NULL,
+    timezone TEXT NOT NULL DEFAULT 'UTC',
+    -- NULL: picked like /next without a number
+    playlist_id BIGINT REFERENCES playlists(id) ON DELETE SET NULL,
+    next_run_at timestamptz NOT NULL,
+    last_run_at timestamptz,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX idx_delivery_schedules_due ON delivery_schedules(next_run_at, user_id);
+
+-- numbers users see in /playlists: 1, 2, 3 ... per user, never renumbered after a delete.
+-- Deleting the highest number frees it for the next playlist.
+CREATE OR REPLACE FUNCTION playlists_assign_ordinal() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF NEW.youtube_link = 'default_playlist' THEN
+        RETURN NEW;
+    END IF;
+
+    -- serialises concurrent imports of the same user; NO KEY so FK checks on users don't wait
+    PERFORM 1 FROM users u WHERE u.id = NEW.user_id FOR NO KEY UPDATE;
+    SELECT COALESCE(MAX(p.ordinal), 0) + 1 INTO NEW.ordinal
+        FROM playlists p
+        WHERE p.user_id = NEW.user_id;
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER playlists_assign_ordinal BEFORE INSERT ON playlists
+    FOR EACH ROW EXECUTE FUNCTION playlists_assign_ordinal();
+
+-- picks one of the user's playlists that still has await items, without sorting them:
+--   random   -- uniform, OFFSET into idx_playlists_user_await
+--   stale    -- round robin, the one sent longest ago (idx_playlists_user_stale)
+--   weighted -- random, weighted by hours since last_sent (sorts the user's pending playlists)
+CREATE OR REPLACE FUNCTION pick_playlist(p_user_id BIGINT, p_mode TEXT DEFAULT 'random')
+RETURNS BIGINT
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_count INT;
+    v_playlist BIGINT;
+BEGIN
+    IF p_mode = 'stale' THEN
+        SELECT p.id INTO v_playlist
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.await_cnt > 0
+            ORDER BY p.last_sent NULLS FIRST, p.id
+            LIMIT 1;
+    ELSIF p_mode = 'weighted' THEN
+        -- exponential race: smallest Exp(1) / weight wins with probability weight / sum(weights)
+        SELECT p.id INTO v_playlist
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.await_cnt > 0
+            ORDER BY -ln(1 - random()) / (1 + EXTRACT(EPOCH FROM NOW() - COALESCE(p.last_sent, p.created_at)) / 3600)
+            LIMIT 1;
+    ELSE
+        SELECT count(*) INTO v_count
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.await_cnt > 0;
+
+        SELECT p.id INTO v_playlist
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.await_cnt > 0
+            ORDER BY p.id
+            OFFSET floor(random() * v_count)::INT
+            LIMIT 1;
+    END IF;
+
+    RETURN v_playlist;
+END;
+$$;
+
+-- /next in one round trip
+CREATE OR REPLACE FUNCTION advance_playlist(p_user_id BIGINT, p_playlist_id BIGINT DEFAULT NULL, p_number INT DEFAULT NULL,
+                                            p_pick TEXT DEFAULT 'random')
+RETURNS TABLE (playlist_id BIGINT, item_id INT, link TEXT, playlist_done BOOLEAN)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_playlist BIGINT := p_playlist_id;
+    v_item INT;
+    v_video INT;
+    v_done BOOLEAN;
+BEGIN
+    IF v_playlist IS NULL AND p_number IS NOT NULL THEN
+        SELECT p.id INTO v_playlist
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.ordinal = p_number;
+    END IF;
+
+    IF v_playlist IS NULL THEN
+        v_playlist := pick_playlist(p_user_id, p_pick);
+    END IF;
+
+    -- concurrent /next calls on one playlist queue up here; every statement below
+    -- takes a fresh snapshot, so the second caller sees the first one's update
+    PERFORM 1 FROM playlists p WHERE p.id = v_playlist AND p.user_id = p_user_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    UPDATE playlist_items pit
+        SET status = 'done',
+            completed_at = NOW()
+        WHERE pit.id = (
+            SELECT n.id
+                FROM playlist_items n
+                WHERE n.playlist_id = v_playlist
+                AND n.status = 'await'
+                ORDER BY n.position_num NULLS FIRST, n.id
+                LIMIT 1
+        )
+        RETURNING pit.id, pit.video_id INTO v_item, v_video;
+
+    IF v_item IS NULL THEN
+        RETURN QUERY SELECT v_playlist, NULL::INT, NULL::TEXT, false;
+        RETURN;
+    END IF;
+
+    -- the counters trigger has already run for the UPDATE above
+    SELECT p.await_cnt = 0 INTO v_done FROM playlists p WHERE p.id = v_playlist;
+
+    UPDATE playlists p
+        SET last_sent = NOW(),
+            status = CASE WHEN v_done THEN 'done' ELSE p.status END,
+            completed_at = CASE WHEN v_done THEN NOW() ELSE p.completed_at END
+        WHERE p.id = v_playlist;
+
+    RETURN QUERY SELECT v_playlist, v_item, v.link, v_done FROM videos v WHERE v.id = v_video;
+END;
+$$;
+
+-- playlists.done_cnt/done_sec/await_cnt/await_sec/full_duration follow playlist_items.
+-- Statement-level, so a 5000-item import is one UPDATE per playlist, not 5000.
+CREATE OR REPLACE FUNCTION playlist_items_counters() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    delta TEXT;
+BEGIN
+    delta := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT playlist_id, status, duration_sec, 1 AS sign FROM new_items'
+        WHEN 'DELETE' THEN 'SELECT playlist_id, status, duration_sec, -1 AS sign FROM old_items'
+        ELSE 'SELECT playlist_id, status, duration_sec, 1 AS sign FROM new_items
+              UNION ALL
+              SELECT playlist_id, status, duration_sec, -1 AS sign FROM old_items'
+    END;
+
+    EXECUTE format($sql$
+        UPDATE playlists p
+            SET done_cnt = p.done_cnt + d.done_cnt,
+                done_sec = p.done_sec + d.done_sec,
+                await_cnt = p.await_cnt + d.await_cnt,
+                await_sec = p.await_sec + d.await_sec,
+                full_duration = p.full_duration + d.done_sec + d.await_sec
+            FROM (
+                SELECT x.playlist_id,
+                       COALESCE(SUM(x.sign) FILTER (WHERE x.status = 'done'), 0) AS done_cnt,
+                       COALESCE(SUM(x.sign * x.duration_sec) FILTER (WHERE x.status = 'done'), 0) AS done_sec,
+                       COALESCE(SUM(x.sign) FILTER (WHERE x.status = 'await'), 0) AS await_cnt,
+                       COALESCE(SUM(x.sign * x.duration_sec) FILTER (WHERE x.status = 'await'), 0) AS await_sec
+                    FROM (%s) x
+                    GROUP BY x.playlist_id
+            ) d
+            WHERE p.id = d.playlist_id
+            AND (d.done_cnt, d.done_sec, d.await_cnt, d.await_sec) <> (0, 0, 0, 0)
+        $sql$, delta);
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER playlist_items_counters_ins AFTER INSERT ON playlist_items
+    REFERENCING NEW TABLE AS new_items
+    FOR EACH STATEMENT EXECUTE FUNCTION playlist_items_counters();
+CREATE TRIGGER playlist_items_counters_upd AFTER UPDATE ON playlist_items
+    REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+    FOR EACH STATEMENT EXECUTE FUNCTION playlist_items_counters();
+CREATE TRIGGER playlist_items_counters_del AFTER DELETE ON playlist_items
+    REFERENCING OLD TABLE AS old_items
+    FOR EACH STATEMENT EXECUTE FUNCTION playlist_items_counters();
+
+-- a corrected video duration is copied to every item pointing at it; the item trigger does the rest.
+-- Items written with the new duration in the same statement already match and are skipped.
+-- The playlists involved are locked first, in id order: the order advance_playlist() and deliver_due()
+-- use, so a sync touching other users' playlists can't deadlock with their /next.
+CREATE OR REPLACE FUNCTION videos_duration_sync() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM 1 FROM playlists p
+        WHERE p.id IN (
+            SELECT pit.playlist_id
+                FROM playlist_items pit
+                JOIN new_videos n ON n.id = pit.video_id
+                JOIN old_videos o ON o.id = n.id
+                WHERE n.duration_sec IS DISTINCT FROM o.duration_sec
+                AND pit.duration_sec <> COALESCE(n.duration_sec, 0))
+        ORDER BY p.id
+        FOR UPDATE;
+
+    UPDATE playlist_items pit
+        SET duration_sec = COALESCE(n.duration_sec, 0)
+        FROM new_videos n
+        JOIN old_videos o ON o.id = n.id
+        WHERE pit.video_id = n.id
+        AND n.duration_sec IS DISTINCT FROM o.duration_sec
+        AND pit.duration_sec <> COALESCE(n.duration_sec, 0);
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER videos_duration_sync AFTER UPDATE ON videos
+    REFERENCING OLD TABLE AS old_videos NEW TABLE AS new_videos
+    FOR EACH STATEMENT EXECUTE FUNCTION videos_duration_sync();
+
+-- first p_time (local to p_tz) strictly after p_after; DST gaps and overlaps are resolved by AT TIME ZONE
+CREATE OR REPLACE FUNCTION next_delivery_at(p_time TIME, p_tz TEXT, p_after timestamptz DEFAULT NOW())
+RETURNS timestamptz
+LANGUAGE sql STABLE AS $$
+    SELECT CASE
+               WHEN today.t > p_after THEN today.t
+               ELSE (((p_after AT TIME ZONE p_tz)::date + 1) + p_time) AT TIME ZONE p_tz
+           END
+        FROM (SELECT ((p_after AT TIME ZONE p_tz)::date + p_time) AT TIME ZONE p_tz AS t) today;
+$$;
+
+-- one bucket of due schedules: claims up to p_limit of them (moving each to its next day),
+-- takes the next video of every chosen playlist and closes the playlists that ran out.
+-- Same steps as advance_playlist(), one statement per step for the whole bucket.
+CREATE OR REPLACE FUNCTION deliver_due(p_limit INT, p_pick TEXT DEFAULT 'random')
+RETURNS TABLE (user_id BIGINT, chat_id BIGINT, playlist_id BIGINT, item_id INT, link TEXT, playlist_done BOOLEAN)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_users BIGINT[];
+    v_chats BIGINT[];
+    v_playlists BIGINT[];
+    v_items INT[];
+BEGIN
+    WITH due AS (
+        SELECT s.user_id
+            FROM delivery_schedules s
+            WHERE s.next_run_at <= NOW()
+            ORDER BY s.next_run_at, s.user_id
+            FOR UPDATE SKIP LOCKED
+            LIMIT p_limit
+    ), claimed AS (
+        UPDATE delivery_schedules s
+            SET next_run_at = next_delivery_at(s.send_time, s.timezone),
+                last_run_at = NOW()
+            FROM due d
+            WHERE s.user_id = d.user_id
+            RETURNING s.user_id, s.chat_id, s.playlist_id
+    )
+    SELECT array_agg(c.user_id), array_agg(c.chat_id),
+           array_agg(COALESCE(
+               (SELECT p.id FROM playlists p WHERE p.id = c.playlist_id AND p.user_id = c.user_id AND p.await_cnt > 0),
+               pick_playlist(c.user_id, p_pick)))
+        INTO v_users, v_chats, v_playlists
+        FROM claimed c;
+
+    IF v_users IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- the lock /next takes, in id order; the statements below see what concurrent /next calls did
+    PERFORM 1 FROM playlists p WHERE p.id = ANY(v_playlists) ORDER BY p.id FOR UPDATE;
+
+    WITH picked AS (
+        SELECT n.id
+            FROM unnest(v_playlists) AS b(playlist_id)
+            CROSS JOIN LATERAL (
+                SELECT pit.id
+                    FROM playlist_items pit
+                    WHERE pit.playlist_id = b.playlist_id
+                    AND pit.status = 'await'
+                    ORDER BY pit.position_num NULLS FIRST, pit.id
+                    LIMIT 1
+            ) n
+    ), sent AS (
+        UPDATE playlist_items pit
+            SET status = 'done',
+                completed_at = NOW()
+            FROM picked
+            WHERE pit.id = picked.id
+            AND pit.status = 'await'
+            RETURNING pit.id
+    )
+    SELECT array_agg(sent.id) INTO v_items FROM sent;
+
+    IF v_items IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- the counters triggers have run for the UPDATE above
+    UPDATE playlists p
+        SET last_sent = NOW(),
+            status = CASE WHEN p.await_cnt = 0 THEN 'done' ELSE p.status END,
+            completed_at = CASE WHEN p.await_cnt = 0 THEN NOW() ELSE p.completed_at END
+        FROM playlist_items pit
+        WHERE pit.id = ANY(v_items)
+        AND p.id = pit.playlist_id;
+
+    RETURN QUERY
+        SELECT p.user_id, u.chat_id, p.id, pit.id, v.link, p.await_cnt = 0
+            FROM unnest(v_items) AS i(id)
+            JOIN playlist_items pit ON pit.id = i.id
+            JOIN playlists p ON p.id = pit.playlist_id
+            JOIN videos v ON v.id = pit.video_id
+            JOIN unnest(v_users, v_chats) AS u(user_id, chat_id) ON u.user_id = p.user_id;
+END;
+$$;
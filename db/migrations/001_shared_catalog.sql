@@ -0,0 +1,114 @@
+-- Moves per-user copies of video metadata into a shared catalog.
+-- playlist_items keeps only the per-user state and references videos(id).
+BEGIN;
+
+-- columns/constraints the code already relies on but older create_tables.sql lacked
+ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS playlists_user_id_youtube_link_key ON playlists(user_id, youtube_link);
+
+CREATE TABLE videos (
+    id SERIAL PRIMARY KEY,
+    youtube_id TEXT NOT NULL UNIQUE,
+    title TEXT,
+    link TEXT NOT NULL,
+    duration_sec INT,
+    fetched_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE playlists_catalog (
+    id SERIAL PRIMARY KEY,
+    youtube_list_id TEXT NOT NULL UNIQUE,
+    title TEXT,
+    full_duration INT,
+    item_count INT,
+    fetched_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE playlists_catalog_items (
+    catalog_id INT NOT NULL REFERENCES playlists_catalog(id) ON DELETE CASCADE,
+    position_num INT NOT NULL,
+    video_id INT NOT NULL REFERENCES videos(id),
+    PRIMARY KEY (catalog_id, position_num)
+);
+
+ALTER TABLE playlists ADD COLUMN catalog_id INT REFERENCES playlists_catalog(id) ON DELETE SET NULL;
+ALTER TABLE playlist_items ADD COLUMN video_id INT REFERENCES videos(id);
+
+-- YouTube id from watch?v= / youtu.be / shorts / live / embed links; NULL when the link has none
+CREATE TEMP TABLE item_keys ON COMMIT DROP AS
+    SELECT pit.id AS item_id,
+           COALESCE(
+               substring(pit.link from '[?&]v=([A-Za-z0-9_-]{11})'),
+               substring(pit.link from 'youtu\.be/([A-Za-z0-9_-]{11})'),
+               substring(pit.link from '/(?:shorts|live|embed|v)/([A-Za-z0-9_-]{11})')
+           ) AS youtube_id
+        FROM playlist_items pit;
+
+-- a link is never a youtube_id: items without one are set aside in unmatched_playlist_items, not migrated
+CREATE TABLE unmatched_playlist_items AS
+    SELECT pit.*
+        FROM playlist_items pit
+        JOIN item_keys k ON k.item_id = pit.id
+        WHERE k.youtube_id IS NULL;
+
+DO $$
+DECLARE
+    skipped INT;
+BEGIN
+    DELETE FROM playlist_items pit
+        USING item_keys k
+        WHERE k.item_id = pit.id
+        AND k.youtube_id IS NULL;
+    GET DIAGNOSTICS skipped = ROW_COUNT;
+    IF skipped > 0 THEN
+        RAISE NOTICE '% playlist items have no YouTube id in their link, moved to unmatched_playlist_items', skipped;
+    END IF;
+END $$;
+
+INSERT INTO videos (youtube_id, title, link, duration_sec)
+SELECT DISTINCT ON (k.youtube_id) k.youtube_id, pit.title, pit.link, pit.duration_sec
+    FROM item_keys k
+    JOIN playlist_items pit ON pit.id = k.item_id
+    ORDER BY k.youtube_id, (pit.title IS NULL), pit.id DESC;
+
+UPDATE playlist_items pit
+    SET video_id = v.id
+    FROM item_keys k
+    JOIN videos v ON v.youtube_id = k.youtube_id
+    WHERE k.item_id = pit.id;
+
+-- seed the playlist catalog from the newest copy of every list= playlist
+CREATE TEMP TABLE catalog_sources ON COMMIT DROP AS
+    SELECT DISTINCT ON (list_id) list_id, id AS playlist_id, title, full_duration
+        FROM (
+            SELECT substring(p.youtube_link from '[?&]list=([A-Za-z0-9_-]+)') AS list_id, p.*
+                FROM playlists p
+        ) src
+        WHERE list_id IS NOT NULL
+        ORDER BY list_id, id DESC;
+
+INSERT INTO playlists_catalog (youtube_list_id, title, full_duration, item_count)
+SELECT cs.list_id, cs.title, cs.full_duration,
+       (SELECT count(*) FROM playlist_items pit WHERE pit.playlist_id = cs.playlist_id)
+    FROM catalog_sources cs;
+
+INSERT INTO playlists_catalog_items (catalog_id, position_num, video_id)
+SELECT DISTINCT ON (c.id, pit.position_num) c.id, pit.position_num, pit.video_id
+    FROM catalog_sources cs
+    JOIN playlists_catalog c ON c.youtube_list_id = cs.list_id
+    JOIN playlist_items pit ON pit.playlist_id = cs.playlist_id
+    WHERE pit.position_num IS NOT NULL
+    ORDER BY c.id, pit.position_num, pit.id;
+
+UPDATE playlists p
+    SET catalog_id = c.id
+    FROM playlists_catalog c
+    WHERE c.youtube_list_id = substring(p.youtube_link from '[?&]list=([A-Za-z0-9_-]+)');
+
+ALTER TABLE playlist_items ALTER COLUMN video_id SET NOT NULL;
+ALTER TABLE playlist_items DROP COLUMN title, DROP COLUMN link, DROP COLUMN duration_sec;
+
+CREATE INDEX idx_items_video_id ON playlist_items(video_id);
+CREATE INDEX idx_catalog_items_video_id ON playlists_catalog_items(video_id);
+
+COMMIT;
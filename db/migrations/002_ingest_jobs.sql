@@ -0,0 +1,24 @@
+-- Durable queue for link ingestion, claimed by workers with FOR UPDATE SKIP LOCKED.
+BEGIN;
+
+CREATE TABLE ingest_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    chat_id BIGINT NOT NULL,
+    link TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 5,
+    run_after timestamptz NOT NULL DEFAULT now(),
+    locked_by TEXT,
+    locked_at timestamptz,
+    last_error TEXT,
+    result JSONB,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    finished_at timestamptz
+);
+
+CREATE INDEX idx_ingest_jobs_ready ON ingest_jobs(run_after, id) WHERE status = 'queued';
+CREATE INDEX idx_ingest_jobs_running ON ingest_jobs(locked_at) WHERE status = 'running';
+
+COMMIT;
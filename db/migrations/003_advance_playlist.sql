@@ -0,0 +1,82 @@
+-- /next in one round trip: resolve the playlist, take the next item, mark it done,
+-- bump last_sent and close the playlist when nothing is left.
+BEGIN;
+
+CREATE OR REPLACE FUNCTION advance_playlist(p_user_id BIGINT, p_playlist_id BIGINT DEFAULT NULL, p_number INT DEFAULT NULL)
+RETURNS TABLE (playlist_id BIGINT, item_id INT, link TEXT, playlist_done BOOLEAN)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_playlist BIGINT := p_playlist_id;
+    v_item INT;
+    v_video INT;
+    v_done BOOLEAN;
+BEGIN
+    IF v_playlist IS NULL AND p_number IS NOT NULL THEN
+        SELECT o.id INTO v_playlist
+            FROM (
+                SELECT p.id, ROW_NUMBER() OVER (ORDER BY p.id) AS num
+                    FROM playlists p
+                    WHERE p.user_id = p_user_id
+                    AND p.youtube_link <> 'default_playlist'
+            ) o
+            WHERE o.num = p_number;
+    END IF;
+
+    IF v_playlist IS NULL THEN
+        SELECT p.id INTO v_playlist
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND EXISTS (
+                SELECT 1
+                FROM playlist_items pit
+                WHERE pit.playlist_id = p.id
+                AND COALESCE(TRIM(LOWER(pit.status)), 'await') = 'await'
+            )
+            ORDER BY random()
+            LIMIT 1;
+    END IF;
+
+    -- concurrent /next calls on one playlist queue up here; every statement below
+    -- takes a fresh snapshot, so the second caller sees the first one's update
+    PERFORM 1 FROM playlists p WHERE p.id = v_playlist AND p.user_id = p_user_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    UPDATE playlist_items pit
+        SET status = 'done',
+            completed_at = NOW()
+        WHERE pit.id = (
+            SELECT n.id
+                FROM playlist_items n
+                WHERE n.playlist_id = v_playlist
+                AND COALESCE(TRIM(LOWER(n.status)), 'await') = 'await'
+                ORDER BY n.position_num NULLS FIRST, n.id
+                LIMIT 1
+        )
+        RETURNING pit.id, pit.video_id INTO v_item, v_video;
+
+    IF v_item IS NULL THEN
+        RETURN QUERY SELECT v_playlist, NULL::INT, NULL::TEXT, false;
+        RETURN;
+    END IF;
+
+    v_done := NOT EXISTS (
+        SELECT 1
+        FROM playlist_items pit
+        WHERE pit.playlist_id = v_playlist
+        AND COALESCE(TRIM(LOWER(pit.status)), 'await') = 'await'
+    );
+
+    UPDATE playlists p
+        SET last_sent = NOW(),
+            status = CASE WHEN v_done THEN 'done' ELSE p.status END,
+            completed_at = CASE WHEN v_done THEN NOW() ELSE p.completed_at END
+        WHERE p.id = v_playlist;
+
+    RETURN QUERY SELECT v_playlist, v_item, v.link, v_done FROM videos v WHERE v.id = v_video;
+END;
+$$;
+
+COMMIT;
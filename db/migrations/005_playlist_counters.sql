@@ -0,0 +1,104 @@
+-- Per-playlist counters (done_cnt, done_sec, await_cnt, await_sec, full_duration)
+-- kept exact by triggers, so /stat and /playlists read playlists rows only.
+-- playlist_items.duration_sec is a copy of videos.duration_sec; it lets the
+-- triggers work from transition tables without joining videos.
+BEGIN;
+
+ALTER TABLE playlist_items ADD COLUMN duration_sec INT NOT NULL DEFAULT 0;
+
+UPDATE playlist_items pit
+    SET duration_sec = v.duration_sec
+    FROM videos v
+    WHERE v.id = pit.video_id
+    AND v.duration_sec IS NOT NULL;
+
+ALTER TABLE playlists
+    ADD COLUMN done_cnt INT NOT NULL DEFAULT 0,
+    ADD COLUMN done_sec INT NOT NULL DEFAULT 0,
+    ADD COLUMN await_cnt INT NOT NULL DEFAULT 0,
+    ADD COLUMN await_sec INT NOT NULL DEFAULT 0;
+
+UPDATE playlists p
+    SET (done_cnt, done_sec, await_cnt, await_sec) = (
+        SELECT count(*) FILTER (WHERE pit.status = 'done'),
+               COALESCE(SUM(pit.duration_sec) FILTER (WHERE pit.status = 'done'), 0),
+               count(*) FILTER (WHERE pit.status = 'await'),
+               COALESCE(SUM(pit.duration_sec) FILTER (WHERE pit.status = 'await'), 0)
+            FROM playlist_items pit
+            WHERE pit.playlist_id = p.id
+    );
+
+UPDATE playlists SET full_duration = done_sec + await_sec;
+ALTER TABLE playlists
+    ALTER COLUMN full_duration SET DEFAULT 0,
+    ALTER COLUMN full_duration SET NOT NULL;
+
+-- playlists.done_cnt/done_sec/await_cnt/await_sec/full_duration follow playlist_items.
+-- Statement-level, so a 5000-item import is one UPDATE per playlist, not 5000.
+CREATE OR REPLACE FUNCTION playlist_items_counters() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    delta TEXT;
+BEGIN
+    delta := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT playlist_id, status, duration_sec, 1 AS sign FROM new_items'
+        WHEN 'DELETE' THEN 'SELECT playlist_id, status, duration_sec, -1 AS sign FROM old_items'
+        ELSE 'SELECT playlist_id, status, duration_sec, 1 AS sign FROM new_items
+              UNION ALL
+              SELECT playlist_id, status, duration_sec, -1 AS sign FROM old_items'
+    END;
+
+    EXECUTE format($sql$
+        UPDATE playlists p
+            SET done_cnt = p.done_cnt + d.done_cnt,
+                done_sec = p.done_sec + d.done_sec,
+                await_cnt = p.await_cnt + d.await_cnt,
+                await_sec = p.await_sec + d.await_sec,
+                full_duration = p.full_duration + d.done_sec + d.await_sec
+            FROM (
+                SELECT x.playlist_id,
+                       COALESCE(SUM(x.sign) FILTER (WHERE x.status = 'done'), 0) AS done_cnt,
+                       COALESCE(SUM(x.sign * x.duration_sec) FILTER (WHERE x.status = 'done'), 0) AS done_sec,
+                       COALESCE(SUM(x.sign) FILTER (WHERE x.status = 'await'), 0) AS await_cnt,
+                       COALESCE(SUM(x.sign * x.duration_sec) FILTER (WHERE x.status = 'await'), 0) AS await_sec
+                    FROM (%s) x
+                    GROUP BY x.playlist_id
+            ) d
+            WHERE p.id = d.playlist_id
+            AND (d.done_cnt, d.done_sec, d.await_cnt, d.await_sec) <> (0, 0, 0, 0)
+        $sql$, delta);
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER playlist_items_counters_ins AFTER INSERT ON playlist_items
+    REFERENCING NEW TABLE AS new_items
+    FOR EACH STATEMENT EXECUTE FUNCTION playlist_items_counters();
+CREATE TRIGGER playlist_items_counters_upd AFTER UPDATE ON playlist_items
+    REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+    FOR EACH STATEMENT EXECUTE FUNCTION playlist_items_counters();
+CREATE TRIGGER playlist_items_counters_del AFTER DELETE ON playlist_items
+    REFERENCING OLD TABLE AS old_items
+    FOR EACH STATEMENT EXECUTE FUNCTION playlist_items_counters();
+
+-- a corrected video duration is copied to every item pointing at it; the item trigger does the rest.
+-- Items written with the new duration in the same statement already match and are skipped.
+CREATE OR REPLACE FUNCTION videos_duration_sync() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE playlist_items pit
+        SET duration_sec = COALESCE(n.duration_sec, 0)
+        FROM new_videos n
+        JOIN old_videos o ON o.id = n.id
+        WHERE pit.video_id = n.id
+        AND n.duration_sec IS DISTINCT FROM o.duration_sec
+        AND pit.duration_sec <> COALESCE(n.duration_sec, 0);
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER videos_duration_sync AFTER UPDATE ON videos
+    REFERENCING OLD TABLE AS old_videos NEW TABLE AS new_videos
+    FOR EACH STATEMENT EXECUTE FUNCTION videos_duration_sync();
+
+COMMIT;
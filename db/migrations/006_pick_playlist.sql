@@ -0,0 +1,120 @@
+-- /next without a number picks a playlist through the await_cnt counter
+-- (005_playlist_counters.sql) and a partial index instead of ORDER BY random()
+-- over an EXISTS probe per playlist.
+BEGIN;
+
+CREATE INDEX idx_playlists_user_await ON playlists(user_id, id) WHERE await_cnt > 0;
+CREATE INDEX idx_playlists_user_stale ON playlists(user_id, last_sent NULLS FIRST, id) WHERE await_cnt > 0;
+
+-- picks one of the user's playlists that still has await items, without sorting them:
+--   random   -- uniform, OFFSET into idx_playlists_user_await
+--   stale    -- round robin, the one sent longest ago (idx_playlists_user_stale)
+--   weighted -- random, weighted by hours since last_sent (sorts the user's pending playlists)
+CREATE OR REPLACE FUNCTION pick_playlist(p_user_id BIGINT, p_mode TEXT DEFAULT 'random')
+RETURNS BIGINT
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_count INT;
+    v_playlist BIGINT;
+BEGIN
+    IF p_mode = 'stale' THEN
+        SELECT p.id INTO v_playlist
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.await_cnt > 0
+            ORDER BY p.last_sent NULLS FIRST, p.id
+            LIMIT 1;
+    ELSIF p_mode = 'weighted' THEN
+        -- exponential race: smallest Exp(1) / weight wins with probability weight / sum(weights)
+        SELECT p.id INTO v_playlist
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.await_cnt > 0
+            ORDER BY -ln(1 - random()) / (1 + EXTRACT(EPOCH FROM NOW() - COALESCE(p.last_sent, p.created_at)) / 3600)
+            LIMIT 1;
+    ELSE
+        SELECT count(*) INTO v_count
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.await_cnt > 0;
+
+        SELECT p.id INTO v_playlist
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.await_cnt > 0
+            ORDER BY p.id
+            OFFSET floor(random() * v_count)::INT
+            LIMIT 1;
+    END IF;
+
+    RETURN v_playlist;
+END;
+$$;
+
+DROP FUNCTION advance_playlist(BIGINT, BIGINT, INT);
+
+CREATE OR REPLACE FUNCTION advance_playlist(p_user_id BIGINT, p_playlist_id BIGINT DEFAULT NULL, p_number INT DEFAULT NULL,
+                                            p_pick TEXT DEFAULT 'random')
+RETURNS TABLE (playlist_id BIGINT, item_id INT, link TEXT, playlist_done BOOLEAN)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_playlist BIGINT := p_playlist_id;
+    v_item INT;
+    v_video INT;
+    v_done BOOLEAN;
+BEGIN
+    IF v_playlist IS NULL AND p_number IS NOT NULL THEN
+        SELECT o.id INTO v_playlist
+            FROM (
+                SELECT p.id, ROW_NUMBER() OVER (ORDER BY p.id) AS num
+                    FROM playlists p
+                    WHERE p.user_id = p_user_id
+                    AND p.youtube_link <> 'default_playlist'
+            ) o
+            WHERE o.num = p_number;
+    END IF;
+
+    IF v_playlist IS NULL THEN
+        v_playlist := pick_playlist(p_user_id, p_pick);
+    END IF;
+
+    -- concurrent /next calls on one playlist queue up here; every statement below
+    -- takes a fresh snapshot, so the second caller sees the first one's update
+    PERFORM 1 FROM playlists p WHERE p.id = v_playlist AND p.user_id = p_user_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    UPDATE playlist_items pit
+        SET status = 'done',
+            completed_at = NOW()
+        WHERE pit.id = (
+            SELECT n.id
+                FROM playlist_items n
+                WHERE n.playlist_id = v_playlist
+                AND n.status = 'await'
+                ORDER BY n.position_num NULLS FIRST, n.id
+                LIMIT 1
+        )
+        RETURNING pit.id, pit.video_id INTO v_item, v_video;
+
+    IF v_item IS NULL THEN
+        RETURN QUERY SELECT v_playlist, NULL::INT, NULL::TEXT, false;
+        RETURN;
+    END IF;
+
+    -- the counters trigger has already run for the UPDATE above
+    SELECT p.await_cnt = 0 INTO v_done FROM playlists p WHERE p.id = v_playlist;
+
+    UPDATE playlists p
+        SET last_sent = NOW(),
+            status = CASE WHEN v_done THEN 'done' ELSE p.status END,
+            completed_at = CASE WHEN v_done THEN NOW() ELSE p.completed_at END
+        WHERE p.id = v_playlist;
+
+    RETURN QUERY SELECT v_playlist, v_item, v.link, v_done FROM videos v WHERE v.id = v_video;
+END;
+$$;
+
+COMMIT;
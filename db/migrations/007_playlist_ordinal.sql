@@ -0,0 +1,101 @@
+-- Persisted per-user playlist numbers: /next N, /delete N and /restart N become
+-- a point lookup on (user_id, ordinal) instead of ROW_NUMBER() over all of the
+-- user's playlists, and numbers no longer shift after a delete.
+BEGIN;
+
+ALTER TABLE playlists ADD COLUMN ordinal INT;
+
+-- keep today's numbering so nobody's numbers change on deploy
+UPDATE playlists p
+    SET ordinal = o.num
+    FROM (
+        SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id) AS num
+            FROM playlists
+            WHERE youtube_link <> 'default_playlist'
+    ) o
+    WHERE o.id = p.id;
+
+ALTER TABLE playlists ADD CONSTRAINT playlists_user_id_ordinal_key UNIQUE (user_id, ordinal);
+
+-- numbers users see in /playlists: 1, 2, 3 ... per user, never renumbered after a delete.
+-- Deleting the highest number frees it for the next playlist.
+CREATE OR REPLACE FUNCTION playlists_assign_ordinal() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF NEW.youtube_link = 'default_playlist' THEN
+        RETURN NEW;
+    END IF;
+
+    -- serialises concurrent imports of the same user; NO KEY so FK checks on users don't wait
+    PERFORM 1 FROM users u WHERE u.id = NEW.user_id FOR NO KEY UPDATE;
+    SELECT COALESCE(MAX(p.ordinal), 0) + 1 INTO NEW.ordinal
+        FROM playlists p
+        WHERE p.user_id = NEW.user_id;
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER playlists_assign_ordinal BEFORE INSERT ON playlists
+    FOR EACH ROW EXECUTE FUNCTION playlists_assign_ordinal();
+
+CREATE OR REPLACE FUNCTION advance_playlist(p_user_id BIGINT, p_playlist_id BIGINT DEFAULT NULL, p_number INT DEFAULT NULL,
+                                            p_pick TEXT DEFAULT 'random')
+RETURNS TABLE (playlist_id BIGINT, item_id INT, link TEXT, playlist_done BOOLEAN)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_playlist BIGINT := p_playlist_id;
+    v_item INT;
+    v_video INT;
+    v_done BOOLEAN;
+BEGIN
+    IF v_playlist IS NULL AND p_number IS NOT NULL THEN
+        SELECT p.id INTO v_playlist
+            FROM playlists p
+            WHERE p.user_id = p_user_id
+            AND p.ordinal = p_number;
+    END IF;
+
+    IF v_playlist IS NULL THEN
+        v_playlist := pick_playlist(p_user_id, p_pick);
+    END IF;
+
+    -- concurrent /next calls on one playlist queue up here; every statement below
+    -- takes a fresh snapshot, so the second caller sees the first one's update
+    PERFORM 1 FROM playlists p WHERE p.id = v_playlist AND p.user_id = p_user_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    UPDATE playlist_items pit
+        SET status = 'done',
+            completed_at = NOW()
+        WHERE pit.id = (
+            SELECT n.id
+                FROM playlist_items n
+                WHERE n.playlist_id = v_playlist
+                AND n.status = 'await'
+                ORDER BY n.position_num NULLS FIRST, n.id
+                LIMIT 1
+        )
+        RETURNING pit.id, pit.video_id INTO v_item, v_video;
+
+    IF v_item IS NULL THEN
+        RETURN QUERY SELECT v_playlist, NULL::INT, NULL::TEXT, false;
+        RETURN;
+    END IF;
+
+    -- the counters trigger has already run for the UPDATE above
+    SELECT p.await_cnt = 0 INTO v_done FROM playlists p WHERE p.id = v_playlist;
+
+    UPDATE playlists p
+        SET last_sent = NOW(),
+            status = CASE WHEN v_done THEN 'done' ELSE p.status END,
+            completed_at = CASE WHEN v_done THEN NOW() ELSE p.completed_at END
+        WHERE p.id = v_playlist;
+
+    RETURN QUERY SELECT v_playlist, v_item, v.link, v_done FROM videos v WHERE v.id = v_video;
+END;
+$$;
+
+COMMIT;
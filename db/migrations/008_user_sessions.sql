@@ -0,0 +1,10 @@
+-- Persistent per-user conversation state, loaded lazily by the bot on first contact.
+BEGIN;
+
+CREATE TABLE user_sessions (
+    telegram_id BIGINT PRIMARY KEY,
+    data JSONB NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+COMMIT;
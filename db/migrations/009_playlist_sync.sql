@@ -0,0 +1,24 @@
+-- Catalog playlists are re-extracted periodically (bot/playlist_sync.py) and every
+-- subscriber's items are brought in line with the source: new videos appended,
+-- videos gone from the source marked 'removed' (skipped by /next, not counted
+-- anywhere), positions and durations corrected.
+-- ADD VALUE can't run inside a transaction block before PostgreSQL 12, so it goes first.
+ALTER TYPE watch_status ADD VALUE IF NOT EXISTS 'removed';
+
+BEGIN;
+
+ALTER TABLE playlists_catalog
+    ADD COLUMN synced_at timestamptz,
+    ADD COLUMN sync_after timestamptz NOT NULL DEFAULT now(),
+    -- hash of the last extracted item list; an unchanged source costs one UPDATE
+    ADD COLUMN sync_fingerprint TEXT,
+    -- syncs in a row that found nothing to do, stretches the interval
+    ADD COLUMN sync_idle INT NOT NULL DEFAULT 0;
+
+-- spread the existing catalog over a day instead of syncing all of it at once
+UPDATE playlists_catalog SET sync_after = now() + random() * interval '1 day';
+
+CREATE INDEX idx_playlists_catalog_sync ON playlists_catalog(sync_after, id);
+CREATE INDEX idx_playlists_catalog_id ON playlists(catalog_id) WHERE catalog_id IS NOT NULL;
+
+COMMIT;
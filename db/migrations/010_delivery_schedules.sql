@@ -0,0 +1,118 @@
+-- Opt-in daily delivery (/schedule): one row per user, due rows are claimed a
+-- minute bucket at a time by bot/delivery.py and advanced with deliver_due().
+BEGIN;
+
+CREATE TABLE delivery_schedules (
+    user_id BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    chat_id BIGINT NOT NULL,
+    -- local time of day, whole minutes
+    send_time TIME NOT NULL,
+    timezone TEXT NOT NULL DEFAULT 'UTC',
+    -- NULL: picked like /next without a number
+    playlist_id BIGINT REFERENCES playlists(id) ON DELETE SET NULL,
+    next_run_at timestamptz NOT NULL,
+    last_run_at timestamptz,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX idx_delivery_schedules_due ON delivery_schedules(next_run_at, user_id);
+
+-- first p_time (local to p_tz) strictly after p_after; DST gaps and overlaps are resolved by AT TIME ZONE
+CREATE OR REPLACE FUNCTION next_delivery_at(p_time TIME, p_tz TEXT, p_after timestamptz DEFAULT NOW())
+RETURNS timestamptz
+LANGUAGE sql STABLE AS $$
+    SELECT CASE
+               WHEN today.t > p_after THEN today.t
+               ELSE (((p_after AT TIME ZONE p_tz)::date + 1) + p_time) AT TIME ZONE p_tz
+           END
+        FROM (SELECT ((p_after AT TIME ZONE p_tz)::date + p_time) AT TIME ZONE p_tz AS t) today;
+$$;
+
+-- one bucket of due schedules: claims up to p_limit of them (moving each to its next day),
+-- takes the next video of every chosen playlist and closes the playlists that ran out.
+-- Same steps as advance_playlist(), one statement per step for the whole bucket.
+CREATE OR REPLACE FUNCTION deliver_due(p_limit INT, p_pick TEXT DEFAULT 'random')
+RETURNS TABLE (user_id BIGINT, chat_id BIGINT, playlist_id BIGINT, item_id INT, link TEXT, playlist_done BOOLEAN)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_users BIGINT[];
+    v_chats BIGINT[];
+    v_playlists BIGINT[];
+    v_items INT[];
+BEGIN
+    WITH due AS (
+        SELECT s.user_id
+            FROM delivery_schedules s
+            WHERE s.next_run_at <= NOW()
+            ORDER BY s.next_run_at, s.user_id
+            FOR UPDATE SKIP LOCKED
+            LIMIT p_limit
+    ), claimed AS (
+        UPDATE delivery_schedules s
+            SET next_run_at = next_delivery_at(s.send_time, s.timezone),
+                last_run_at = NOW()
+            FROM due d
+            WHERE s.user_id = d.user_id
+            RETURNING s.user_id, s.chat_id, s.playlist_id
+    )
+    SELECT array_agg(c.user_id), array_agg(c.chat_id),
+           array_agg(COALESCE(
+               (SELECT p.id FROM playlists p WHERE p.id = c.playlist_id AND p.user_id = c.user_id AND p.await_cnt > 0),
+               pick_playlist(c.user_id, p_pick)))
+        INTO v_users, v_chats, v_playlists
+        FROM claimed c;
+
+    IF v_users IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- the lock /next takes, in id order; the statements below see what concurrent /next calls did
+    PERFORM 1 FROM playlists p WHERE p.id = ANY(v_playlists) ORDER BY p.id FOR UPDATE;
+
+    WITH picked AS (
+        SELECT n.id
+            FROM unnest(v_playlists) AS b(playlist_id)
+            CROSS JOIN LATERAL (
+                SELECT pit.id
+                    FROM playlist_items pit
+                    WHERE pit.playlist_id = b.playlist_id
+                    AND pit.status = 'await'
+                    ORDER BY pit.position_num NULLS FIRST, pit.id
+                    LIMIT 1
+            ) n
+    ), sent AS (
+        UPDATE playlist_items pit
+            SET status = 'done',
+                completed_at = NOW()
+            FROM picked
+            WHERE pit.id = picked.id
+            AND pit.status = 'await'
+            RETURNING pit.id
+    )
+    SELECT array_agg(sent.id) INTO v_items FROM sent;
+
+    IF v_items IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- the counters triggers have run for the UPDATE above
+    UPDATE playlists p
+        SET last_sent = NOW(),
+            status = CASE WHEN p.await_cnt = 0 THEN 'done' ELSE p.status END,
+            completed_at = CASE WHEN p.await_cnt = 0 THEN NOW() ELSE p.completed_at END
+        FROM playlist_items pit
+        WHERE pit.id = ANY(v_items)
+        AND p.id = pit.playlist_id;
+
+    RETURN QUERY
+        SELECT p.user_id, u.chat_id, p.id, pit.id, v.link, p.await_cnt = 0
+            FROM unnest(v_items) AS i(id)
+            JOIN playlist_items pit ON pit.id = i.id
+            JOIN playlists p ON p.id = pit.playlist_id
+            JOIN videos v ON v.id = pit.video_id
+            JOIN unnest(v_users, v_chats) AS u(user_id, chat_id) ON u.user_id = p.user_id;
+END;
+$$;
+
+COMMIT;
@@ -0,0 +1,34 @@
+-- videos_duration_sync() updated other users' items before their playlist rows, the
+-- reverse of advance_playlist(): it now locks the playlists first, in id order.
+BEGIN;
+
+-- a corrected video duration is copied to every item pointing at it; the item trigger does the rest.
+-- Items written with the new duration in the same statement already match and are skipped.
+-- The playlists involved are locked first, in id order: the order advance_playlist() and deliver_due()
+-- use, so a sync touching other users' playlists can't deadlock with their /next.
+CREATE OR REPLACE FUNCTION videos_duration_sync() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM 1 FROM playlists p
+        WHERE p.id IN (
+            SELECT pit.playlist_id
+                FROM playlist_items pit
+                JOIN new_videos n ON n.id = pit.video_id
+                JOIN old_videos o ON o.id = n.id
+                WHERE n.duration_sec IS DISTINCT FROM o.duration_sec
+                AND pit.duration_sec <> COALESCE(n.duration_sec, 0))
+        ORDER BY p.id
+        FOR UPDATE;
+
+    UPDATE playlist_items pit
+        SET duration_sec = COALESCE(n.duration_sec, 0)
+        FROM new_videos n
+        JOIN old_videos o ON o.id = n.id
+        WHERE pit.video_id = n.id
+        AND n.duration_sec IS DISTINCT FROM o.duration_sec
+        AND pit.duration_sec <> COALESCE(n.duration_sec, 0);
+    RETURN NULL;
+END;
+$$;
+
+COMMIT;
@@ -0,0 +1,9 @@
+-- A streamed import commits chunk by chunk: the playlist row says it is still importing and for which
+-- ingest job, so a retry of that job replaces the partial playlist instead of taking it as finished.
+BEGIN;
+
+ALTER TABLE playlists
+    ADD COLUMN importing BOOLEAN NOT NULL DEFAULT false,
+    ADD COLUMN import_job BIGINT;
+
+COMMIT;
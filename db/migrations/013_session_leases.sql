@@ -0,0 +1,9 @@
+-- Webhook replicas take a short lease on the user's session row while they handle one of their
+-- updates, so a user's next update waits on whichever replica it lands (bot/session_store.py).
+BEGIN;
+
+ALTER TABLE user_sessions
+    ADD COLUMN locked_by TEXT,
+    ADD COLUMN locked_until timestamptz;
+
+COMMIT;
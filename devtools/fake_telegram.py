@@ -0,0 +1,157 @@
+# A local stand-in for the Telegram Bot API, for running the bot end to end without Telegram.
+#
+#   python -m devtools.fake_telegram --port 8081
+#   TELEGRAM_API_URL=http://127.0.0.1:8081/bot WEBHOOK_URL=http://127.0.0.1:8000/telegram \
+#       uvicorn bot.webhook:app --port 8000
+#
+#   curl -X POST localhost:8081/push -d '{"chat_id": 1, "text": "/next"}'
+#   curl localhost:8081/sent?chat_id=1
+#
+# Bot API calls the bot makes are answered from memory (sendMessage, editMessageText, setWebhook,
+# getUpdates ...). /push turns a text into an Update and delivers it to the registered webhook, or
+# queues it for getUpdates when the bot runs with polling. /sent lists what the bot replied.
+import json
+import time
+import asyncio
+import argparse
+import itertools
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.sent = []
+        self.pending = []
+        self._new_update = asyncio.Condition()
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+
+    def _message(self, chat_id, text, message_id=None, sender=None):
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": sender or BOT_USER,
+            "text": text,
+        }
+
+    async def call(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method == "sendMessage":
+            msg = self._message(int(params["chat_id"]), params.get("text", ""))
+            self.sent.append(msg)
+            return msg
+        if method == "editMessageText":
+            msg = self._message(int(params["chat_id"]), params.get("text", ""), int(params["message_id"]))
+            self.sent.append(msg)
+            return msg
+        if method == "setWebhook":
+            self.webhook_url = params.get("url") or None
+            self.webhook_secret = params.get("secret_token")
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            return True
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url or "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "getUpdates":
+            return await self._get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        #setMyCommands, answerCallbackQuery, ...
+        return True
+
+    async def _get_updates(self, offset, timeout):
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending and timeout:
+            async with self._new_update:
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), timeout=min(timeout, 10))
+                except asyncio.TimeoutError:
+                    pass
+        return list(self.pending)
+
+    def make_update(self, chat_id, text, username=None):
+        sender = {"id": chat_id, "is_bot": False, "first_name": username or f"user{chat_id}",
+                  "username": username or f"user{chat_id}"}
+        message = self._message(chat_id, text, sender=sender)
+        if text.startswith("/"):
+            #CommandHandler only matches messages that carry a bot_command entity
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    async def push(self, update):
+        if self.webhook_url:
+            headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret} if self.webhook_secret else {}
+            async with httpx.AsyncClient() as client:
+                response = await client.post(self.webhook_url, json=update, headers=headers)
+            return {"delivered": "webhook", "status": response.status_code}
+
+        self.pending.append(update)
+        async with self._new_update:
+            self._new_update.notify_all()
+        return {"delivered": "getUpdates"}
+
+
+fake = FakeTelegram()
+
+
+async def _params(request):
+    #python-telegram-bot posts form fields with JSON-encoded values for anything non-scalar
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return await request.json()
+    form = await request.form()
+    params = {}
+    for key, value in form.items():
+        params[key] = json.loads(value) if isinstance(value, str) and value[:1] in "[{" else value
+    return params
+
+
+async def bot_api(request):
+    method = request.path_params["method"]
+    result = await fake.call(method, await _params(request))
+    return JSONResponse({"ok": True, "result": result})
+
+
+async def push(request):
+    body = await request.json()
+    update = fake.make_update(int(body["chat_id"]), body["text"], body.get("username"))
+    return JSONResponse({"update_id": update["update_id"], **await fake.push(update)})
+
+
+async def sent(request):
+    chat_id = request.query_params.get("chat_id")
+    if request.method == "DELETE":
+        fake.sent.clear()
+        return JSONResponse([])
+    messages = [m for m in fake.sent if chat_id is None or m["chat"]["id"] == int(chat_id)]
+    return JSONResponse(messages)
+
+
+app = Starlette(routes=[
+    Route("/bot{token}/{method}", bot_api, methods=["GET", "POST"]),
+    Route("/push", push, methods=["POST"]),
+    Route("/sent", sent, methods=["GET", "DELETE"]),
+])
+
+
+def main():
+    #only the standalone server needs it, benchmarks/load_driver.py uses FakeTelegram in process
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
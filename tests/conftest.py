@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+
+class Clock:
+    #stands in for the time module of the code under test; sleeping moves the clock instead of waiting
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "clock(*modules): modules whose `time` the clock fixture replaces")
+
+
+#pytestmark = pytest.mark.clock(module) in the test file says which modules read the clock;
+#only their `time` is replaced, the event loop keeps the real one
+@pytest.fixture
+def clock(request, monkeypatch):
+    clock = Clock()
+    marker = request.node.get_closest_marker("clock")
+    for module in marker.args if marker else ():
+        monkeypatch.setattr(module, "time", clock)
+    monkeypatch.setattr(asyncio, "sleep", clock.sleep)
+    return clock
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from psycopg2 import errors as pg_errors
+
+from bot import db_connection
+from bot.db_connection import _execute_prepared
+from bot.queries import Query
+
+
+class Cursor:
+    #fails the PREPARE with the given error, records everything else
+    def __init__(self, error):
+        self.error = error
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        if isinstance(sql, str) and sql.startswith("PREPARE"):
+            raise self.error
+        self.executed.append(sql)
+
+
+@pytest.fixture(autouse=True)
+def unpreparable(monkeypatch):
+    monkeypatch.setattr(db_connection, "_unpreparable", set())
+    return db_connection._unpreparable
+
+
+def test_unpreparable_query_runs_as_plain_text_from_then_on(unpreparable):
+    query = Query("untyped", "SELECT %s;")
+    cur = Cursor(pg_errors.IndeterminateDatatype())
+    _execute_prepared(SimpleNamespace(prepared=set()), cur, query, (1,))
+    assert cur.executed == ["SAVEPOINT prepare_query", "ROLLBACK TO SAVEPOINT prepare_query", "SELECT %s;"]
+    assert unpreparable == {"untyped"}
+
+
+def test_transient_prepare_failure_is_raised_and_retried_next_time(unpreparable):
+    query = Query("locked", "SELECT id FROM playlists WHERE id = %s;")
+    cur = Cursor(pg_errors.LockNotAvailable())
+    with pytest.raises(pg_errors.LockNotAvailable):
+        _execute_prepared(SimpleNamespace(prepared=set()), cur, query, (1,))
+    assert unpreparable == set()
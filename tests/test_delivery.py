@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+#bot.delivery pulls in the Bot API errors and, through the queries it runs, both database drivers
+pytest.importorskip("telegram")
+pytest.importorskip("psycopg2")
+pytest.importorskip("psycopg_pool")
+
+from bot import delivery
+from bot.delivery import TokenBucket
+
+pytestmark = pytest.mark.clock(delivery)
+
+
+def acquire(bucket, times=1):
+    async def run():
+        for _ in range(times):
+            await bucket.acquire()
+    asyncio.run(run())
+
+
+def test_burst_up_to_capacity_without_waiting(clock):
+    bucket = TokenBucket(rate=10, capacity=5)
+    acquire(bucket, 5)
+    assert clock.slept == []
+
+
+def test_waits_for_the_next_token_once_empty(clock):
+    bucket = TokenBucket(rate=10, capacity=2)
+    acquire(bucket, 3)
+    assert clock.slept == [pytest.approx(0.1)]
+    assert clock.now == pytest.approx(1000.1)
+
+
+def test_refills_at_rate_up_to_capacity(clock):
+    bucket = TokenBucket(rate=4, capacity=2)
+    acquire(bucket, 2)
+    clock.now += 0.25
+    acquire(bucket)
+    assert clock.slept == []
+
+    #an hour idle still saves up only capacity tokens
+    clock.now += 3600
+    acquire(bucket, 3)
+    assert clock.slept == [pytest.approx(0.25)]
+
+
+def test_pause_empties_the_bucket(clock):
+    bucket = TokenBucket(rate=10, capacity=5)
+    asyncio.run(bucket.pause(3))
+    assert clock.now == pytest.approx(1003)
+    acquire(bucket)
+    assert clock.slept == [3, pytest.approx(0.1)]
+
+
+def test_next_batch_is_claimed_once_the_last_one_is_sent(monkeypatch):
+    class Bot:
+        def __init__(self):
+            self.sent = []
+
+        async def send_message(self, chat_id, text):
+            await asyncio.sleep(0)
+            self.sent.append(chat_id)
+
+    bot = Bot()
+    stop = asyncio.Event()
+    batches = [[1, 2], [3, 4], [5]]
+    claimed_after = []
+
+    async def deliver_due_async():
+        claimed_after.append(list(bot.sent))
+        batch = batches.pop(0)
+        if not batches:
+            stop.set()
+        return [{"chat_id": n, "user_id": n, "link": f"https://youtu.be/{n}", "playlist_done": False} for n in batch]
+
+    monkeypatch.setattr(delivery, "DELIVERY_BATCH", 2)
+    monkeypatch.setattr(delivery.DeliverySchedule, "deliver_due_async", staticmethod(deliver_due_async))
+    asyncio.run(delivery.run_scheduler(bot, stop, rate=1000, burst=10))
+    assert claimed_after == [[], [1, 2], [1, 2, 3, 4]]
+    assert bot.sent == [1, 2, 3, 4, 5]
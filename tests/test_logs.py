@@ -0,0 +1,105 @@
+import io
+import queue
+import logging
+
+import pytest
+
+from bot import logs
+from bot.metrics import get_metrics
+
+
+def make_record(msg, *args, level=logging.INFO, name="bot.test"):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+@pytest.fixture
+def root_logger():
+    #setup_logging() replaces the root handlers and reads the environment once
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    logs.stop_logging()
+    logs._sql_params = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_bot_token_is_redacted():
+    text = logs.redact("POST https://api.telegram.org/bot123456:AAH-abcdefghijklmnopqrstuvwxyz012/sendMessage")
+    assert "AAH-abc" not in text
+    assert "bot<redacted>/sendMessage" in text
+
+
+def test_dsn_and_json_secrets_are_redacted():
+    text = logs.redact("connection to host=db user=bot password=hunter2 dbname=playlists failed")
+    assert "hunter2" not in text
+    assert "password=<redacted>" in text
+    assert "user=bot" in text
+
+    text = logs.redact("""payload {"token": "s3cr3t", "chat_id": 1}""")
+    assert "s3cr3t" not in text
+    assert '"chat_id": 1' in text
+
+
+def test_formatters_redact_the_rendered_message():
+    record = make_record("retrying with %s", "api_key=abcdef")
+    assert "abcdef" not in logs.TextFormatter(logs.TEXT_FORMAT).format(record)
+    assert "abcdef" not in logs.JsonFormatter().format(record)
+
+
+def test_sql_params_are_logged_as_types_by_default():
+    assert logs.log_params((1, "secret")) == "(<int>, <str>)"
+    assert logs.log_params({"user_id": 1, "link": "https://x"}) == "{user_id: <int>, link: <str>}"
+    assert logs.log_params(None) is None
+
+
+def test_log_sql_params_logs_the_values(root_logger, monkeypatch):
+    monkeypatch.setenv("LOG_SQL_PARAMS", "1")
+    logs.setup_logging(stream=io.StringIO())
+    assert logs.log_params((1, "secret")) == (1, "secret")
+
+
+def test_setup_logging_defaults_to_types_only(root_logger, monkeypatch):
+    monkeypatch.delenv("LOG_SQL_PARAMS", raising=False)
+    logs.setup_logging(stream=io.StringIO())
+    assert logs.log_params((1,)) == "(<int>)"
+
+
+def test_sampling_drops_info_but_keeps_warnings():
+    sampler = logs.SamplingFilter({"bot": 0.0, "bot.main": 1.0})
+    assert not sampler.filter(make_record("x", name="bot.playlist_class"))
+    assert sampler.filter(make_record("x", name="bot.main.child"))
+    assert sampler.filter(make_record("x", name="httpx"))
+    assert sampler.filter(make_record("x", level=logging.WARNING, name="bot.playlist_class"))
+    assert sampler.filter(make_record("x", level=logging.ERROR, name="bot.playlist_class"))
+
+
+def test_sampling_spec_is_parsed():
+    assert logs.SamplingFilter.parse("bot.playlist_class=0.01, bot.main=0.1,,junk") == {
+        "bot.playlist_class": 0.01, "bot.main": 0.1}
+
+
+def test_full_queue_drops_and_counts():
+    get_metrics().reset()
+    handler = logs.NonBlockingQueueHandler(queue.Queue(1))
+    handler.handle(make_record("first"))
+    handler.handle(make_record("second"))
+    assert handler.queue.qsize() == 1
+    assert handler.dropped == 1
+    assert 'log_records_dropped_total{name="bot.test"} 1' in get_metrics().render()
+
+
+def test_queued_record_is_a_snapshot_of_the_message():
+    handler = logs.NonBlockingQueueHandler(queue.Queue())
+    items = ["a"]
+    record = make_record("items %s", items)
+    handler.handle(record)
+    items.append("b")
+
+    queued = handler.queue.get_nowait()
+    assert queued is not record
+    assert queued.getMessage() == "items ['a']"
+    assert queued.args is None
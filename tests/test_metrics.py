@@ -0,0 +1,80 @@
+import pytest
+
+from bot.metrics import Histogram, Metrics, query_name, UNREGISTERED
+from bot.queries import Query
+
+
+def test_empty_histogram_quantile_is_zero():
+    assert Histogram().quantile(0.99) == 0.0
+
+
+def test_quantile_interpolates_inside_the_bucket():
+    hist = Histogram(buckets=(1, 2, 4))
+    for value in (1.5, 1.5, 1.5, 1.5):
+        hist.observe(value)
+    #all four in (1, 2]: the median sits halfway through it
+    assert hist.quantile(0.5) == pytest.approx(1.5)
+    assert hist.quantile(0.25) == pytest.approx(1.25)
+    assert hist.quantile(1.0) == pytest.approx(2.0)
+
+
+def test_values_on_a_bucket_edge_count_in_that_bucket():
+    hist = Histogram(buckets=(1, 2, 4))
+    for value in (1, 1, 2, 2):
+        hist.observe(value)
+    assert hist.counts == [2, 2, 0, 0]
+    #the rank lands exactly on the end of the first bucket, not in the second
+    assert hist.quantile(0.5) == pytest.approx(1.0)
+    assert hist.quantile(0.75) == pytest.approx(1.5)
+    assert hist.quantile(1.0) == pytest.approx(2.0)
+
+
+def test_first_bucket_starts_at_zero():
+    hist = Histogram(buckets=(1, 2))
+    hist.observe(0.5)
+    hist.observe(0.5)
+    assert hist.quantile(0.5) == pytest.approx(0.5)
+
+
+def test_overflow_bucket_is_bounded_by_the_max():
+    hist = Histogram(buckets=(1, 2))
+    hist.observe(1.5)
+    hist.observe(10)
+    assert hist.counts == [0, 1, 1]
+    assert hist.quantile(0.5) == pytest.approx(2.0)
+    assert hist.quantile(0.75) == pytest.approx(6.0)
+    assert hist.quantile(1.0) == pytest.approx(10.0)
+
+
+def test_empty_buckets_are_skipped():
+    hist = Histogram(buckets=(1, 2, 4, 8))
+    hist.observe(0.5)
+    hist.observe(6)
+    #the rank is reached at the end of the first bucket already; the empty ones in between add nothing
+    assert hist.quantile(0.5) == pytest.approx(1.0)
+    assert hist.quantile(0.75) == pytest.approx(6.0)
+
+
+def test_summary_reports_the_quantiles():
+    metrics = Metrics()
+    for _ in range(10):
+        metrics.observe("query_seconds", "advance", 0.004)
+    (metric, name, count, p50, p95, p99, peak), = metrics.summary()
+    assert (metric, name, count) == ("query_seconds", "advance", 10)
+    assert 0.0025 < p50 <= p95 <= p99 <= 0.005
+    assert peak == 0.004
+
+
+def test_only_registry_queries_get_their_own_label():
+    assert query_name(Query("advance", "SELECT 1;")) == "advance"
+    assert query_name("SELECT * FROM users WHERE telegram_id = 42") == UNREGISTERED
+    assert query_name("DELETE FROM videos") == UNREGISTERED
+
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.inc("errors", 'say "hi"\\ \nbye')
+    metrics.register_gauge("pool", lambda: {"a\nb": 1})
+    rendered = metrics.render()
+    assert 'playlist_bot_errors_total{name="say \\"hi\\"\\\\ \\nbye"} 1' in rendered
+    assert 'playlist_bot_pool{name="a\\nb"} 1' in rendered
@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("yt_dlp")
+pytest.importorskip("psycopg2")
+pytest.importorskip("psycopg_pool")
+
+from bot import playlist_service
+from bot.playlist_service import PlaylistService
+from bot.yt_parse import PlaylistResult, ExtractionError
+
+
+def never(*args, **kwargs):
+    raise AssertionError("an empty playlist must not reach the database")
+
+
+@pytest.fixture
+def empty_playlist(monkeypatch):
+    playlist = PlaylistResult(link="https://www.youtube.com/playlist?list=PLempty", title="empty", list_id="PLempty")
+    monkeypatch.setattr(playlist_service, "run_query", never)
+    monkeypatch.setattr(playlist_service, "run_query_async", never)
+    return playlist
+
+
+def test_empty_playlist_is_an_extraction_error(empty_playlist):
+    with pytest.raises(ExtractionError, match="PLempty has no available items"):
+        PlaylistService.save_playlist(101, empty_playlist)
+    with pytest.raises(ExtractionError):
+        asyncio.run(PlaylistService.save_playlist_async(101, empty_playlist))
+
+
+def test_sync_add_playlist_rejects_an_empty_extraction(empty_playlist, monkeypatch):
+    monkeypatch.setattr(PlaylistService, "playlist_from_catalog", staticmethod(lambda user_id, link: (None, None)))
+    monkeypatch.setattr(playlist_service, "extract_playlist", lambda link: empty_playlist)
+    with pytest.raises(ExtractionError):
+        PlaylistService.add_playlist(101, empty_playlist.link)
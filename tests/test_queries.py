@@ -0,0 +1,50 @@
+import pytest
+
+from bot.queries import Query, register, get_query
+
+
+def test_named_placeholders_become_numbered_in_first_use_order():
+    query = Query("t", "SELECT %(x)s, %(y)s, %(x)s;")
+    statement, keys, count = query.positional
+    assert statement == "SELECT $1, $2, $1"
+    assert keys == ["x", "y"]
+    assert count == 2
+
+
+def test_positional_placeholders_are_numbered_in_order():
+    statement, keys, count = Query("t", "UPDATE t SET a = %s WHERE id = %s").positional
+    assert statement == "UPDATE t SET a = $1 WHERE id = $2"
+    assert keys is None
+    assert count == 2
+
+
+def test_escaped_percent_is_unescaped_not_numbered():
+    statement, keys, count = Query("t", "SELECT title FROM videos WHERE title LIKE '%%' || %s || '%%'").positional
+    assert statement == "SELECT title FROM videos WHERE title LIKE '%' || $1 || '%'"
+    assert count == 1
+
+
+def test_values_orders_dict_params_by_placeholder():
+    query = Query("t", "SELECT %(b)s, %(a)s, %(b)s")
+    assert query.values({"a": 1, "b": 2, "unused": 3}) == [2, 1]
+
+
+def test_values_checks_positional_count():
+    query = Query("t", "SELECT %s, %s")
+    assert query.values((1, 2)) == [1, 2]
+    assert Query("t", "SELECT 1").values(None) == []
+    with pytest.raises(ValueError):
+        query.values((1,))
+
+
+def test_register_returns_the_same_query_for_the_same_sql():
+    first = register("test_queries_same", "SELECT 1")
+    assert register("test_queries_same", "SELECT 1") is first
+    assert get_query("test_queries_same") is first
+    assert first.name == "test_queries_same"
+
+
+def test_register_rejects_a_name_reused_for_different_sql():
+    register("test_queries_clash", "SELECT 1")
+    with pytest.raises(ValueError):
+        register("test_queries_clash", "SELECT 2")
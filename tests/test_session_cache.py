@@ -0,0 +1,34 @@
+import pytest
+
+from bot import session_cache
+from bot.session_cache import SessionCache
+
+pytestmark = pytest.mark.clock(session_cache)
+
+
+def test_users_expire_after_ttl(clock):
+    cache = SessionCache(ttl=60, size=10)
+    cache.set_user(1, 101, default_playlist_id=7)
+    clock.now += 59
+    assert cache.get_user(1) == {"user_id": 101, "default_playlist_id": 7}
+    clock.now += 2
+    assert cache.get_user(1) is None
+    assert cache.stats()["users"]["entries"] == 0
+
+
+def test_get_user_returns_a_copy(clock):
+    cache = SessionCache(ttl=60, size=10)
+    cache.set_user(1, 101)
+    cache.get_user(1)["user_id"] = 999
+    assert cache.get_user(1)["user_id"] == 101
+
+
+def test_least_recently_used_user_is_evicted(clock):
+    cache = SessionCache(ttl=60, size=2)
+    cache.set_user(1, 101)
+    cache.set_user(2, 102)
+    cache.get_user(1)
+    cache.set_user(3, 103)
+    assert cache.get_user(2) is None
+    assert cache.get_user(1)["user_id"] == 101
+    assert cache.get_user(3)["user_id"] == 103
@@ -0,0 +1,202 @@
+import asyncio
+
+import pytest
+
+#bot.session_store imports both database drivers through the query layer
+pytest.importorskip("psycopg2")
+pytest.importorskip("psycopg_pool")
+
+from bot.session_store import SessionPersistence, FileSessionStore, snapshot, restore
+from bot.user_class import User
+
+
+class CountingStore:
+    #wraps a store and remembers every batch written through it
+    def __init__(self, store):
+        self.store = store
+        self.saves = []
+        self.leases = []
+
+    async def load(self, tg_id):
+        return await self.store.load(tg_id)
+
+    async def acquire(self, tg_id, owner, lease):
+        self.leases.append(("acquire", tg_id, owner))
+        return await self.store.acquire(tg_id, owner, lease)
+
+    async def release(self, tg_id, owner):
+        self.leases.append(("release", tg_id, owner))
+        await self.store.release(tg_id, owner)
+
+    async def save_many(self, sessions):
+        self.saves.append(dict(sessions))
+        await self.store.save_many(sessions)
+
+    async def close(self):
+        await self.store.close()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CountingStore(FileSessionStore(str(tmp_path / "sessions.sqlite3")))
+
+
+def make_user(tg_id=1):
+    user = User(tg_id, "alice", user_id=101)
+    user.default_playlist_id = 7
+    return user
+
+
+def test_snapshot_keeps_the_user_and_plain_values():
+    data = snapshot({"user": make_user(), "awaiting_delete": True, "progress": object()})
+    assert data == {
+        "user": {"__user__": {"tg_id": 1, "username": "alice", "user_id": 101, "default_playlist_id": 7}},
+        "awaiting_delete": True,
+    }
+    restored = restore(data)
+    assert isinstance(restored["user"], User)
+    assert restored["user"].to_session() == make_user().to_session()
+    assert restored["awaiting_delete"] is True
+
+
+def test_state_survives_a_restart(store, tmp_path):
+    async def run():
+        first = SessionPersistence(store)
+        user_data = {}
+        await first.attach(1, user_data)
+        user_data.update(user=make_user(), awaiting_restart=True)
+        await first.close()
+
+        second = SessionPersistence(FileSessionStore(str(tmp_path / "sessions.sqlite3")))
+        reloaded = {}
+        await second.attach(1, reloaded)
+        await second.close()
+        return reloaded
+
+    reloaded = asyncio.run(run())
+    assert reloaded["awaiting_restart"] is True
+    assert reloaded["user"].user_id == 101
+
+
+def test_flush_writes_only_changed_users_in_one_batch(store):
+    async def run():
+        sessions = SessionPersistence(store)
+        alice, bob = {}, {}
+        await sessions.attach(1, alice)
+        await sessions.attach(2, bob)
+        alice["awaiting_delete"] = True
+        bob["awaiting_restart"] = True
+        assert await sessions.flush() == 2
+
+        await sessions.attach(1, alice)
+        await sessions.attach(2, bob)
+        bob.pop("awaiting_restart")
+        assert await sessions.flush() == 1
+        #nobody seen since the last flush: nothing to compare
+        assert await sessions.flush() == 0
+        await sessions.close()
+
+    asyncio.run(run())
+    assert store.saves == [{1: {"awaiting_delete": True}, 2: {"awaiting_restart": True}}, {2: {}}]
+
+
+def test_flush_user_writes_just_that_user(store):
+    async def run():
+        sessions = SessionPersistence(store, shared=True)
+        alice, bob = {}, {}
+        await sessions.attach(1, alice)
+        await sessions.attach(2, bob)
+        alice["awaiting_delete"] = True
+        bob["awaiting_delete"] = True
+        assert await sessions.flush_user(1) == 1
+        assert await sessions.flush_user(1) == 0
+        assert await sessions.flush() == 1
+        await sessions.close()
+
+    asyncio.run(run())
+    assert store.saves == [{1: {"awaiting_delete": True}}, {2: {"awaiting_delete": True}}]
+
+
+def test_shared_mode_reloads_on_every_update(store):
+    async def run():
+        replica_a = SessionPersistence(store, shared=True)
+        replica_b = SessionPersistence(store, shared=True)
+        on_a, on_b = {}, {}
+        await replica_a.attach(1, on_a)
+        on_a["awaiting_restart"] = True
+        await replica_a.flush_user(1)
+
+        await replica_b.attach(1, on_b)
+        seen_on_b = dict(on_b)
+        on_b.pop("awaiting_restart")
+        await replica_b.flush_user(1)
+
+        await replica_a.attach(1, on_a)
+        return seen_on_b, on_a
+
+    seen_on_b, on_a = asyncio.run(run())
+    assert seen_on_b == {"awaiting_restart": True}
+    assert on_a == {}
+
+
+def test_failed_flush_is_retried(store):
+    class FlakyStore(CountingStore):
+        failures = 1
+
+        async def save_many(self, sessions):
+            if self.failures:
+                self.failures -= 1
+                raise OSError("disk full")
+            await super().save_many(sessions)
+
+    flaky = FlakyStore(store.store)
+
+    async def run():
+        sessions = SessionPersistence(flaky)
+        user_data = {}
+        await sessions.attach(1, user_data)
+        user_data["awaiting_delete"] = True
+        assert await sessions.flush() == 0
+        assert await sessions.flush() == 1
+
+    asyncio.run(run())
+    assert flaky.saves == [{1: {"awaiting_delete": True}}]
+
+
+def test_saved_map_evicts_least_recently_seen_user(store):
+    async def run():
+        sessions = SessionPersistence(store, saved_size=2)
+        users = {tg_id: {} for tg_id in (1, 2, 3)}
+        for tg_id in (1, 2):
+            await sessions.attach(tg_id, users[tg_id])
+            users[tg_id]["awaiting_delete"] = True
+        await sessions.flush()
+
+        await sessions.attach(1, users[1])
+        await sessions.attach(3, users[3])
+        saved = list(sessions._saved)
+
+        #2 was forgotten: its next update loads it again, without overwriting what is in memory
+        users[2]["awaiting_delete"] = False
+        await sessions.attach(2, users[2])
+        return saved, users[2]
+
+    saved, bob = asyncio.run(run())
+    assert saved == [1, 3]
+    assert bob == {"awaiting_delete": False}
+
+
+def test_shared_mode_holds_the_lease_until_flush_user(store):
+    async def run():
+        sessions = SessionPersistence(store, shared=True, owner="replica-a")
+        user_data = {}
+        await sessions.attach(1, user_data)
+        held = list(store.leases)
+        #nothing changed: no write, but the lease is still given back
+        assert await sessions.flush_user(1) == 0
+        return held
+
+    held = asyncio.run(run())
+    assert held == [("acquire", 1, "replica-a")]
+    assert store.leases == [("acquire", 1, "replica-a"), ("release", 1, "replica-a")]
+    assert store.saves == []
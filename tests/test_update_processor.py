@@ -0,0 +1,153 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+
+from bot.update_processor import PerUserUpdateProcessor, OVERFLOW_TEXT
+
+
+class Message:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def make_update(update_id, user_id):
+    return SimpleNamespace(update_id=update_id, effective_user=SimpleNamespace(id=user_id),
+                           effective_chat=SimpleNamespace(id=user_id), effective_message=Message())
+
+
+#a handler that records when it starts and ends, and finishes once released
+def handler(log, name, release):
+    async def run():
+        log.append(("start", name))
+        await release.wait()
+        log.append(("end", name))
+    return run()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_updates_of_one_user_run_in_arrival_order():
+    async def run():
+        processor = PerUserUpdateProcessor(8)
+        log = []
+        releases = [asyncio.Event() for _ in range(3)]
+        tasks = [asyncio.create_task(processor.process_update(make_update(n, 1), handler(log, n, releases[n])))
+                 for n in range(3)]
+        await settle()
+        assert log == [("start", 0)]
+        for release in releases:
+            release.set()
+        await asyncio.gather(*tasks)
+        return log
+
+    assert asyncio.run(run()) == [("start", 0), ("end", 0), ("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+
+
+def test_different_users_run_concurrently_up_to_the_slots():
+    async def run():
+        processor = PerUserUpdateProcessor(2)
+        log = []
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(processor.process_update(make_update(n, n), handler(log, n, release)))
+                 for n in range(3)]
+        await settle()
+        started = list(log)
+        running = processor.current_concurrent_updates
+        release.set()
+        await asyncio.gather(*tasks)
+        return started, running
+
+    started, running = asyncio.run(run())
+    assert started == [("start", 0), ("start", 1)]
+    assert running == 2
+
+
+def test_waiting_updates_of_one_user_hold_no_slots():
+    async def run():
+        processor = PerUserUpdateProcessor(2)
+        log = []
+        busy, other = asyncio.Event(), asyncio.Event()
+        tasks = [asyncio.create_task(processor.process_update(make_update(n, 1), handler(log, n, busy)))
+                 for n in range(3)]
+        await settle()
+        tasks.append(asyncio.create_task(processor.process_update(make_update(9, 2), handler(log, 9, other))))
+        await settle()
+        started = list(log)
+        busy.set()
+        other.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert asyncio.run(run()) == [("start", 0), ("start", 9)]
+
+
+def test_overflow_is_answered_and_never_handled():
+    async def run():
+        processor = PerUserUpdateProcessor(8, max_pending_per_user=2)
+        log = []
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(processor.process_update(make_update(n, 1), handler(log, n, release)))
+                 for n in range(2)]
+        await settle()
+        overflow = make_update(2, 1)
+        await processor.process_update(overflow, handler(log, 2, release))
+        release.set()
+        await asyncio.gather(*tasks)
+        return processor, overflow, log
+
+    processor, overflow, log = asyncio.run(run())
+    assert overflow.effective_message.replies == [OVERFLOW_TEXT]
+    assert ("start", 2) not in log
+    assert processor.overflowed == 1
+
+
+def test_mailbox_is_removed_once_drained():
+    async def run():
+        processor = PerUserUpdateProcessor(8, max_pending_per_user=2)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(processor.process_update(make_update(n, 1), handler([], n, release)))
+                 for n in range(2)]
+        await settle()
+        active = processor.active_users
+        release.set()
+        await asyncio.gather(*tasks)
+        return active, processor.active_users
+
+    assert asyncio.run(run()) == (1, 0)
+
+
+def test_after_update_runs_in_turn_and_its_failure_is_contained():
+    async def run():
+        log = []
+
+        async def after_update(update):
+            log.append(("after", update.update_id))
+            if update.update_id == 0:
+                raise RuntimeError("session store down")
+
+        async def failing():
+            log.append(("start", 0))
+            raise ValueError("handler failed")
+
+        processor = PerUserUpdateProcessor(8, after_update=after_update)
+        release = asyncio.Event()
+        release.set()
+        first = asyncio.create_task(processor.process_update(make_update(0, 1), failing()))
+        second = asyncio.create_task(processor.process_update(make_update(1, 1), handler(log, 1, release)))
+        results = await asyncio.gather(first, second, return_exceptions=True)
+        return log, results, processor.active_users
+
+    log, results, active = asyncio.run(run())
+    #the handler's own error still reaches the Application, the after_update one is only logged
+    assert isinstance(results[0], ValueError) and results[1] is None
+    assert log == [("start", 0), ("after", 0), ("start", 1), ("end", 1), ("after", 1)]
+    assert active == 0
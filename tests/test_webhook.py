@@ -0,0 +1,63 @@
+import os
+import asyncio
+import importlib
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("starlette")
+pytest.importorskip("psycopg2")
+pytest.importorskip("psycopg_pool")
+
+#bot.main refuses to import without a token; nothing here talks to Telegram
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:test")
+
+from bot import logs
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    #importing bot.webhook would otherwise replace the root log handlers for the whole session
+    monkeypatch.setattr(logs, "setup_logging", lambda *args, **kwargs: None)
+    import bot.webhook
+    return importlib.reload(bot.webhook)
+
+
+def test_webhook_app_imports(webhook):
+    assert webhook.application.updater is None
+    assert webhook.application.bot_data["shared_sessions"] is True
+    assert {route.path for route in webhook.app.routes} == {webhook.WEBHOOK_PATH, "/healthz", "/metrics"}
+
+
+def test_build_application_for_webhook(webhook):
+    from bot.main import build_application, get_restarting_info, get_deletion_info
+
+    app = build_application(webhook=True)
+    assert app.updater is None
+    assert app.post_stop is not None and app.post_shutdown is not None
+    #each dialog gets its own group, so the first one not waiting for an answer doesn't hide the other
+    assert [h.callback.__wrapped__ for h in app.handlers[1]] == [get_restarting_info]
+    assert [h.callback.__wrapped__ for h in app.handlers[2]] == [get_deletion_info]
+
+
+def test_post_stop_waits_for_in_flight_work(webhook):
+    from bot.main import _post_stop
+
+    async def run():
+        stop = asyncio.Event()
+        sent = []
+
+        #both send once stopped (claimed deliveries, the outcome of the running import): the bot must still be up
+        async def finishing(text):
+            await stop.wait()
+            await asyncio.sleep(0)
+            sent.append(text)
+
+        app = SimpleNamespace(bot_data={"ingest_stop": stop, "sync_workers": [], "metrics_dump": [],
+                                        "ingest_workers": [asyncio.create_task(finishing("Playlist saved"))],
+                                        "delivery": [asyncio.create_task(finishing("🎬 Your video for today"))]})
+        await _post_stop(app)
+        return sent
+
+    assert sorted(asyncio.run(run())) == ["Playlist saved", "🎬 Your video for today"]
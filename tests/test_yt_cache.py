@@ -0,0 +1,86 @@
+import pytest
+
+from bot import yt_cache
+from bot.yt_cache import MetadataCache
+from bot.metrics import get_metrics
+
+pytestmark = pytest.mark.clock(yt_cache)
+
+
+def test_memory_entries_expire_after_ttl(clock):
+    cache = MetadataCache(ttl=60, memory_size=10)
+    cache.set("video:a", {"title": "A"})
+    clock.now += 59
+    assert cache.get("video:a") == {"title": "A"}
+    clock.now += 2
+    assert cache.get("video:a") is None
+    assert cache.stats()["memory_entries"] == 0
+
+
+def test_memory_evicts_least_recently_used(clock):
+    cache = MetadataCache(ttl=60, memory_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_disk_tier_serves_after_memory_eviction(clock, tmp_path):
+    cache = MetadataCache(ttl=60, memory_size=1, disk_path=str(tmp_path / "cache.sqlite3"), disk_size=10)
+    cache.set("a", {"n": 1})
+    cache.set("b", {"n": 2})
+    assert cache.get("a") == {"n": 1}
+    assert cache.hits_disk == 1
+    clock.now += 61
+    assert cache.get("b") is None
+
+
+def test_disk_tier_evicts_least_recently_used(clock, tmp_path):
+    cache = MetadataCache(ttl=600, memory_size=0, disk_path=str(tmp_path / "cache.sqlite3"), disk_size=3)
+    for key in "abc":
+        clock.now += 1
+        cache.set(key, key)
+    clock.now += 1
+    assert cache.get("a") == "a"
+    clock.now += 1
+    cache.set("d", "d")
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["a", "c", "d"]
+
+
+def test_disk_tier_survives_a_restart(clock, tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    MetadataCache(ttl=60, memory_size=10, disk_path=path, disk_size=10).set("a", [1, 2])
+    assert MetadataCache(ttl=60, memory_size=10, disk_path=path, disk_size=10).get("a") == [1, 2]
+
+
+def test_disk_tier_is_counted_only_past_the_limit(clock, tmp_path):
+    cache = MetadataCache(ttl=600, memory_size=0, disk_path=str(tmp_path / "cache.sqlite3"), disk_size=20)
+    statements = []
+    cache._db.set_trace_callback(statements.append)
+    for n in range(20):
+        clock.now += 1
+        cache.set(f"k{n}", n)
+    assert not any("count(*)" in s for s in statements)
+
+    clock.now += 1
+    cache.set("k20", 20)
+    assert sum("count(*)" in s for s in statements) == 1
+    #21 rows, down to 90% of 20: the three least recently used go
+    assert [cache.get(f"k{n}") for n in range(4)] == [None, None, None, 3]
+    assert cache.get("k20") == 20
+
+
+def test_shared_cache_reports_to_metrics(clock, monkeypatch):
+    monkeypatch.setattr(yt_cache, "_metadata_cache", None)
+    monkeypatch.setenv("YT_CACHE_PATH", "")
+    cache = yt_cache.get_metadata_cache()
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+    rendered = get_metrics().render()
+    assert 'playlist_bot_yt_cache{name="hits_memory"} 1' in rendered
+    assert 'playlist_bot_yt_cache{name="misses"} 1' in rendered
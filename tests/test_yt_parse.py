@@ -0,0 +1,86 @@
+import pytest
+
+pytest.importorskip("yt_dlp")
+
+import yt_dlp
+from yt_dlp.utils import DownloadError, UnsupportedError, ExtractorError
+
+from bot import yt_parse
+from bot.yt_parse import classify_link, _playlist_item, extract, extract_video, ExtractionError
+
+
+@pytest.mark.parametrize("link, expected", [
+    ("https://www.youtube.com/watch?v=dQw4w9WgXcQ", ("video", "dQw4w9WgXcQ")),
+    ("https://m.youtube.com/watch?v=dQw4w9WgXcQ&t=42s", ("video", "dQw4w9WgXcQ")),
+    ("  https://youtu.be/dQw4w9WgXcQ?si=abc  ", ("video", "dQw4w9WgXcQ")),
+    ("https://www.youtube.com/shorts/abcDEF12345", ("video", "abcDEF12345")),
+    ("https://www.youtube.com/live/abcDEF12345?feature=share", ("video", "abcDEF12345")),
+    ("https://www.youtube.com/embed/abcDEF12345", ("video", "abcDEF12345")),
+    ("https://www.youtube.com/playlist?list=PL123", ("playlist", "PL123")),
+])
+def test_classify_link(link, expected):
+    assert classify_link(link) == expected
+
+
+@pytest.mark.parametrize("link", [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL123&index=3",
+    "https://youtu.be/dQw4w9WgXcQ?list=PL123",
+    "https://www.youtube.com/embed/videoseries?list=PL123",
+])
+def test_list_parameter_takes_precedence(link):
+    assert classify_link(link) == ("playlist", "PL123")
+
+
+@pytest.mark.parametrize("link", [
+    "https://www.youtube.com/@channel",
+    "https://www.youtube.com/watch",
+    "https://youtu.be/",
+    "not a link",
+    "http://[::1",
+])
+def test_unknown_shapes_are_left_to_yt_dlp(link):
+    assert classify_link(link) == (None, None)
+
+
+def test_playlist_entry_takes_its_id_from_the_link():
+    item = _playlist_item(3, {"webpage_url": "https://youtu.be/dQw4w9WgXcQ", "title": "A", "duration": 61.0})
+    assert item == {"position_num": 3, "video_id": "dQw4w9WgXcQ", "title": "A",
+                    "link": "https://youtu.be/dQw4w9WgXcQ", "duration_sec": 61}
+
+
+def test_playlist_entry_without_a_video_id_is_skipped():
+    assert _playlist_item(1, {"webpage_url": "https://www.youtube.com/@channel", "title": "A"}) is None
+
+
+def failing_ydl(error):
+    class YoutubeDL:
+        def __init__(self, opts):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def extract_info(self, link, download=False):
+            raise DownloadError(str(error), (type(error), error, None))
+    return YoutubeDL
+
+
+@pytest.fixture
+def no_cache(monkeypatch):
+    monkeypatch.setattr(yt_parse, "_cached", lambda kind, yt_id: None)
+
+
+def test_failed_extraction_raises_for_retry(monkeypatch, no_cache):
+    monkeypatch.setattr(yt_dlp, "YoutubeDL", failing_ydl(ExtractorError("Unable to download API page")))
+    with pytest.raises(ExtractionError):
+        extract_video("https://youtu.be/dQw4w9WgXcQ")
+    with pytest.raises(ExtractionError):
+        extract("https://www.youtube.com/@channel")
+
+
+def test_unsupported_link_is_not_a_video_or_playlist(monkeypatch, no_cache):
+    monkeypatch.setattr(yt_dlp, "YoutubeDL", failing_ydl(UnsupportedError("https://www.youtube.com/about")))
+    assert extract("https://www.youtube.com/about") is None